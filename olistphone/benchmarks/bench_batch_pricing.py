@@ -0,0 +1,69 @@
+'''
+Measures the batch pricing of a million calls with price_calls, and
+the scalar calculate_pricing on a sample of the same calls.
+
+Usage: python benchmarks/bench_batch_pricing.py
+'''
+from common import time_per_call
+from datetime import date, datetime
+from decimal import Decimal
+from rest.models import CallTariff
+from rest.services import calculate_pricing, price_calls
+import time
+# Batch pricing is optional, as NumPy is not a requirement
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CALLS = 1000000
+SCALAR_SAMPLE = 20000
+
+
+def main():
+    if numpy is None:
+        print('Skipped: batch pricing requires NumPy to be installed')
+        return
+    tariffs = [
+        CallTariff(
+            valid_after=date(year, 1, 1),
+            base_tariff=Decimal('0.36'),
+            minute_charge=Decimal('0.09'),
+            discount_charge=Decimal('0.01')
+        ) for year in range(2000, 2020)
+    ]
+    generator = numpy.random.RandomState(2018)
+    # Starts over a year, lasting up to two hours
+    starts = (
+        numpy.datetime64('2018-01-01T00:00:00', 'us')
+        + generator.randint(0, 365 * 86400 * 10**6, CALLS, dtype='int64')
+    )
+    ends = starts + generator.randint(
+        0,
+        2 * 3600 * 10**6,
+        CALLS,
+        dtype='int64'
+    )
+    began = time.perf_counter()
+    price_calls(starts, ends, tariffs)
+    batch = time.perf_counter() - began
+    sample = [
+        (start, end, tariffs[-1])
+        for start, end in zip(
+            starts[:SCALAR_SAMPLE].astype(datetime),
+            ends[:SCALAR_SAMPLE].astype(datetime)
+        )
+    ]
+    sample_iterator = iter(sample * 2)
+
+    def price_next():
+        calculate_pricing(*next(sample_iterator))
+
+    scalar = time_per_call(price_next, SCALAR_SAMPLE)
+    print('{:>12} {:>16}'.format('pricing', 'calls/s'))
+    print('{:>12} {:>16,.0f}'.format('price_calls', CALLS / batch))
+    print('{:>12} {:>16,.0f}'.format('scalar', 1 / scalar))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+'''
+Measures closing a month: billing every call of the month and storing
+the statement of each subscriber, with growing numbers of workers.
+
+Usage: python benchmarks/bench_close_period.py [calls] [workers,...]
+'''
+from common import create_test_database
+from datetime import datetime, timedelta
+from decimal import Decimal
+from django.core.management import call_command
+from django.db import transaction
+from io import StringIO
+from rest.models import Call, PhoneBill
+import os
+import sys
+import tempfile
+import time
+
+CALLS = 200000
+CALLS_PER_SUBSCRIBER = 50
+# A month of 10M records, i.e. 5M start and end pairs
+TARGET_CALLS = 5000000
+
+
+def create_month(calls):
+    '''
+    Stores "calls" calls ending in march 2018, spread over subscribers
+    '''
+    start = datetime(2018, 3, 1)
+    seconds = 30 * 86400 // CALLS_PER_SUBSCRIBER
+    batch = []
+    for call_id in range(calls):
+        subscriber, number = divmod(call_id, CALLS_PER_SUBSCRIBER)
+        call_start = start + timedelta(seconds=number*seconds)
+        batch.append(Call(
+            call_id=call_id,
+            source='21{:09d}'.format(subscriber),
+            destination='41{:09d}'.format(call_id),
+            start_timestamp=call_start,
+            end_timestamp=call_start + timedelta(seconds=150),
+            duration=150,
+            charge=Decimal('0.54')
+        ))
+        if len(batch) == 10000:
+            with transaction.atomic():
+                Call.objects.bulk_create(batch)
+            batch = []
+    with transaction.atomic():
+        Call.objects.bulk_create(batch)
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else CALLS
+    workers = [
+        int(count) for count in (
+            sys.argv[2] if len(sys.argv) > 2 else '1'
+        ).split(',')
+    ]
+    # Workers need a database file they can all open
+    database = os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+    create_test_database(database)
+    create_month(calls)
+    print('{:>8} {:>10} {:>14} {:>18}'.format(
+        'workers',
+        'time (s)',
+        'records/s',
+        '10M records (min)'
+    ))
+    for count in workers:
+        # Every run creates the bills from scratch
+        PhoneBill.objects.all().delete()
+        began = time.perf_counter()
+        call_command(
+            'close_billing_period',
+            '2018-03',
+            workers=count,
+            stdout=StringIO()
+        )
+        elapsed = time.perf_counter() - began
+        print('{:>8} {:>10.1f} {:>14,.0f} {:>18.1f}'.format(
+            count,
+            elapsed,
+            2 * calls / elapsed,
+            TARGET_CALLS * elapsed / calls / 60
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+'''
+Measures the latency of billing reads while records are being ingested,
+on a SQLite file with its default settings (rollback journal, full
+fsync) and with the SQLITE_PRAGMAS of settings.py.
+
+On Linux, the latency of each read is split into the time it ran, the
+time it waited for a CPU taken by the other processes, and the time it
+was blocked, e.g. sleeping until the writer released its lock. Only
+the latter depends on the PRAGMAs, and it shows even on a machine with
+fewer cores than processes, where waiting for the CPU dominates.
+
+Usage: python benchmarks/bench_concurrent_sqlite.py [seconds]
+'''
+from common import create_test_database
+from datetime import datetime, timedelta
+from decimal import Decimal
+from django.conf import settings
+from django.db import connection, connections, OperationalError
+from django.test import RequestFactory
+from rest.ingest import ingest_records
+from rest.models import Call
+from rest.views import MonthlyBillingView
+import rest.statement_cache as statement_cache
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+SECONDS = 5
+SUBSCRIBER = '21999999999'
+# Calls in the statement read. A small one, so reads are quick and any
+# wait for a lock shows
+CALLS = 20
+# Records ingested per batch, half of them start records
+BATCH_SIZE = 500
+# Processes reading statements, next to the one ingesting
+READERS = 2
+# The settings SQLite ships with
+DEFAULT_PRAGMAS = {'journal_mode': 'delete', 'synchronous': 'full'}
+
+
+def create_statement():
+    '''
+    Stores the march 2018 calls of the subscriber the readers bill
+    '''
+    start = datetime(2018, 3, 1)
+    Call.objects.bulk_create([
+        Call(
+            call_id=10**6 + number,
+            source=SUBSCRIBER,
+            destination='41{:09d}'.format(number),
+            start_timestamp=start + timedelta(hours=number),
+            end_timestamp=start + timedelta(hours=number, seconds=90),
+            duration=90,
+            charge=Decimal('0.45')
+        ) for number in range(CALLS)
+    ])
+
+
+def ingest(seconds, first_call_id):
+    '''
+    Ingests batches of calls of other subscribers for a number of
+    seconds, returning the time each batch took and the number of
+    batches that failed on a lock
+    '''
+    start = datetime(2018, 4, 1)
+    call_id = first_call_id
+    batches = []
+    failures = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        items = []
+        for _ in range(BATCH_SIZE // 2):
+            call_id += 1
+            timestamp = start + timedelta(seconds=call_id)
+            items.append({
+                'type': 'S',
+                'timestamp': timestamp.isoformat(),
+                'call_id': call_id,
+                'source': '21{:08d}'.format(call_id),
+                'destination': '41000000000'
+            })
+            items.append({
+                'type': 'E',
+                'timestamp': (
+                    timestamp + timedelta(seconds=30)
+                ).isoformat(),
+                'call_id': call_id
+            })
+        began = time.perf_counter()
+        try:
+            ingest_records(items)
+        # Readers held the lock the batch needed to commit
+        except OperationalError:
+            failures += 1
+            continue
+        batches.append(time.perf_counter() - began)
+    connection.close()
+    return batches, failures
+
+
+def scheduler_times():
+    '''
+    Gets the time the current thread has run and has waited for a CPU,
+    in seconds, or None where Linux's schedstat is not available
+    '''
+    try:
+        with open('/proc/thread-self/schedstat') as schedstat:
+            queued = schedstat.read().split()[1]
+    except (OSError, IndexError):
+        return None
+    # The run time of schedstat lags by up to a scheduler tick, while
+    # the thread's CPU clock is exact. The time waiting for a CPU is
+    # settled by the time the thread runs to read it.
+    return time.thread_time(), int(queued) / 1e9
+
+
+def read(seconds):
+    '''
+    Requests the subscriber's statement, computed from the database
+    every time, for a number of seconds, returning the (latency, time
+    waiting for a CPU, time blocked) of each request and the number of
+    requests that failed on a lock
+    '''
+    view = MonthlyBillingView.as_view()
+    latencies = []
+    failures = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        statement_cache.clear()
+        request = RequestFactory().get('/billing/')
+        scheduled = scheduler_times()
+        began = time.perf_counter()
+        try:
+            view(request, phone_number=SUBSCRIBER, year_month='03-2018')
+        except OperationalError:
+            failures += 1
+            continue
+        latency = time.perf_counter() - began
+        if scheduled is None:
+            latencies.append((latency, None, None))
+            continue
+        ran, queued = (
+            after - before
+            for before, after in zip(scheduled, scheduler_times())
+        )
+        latencies.append((latency, queued, max(latency - ran - queued, 0)))
+    connection.close()
+    return latencies, failures
+
+
+def percentile(values, fraction):
+    '''
+    Gets a percentile of some values, in milliseconds, or None if they
+    were not measured
+    '''
+    values = sorted(values)
+    if not values or values[0] is None:
+        return None
+    return values[min(int(len(values) * fraction), len(values) - 1)] * 1000
+
+
+def spin(seconds, first_call_id):
+    '''
+    Keeps a CPU busy for a number of seconds without touching the
+    database, taking the place of the writer to tell the time reads
+    wait for a CPU from the time they wait for its locks
+    '''
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        sum(range(10000))
+    return [], 0
+
+
+def measure(pragmas, seconds, first_call_id, writer=ingest):
+    '''
+    Reads and ingests at once, in worker processes like those of an
+    application server, for a number of seconds with a set of PRAGMAs.
+    Returns the read latencies, the ingest batch times, and the
+    number of reads and batches that failed.
+    '''
+    settings.SQLITE_PRAGMAS = pragmas
+    # The workers are forked from this process. Closing its connections
+    # first makes each of them open its own, with the PRAGMAs
+    connections.close_all()
+    with ProcessPoolExecutor(
+            max_workers=READERS + 1,
+            mp_context=multiprocessing.get_context('fork')) as executor:
+        writer = executor.submit(writer, seconds, first_call_id)
+        readers = [
+            executor.submit(read, seconds) for _ in range(READERS)
+        ]
+        latencies = []
+        failures = 0
+        for reader in readers:
+            reader_latencies, reader_failures = reader.result()
+            latencies.extend(reader_latencies)
+            failures += reader_failures
+        batches, writer_failures = writer.result()
+    return latencies, batches, failures + writer_failures
+
+
+def milliseconds(value):
+    '''
+    Formats a time in milliseconds, or n/a if it was not measured
+    '''
+    return 'n/a' if value is None else '{:.1f}'.format(value)
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else SECONDS
+    # The queries are not logged, as they would be in production
+    settings.DEBUG = False
+    tuned = settings.SQLITE_PRAGMAS
+    # Readers and writers only contend on a database file
+    directory = tempfile.mkdtemp()
+    try:
+        settings.SQLITE_PRAGMAS = DEFAULT_PRAGMAS
+        create_test_database(os.path.join(directory, 'bench.sqlite3'))
+        create_statement()
+        # Latencies, then the p99 of the time waiting for a CPU and of
+        # the time blocked, and the reads blocked over a millisecond
+        columns = '{:>8} {:>6} {:>8} {:>8} {:>8} {:>9} {:>9} {:>8} {:>9} {:>8}'
+        print(columns.format(
+            'profile',
+            'reads',
+            'p50 ms',
+            'p99 ms',
+            'max ms',
+            'cpu p99',
+            'blk p99',
+            'blk >1ms',
+            'records/s',
+            'failures'
+        ))
+        # The first run only loads the CPU, as much as the writer does
+        for run, (profile, pragmas, writer) in enumerate((
+                ('cpu only', tuned, spin),
+                ('default', DEFAULT_PRAGMAS, ingest),
+                ('tuned', tuned, ingest))):
+            latencies, batches, failures = measure(
+                pragmas,
+                seconds,
+                run * 10**6,
+                writer
+            )
+            latency, queued, blocked = zip(*latencies)
+            print(columns.format(
+                profile,
+                len(latencies),
+                milliseconds(percentile(latency, 0.5)),
+                milliseconds(percentile(latency, 0.99)),
+                milliseconds(percentile(latency, 1)),
+                milliseconds(percentile(queued, 0.99)),
+                milliseconds(percentile(blocked, 0.99)),
+                'n/a' if blocked[0] is None else sum(
+                    time > 0.001 for time in blocked
+                ),
+                '{:.0f}'.format(len(batches) * BATCH_SIZE / seconds),
+                failures
+            ))
+    finally:
+        connections.close_all()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
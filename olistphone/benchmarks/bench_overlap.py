@@ -0,0 +1,83 @@
+'''
+Measures the overlap validation of a new start record against sources
+with a growing call history. The latency should stay flat.
+
+Usage: python benchmarks/bench_overlap.py
+'''
+from common import create_test_database, time_per_call
+from datetime import datetime, timedelta
+from django.db import transaction
+from rest.models import CallRecord, LastCall
+
+HISTORY_SIZES = (10, 100, 1000, 10000, 100000)
+REPEAT = 500
+
+
+def create_history(source, calls):
+    '''
+    Stores "calls" finished calls for a source, five minutes apart,
+    and returns the end of the last one and the start of the middle one
+    '''
+    start = datetime(2010, 1, 1)
+    call_id = int(source)
+    records = []
+    for number in range(calls):
+        timestamp = start + timedelta(minutes=5*number)
+        records.append(CallRecord(
+            type='S',
+            timestamp=timestamp,
+            call_id=call_id+number,
+            source=source,
+            destination='41000000000'
+        ))
+        records.append(CallRecord(
+            type='E',
+            timestamp=timestamp+timedelta(minutes=2),
+            call_id=call_id+number
+        ))
+    with transaction.atomic():
+        CallRecord.objects.bulk_create(records)
+    LastCall.objects.create(
+        source=source,
+        call_id=records[-1].call_id,
+        start_timestamp=records[-2].timestamp,
+        end_timestamp=records[-1].timestamp
+    )
+    return records[-1].timestamp, records[2*(calls//2)].timestamp
+
+
+def main():
+    create_test_database()
+    print('{:>10} {:>16} {:>16}'.format(
+        'history',
+        'new call (us)',
+        'late call (us)'
+    ))
+    for index, calls in enumerate(HISTORY_SIZES):
+        source = '21{:09d}'.format((index+1)*10000000)
+        last_end, middle = create_history(source, calls)
+        # A start record after the whole history...
+        new_call = CallRecord(
+            type='S',
+            timestamp=last_end+timedelta(minutes=1),
+            call_id=1,
+            source=source,
+            destination='41999999999'
+        )
+        # ...and one arriving late, in the middle of the history
+        late_call = CallRecord(
+            type='S',
+            timestamp=middle+timedelta(minutes=3),
+            call_id=2,
+            source=source,
+            destination='41999999999'
+        )
+        print('{:>10} {:>16.1f} {:>16.1f}'.format(
+            calls,
+            time_per_call(new_call.validate_overlap, REPEAT) * 1e6,
+            time_per_call(late_call.validate_overlap, REPEAT) * 1e6
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+'''
+Measures the pricing of a single call with the closed-form
+calculate_pricing against the period walk it replaced, which is kept
+in the tests as the reference.
+
+Usage: python benchmarks/bench_pricing.py
+'''
+from common import time_per_call
+from datetime import datetime, timedelta
+from decimal import Decimal
+from rest.models import CallTariff
+from rest.services import calculate_pricing
+from rest.test_service import reference_pricing
+
+CALLS = (
+    ('5 minutes', timedelta(minutes=5)),
+    ('across 22:00', timedelta(hours=2)),
+    ('overnight', timedelta(hours=10)),
+    ('3 days', timedelta(days=3)),
+)
+REPEAT = 20000
+
+
+def main():
+    tariff = CallTariff(
+        base_tariff=Decimal('0.36'),
+        minute_charge=Decimal('0.09'),
+        discount_charge=Decimal('0.00')
+    )
+    start = datetime(2018, 6, 27, 21, 0, 0)
+    print('{:>14} {:>16} {:>16} {:>10}'.format(
+        'call',
+        'walk (us)',
+        'closed (us)',
+        'speedup'
+    ))
+    for name, duration in CALLS:
+        end = start + duration
+        walk = time_per_call(
+            lambda: reference_pricing(start, end, tariff),
+            REPEAT
+        )
+        closed = time_per_call(
+            lambda: calculate_pricing(start, end, tariff),
+            REPEAT
+        )
+        print('{:>14} {:>16.2f} {:>16.2f} {:>9.1f}x'.format(
+            name,
+            walk * 1e6,
+            closed * 1e6,
+            walk / closed
+        ))
+
+
+if __name__ == '__main__':
+    main()
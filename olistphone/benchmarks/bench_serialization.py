@@ -0,0 +1,64 @@
+'''
+Measures the cost of serializing each billed call of a statement with
+PhoneBillSerializer and with the read-only representation the billing
+responses use, from bills and from values_list tuples.
+
+Usage: python benchmarks/bench_serialization.py [bills]
+'''
+from common import time_per_call
+from datetime import datetime, timedelta
+from decimal import Decimal
+from rest.models import PhoneBill
+from rest.serializers import (
+    PhoneBillSerializer,
+    represent_bills,
+    represent_bill_values
+)
+import sys
+
+BILLS = 20000
+REPEAT = 5
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else BILLS
+    start = datetime(2018, 3, 1)
+    bills = []
+    for number in range(count):
+        duration = 37 * number % 3600
+        # Priced at the standard rate, in cents
+        cents = 36 + 9 * (duration // 60)
+        bills.append(PhoneBill(
+            destination='41{:09d}'.format(number),
+            start_timestamp=start + timedelta(seconds=97*number),
+            call_duration=duration,
+            charge=Decimal('{}.{:02d}'.format(cents // 100, cents % 100))
+        ))
+    rows = [
+        tuple(
+            getattr(bill, field) for field in PhoneBillSerializer.Meta.fields
+        ) for bill in bills
+    ]
+    timings = [
+        # The best of a few runs, the others being slowed by the system
+        (name, min(
+            time_per_call(function, 1) for _ in range(REPEAT)
+        )) for name, function in (
+            ('PhoneBillSerializer',
+             lambda: PhoneBillSerializer(bills, many=True).data),
+            ('represent_bills', lambda: represent_bills(bills)),
+            ('represent_bill_values', lambda: represent_bill_values(rows)),
+        )
+    ]
+    baseline = timings[0][1]
+    print('{:>22} {:>14} {:>8}'.format('', 'us per call', 'speedup'))
+    for name, elapsed in timings:
+        print('{:>22} {:>14.2f} {:>7.1f}x'.format(
+            name,
+            elapsed / count * 10**6,
+            baseline / elapsed
+        ))
+
+
+if __name__ == '__main__':
+    main()
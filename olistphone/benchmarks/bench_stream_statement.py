@@ -0,0 +1,113 @@
+'''
+Compares the time to first byte and the peak memory of a statement
+rendered at once and streamed, as the number of calls grows.
+
+Usage: python benchmarks/bench_stream_statement.py [calls,...]
+'''
+from common import create_test_database
+from datetime import datetime, timedelta
+from decimal import Decimal
+from django.conf import settings
+from django.db import transaction
+from django.test import RequestFactory
+from rest.models import Call, PhoneBill
+from rest.views import MonthlyBillingView
+import rest.statement_cache as statement_cache
+import sys
+import time
+import tracemalloc
+
+CALLS = '10000,50000'
+SUBSCRIBER = '21999999999'
+
+
+def create_calls(first, last):
+    '''
+    Stores the calls numbered from first to last (exclusive), all of
+    them made by the subscriber and ending in march 2018
+    '''
+    start = datetime(2018, 3, 1)
+    batch = []
+    for call_id in range(first, last):
+        call_start = start + timedelta(seconds=10*call_id)
+        batch.append(Call(
+            call_id=call_id,
+            source=SUBSCRIBER,
+            destination='41{:09d}'.format(call_id),
+            start_timestamp=call_start,
+            end_timestamp=call_start + timedelta(seconds=5),
+            duration=5,
+            charge=Decimal('0.36')
+        ))
+        if len(batch) == 10000:
+            with transaction.atomic():
+                Call.objects.bulk_create(batch)
+            batch = []
+    with transaction.atomic():
+        Call.objects.bulk_create(batch)
+
+
+def measure(query):
+    '''
+    Requests the statement, returning the time to first byte, the
+    total time, and the peak memory allocated
+    '''
+    # Every run bills the calls from scratch
+    PhoneBill.objects.all().delete()
+    statement_cache.clear()
+    request = RequestFactory().get('/billing/', query)
+    tracemalloc.start()
+    began = time.perf_counter()
+    response = MonthlyBillingView.as_view()(
+        request,
+        phone_number=SUBSCRIBER,
+        year_month='03-2018'
+    )
+    if response.streaming:
+        content = iter(response.streaming_content)
+        next(content)
+        first_byte = time.perf_counter() - began
+        for _ in content:
+            pass
+    else:
+        response.render()
+        first_byte = time.perf_counter() - began
+    elapsed = time.perf_counter() - began
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return first_byte, elapsed, peak
+
+
+def main():
+    counts = [
+        int(count) for count in (
+            sys.argv[1] if len(sys.argv) > 1 else CALLS
+        ).split(',')
+    ]
+    # The queries are not logged, as they would be in production
+    settings.DEBUG = False
+    create_test_database()
+    print('{:>8} {:>9} {:>10} {:>10} {:>10}'.format(
+        'calls',
+        'mode',
+        'TTFB (ms)',
+        'total (s)',
+        'peak (MB)'
+    ))
+    stored = 0
+    for count in counts:
+        create_calls(stored, count)
+        stored = count
+        for mode, query in (('buffered', {}), ('streamed', {'stream': 1})):
+            first_byte, elapsed, peak = measure(query)
+            print('{:>8} {:>9} {:>10.1f} {:>10.2f} {:>10.1f}'.format(
+                count,
+                mode,
+                first_byte * 1000,
+                elapsed,
+                peak / 2**20
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+'''
+Measures the tariff lookup of a call start, from the in-memory tariff
+timeline and with the per-call query it replaces.
+
+Usage: python benchmarks/bench_tariffs.py
+'''
+from common import create_test_database, time_per_call
+from datetime import date, datetime
+from decimal import Decimal
+from rest.models import CallTariff
+from rest.tariffs import get_timeline
+
+# Tariffs changing twice a year, for 30 years
+TARIFF_DATES = [
+    date(year, month, 1)
+    for year in range(1990, 2020)
+    for month in (1, 7)
+]
+REPEAT = 100000
+QUERY_REPEAT = 2000
+
+
+def main():
+    create_test_database()
+    CallTariff.objects.bulk_create([
+        CallTariff(
+            valid_after=valid_after,
+            base_tariff=Decimal('0.36'),
+            minute_charge=Decimal('0.09'),
+            discount_charge=Decimal('0.00')
+        ) for valid_after in TARIFF_DATES
+    ])
+    start = datetime(2005, 3, 14, 12, 0, 0)
+    timeline = get_timeline()
+
+    def query():
+        CallTariff.objects.filter(
+            valid_after__lte=start
+        ).order_by('-valid_after')[0]
+
+    print('{:>24} {:>12}'.format('lookup', 'time (us)'))
+    print('{:>24} {:>12.3f}'.format(
+        'timeline.tariff_at',
+        time_per_call(lambda: timeline.tariff_at(start), REPEAT) * 1e6
+    ))
+    print('{:>24} {:>12.3f}'.format(
+        'query',
+        time_per_call(query, QUERY_REPEAT) * 1e6
+    ))
+
+
+if __name__ == '__main__':
+    main()
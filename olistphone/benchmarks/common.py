@@ -0,0 +1,40 @@
+'''
+Shared setup for the benchmark scripts. They always run against a
+throwaway test database, never against db.sqlite3.
+'''
+import os
+import sys
+import time
+
+sys.path.insert(
+    0,
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'olistphone.settings')
+
+import django
+django.setup()
+
+from django.db import connection
+
+
+def create_test_database(name=None):
+    '''
+    Creates and migrates an empty test database, and points the
+    default connection at it. On SQLite it lives in memory unless
+    a file name is given, e.g. to share it with worker processes.
+    '''
+    if name is not None:
+        connection.settings_dict['TEST']['NAME'] = name
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+
+def time_per_call(function, repeat):
+    '''
+    Calls a function "repeat" times and returns the mean time per
+    call, in seconds
+    '''
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
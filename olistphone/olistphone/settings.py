@@ -31,7 +31,7 @@ ALLOWED_HOSTS = []
 # Application definition
 
 INSTALLED_APPS = [
-    'rest',
+    'rest.apps.RestConfig',
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -42,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'rest.middleware.ReplicaPinningMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -79,9 +80,100 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # Keep connections open across requests, for up to this many
+        # seconds, instead of opening one per request
+        'CONN_MAX_AGE': 600,
     }
 }
 
+# Set OLISTPHONE_DATABASE=postgresql in the environment to use
+# PostgreSQL 11 or later instead, configured through the POSTGRES_*
+# variables. It needs psycopg2 (pip install psycopg2-binary). There,
+# CallRecord, Call and PhoneBill are partitioned by month.
+if os.environ.get('OLISTPHONE_DATABASE') == 'postgresql':
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('POSTGRES_DB', 'olistphone'),
+        'USER': os.environ.get('POSTGRES_USER', ''),
+        'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+        'HOST': os.environ.get('POSTGRES_HOST', ''),
+        'PORT': os.environ.get('POSTGRES_PORT', ''),
+        'CONN_MAX_AGE': 600,
+    }
+
+# Read replicas of the database, which serve the billing statements
+# (see rest.routers). Set OLISTPHONE_REPLICAS in the environment to a
+# comma separated list of replica hosts on PostgreSQL, or of database
+# files on SQLite, e.g. a copy of db.sqlite3 refreshed with the sqlite3
+# .backup command, to try replicas out locally. Tests read the replicas
+# through the default database.
+DATABASE_REPLICAS = []
+for index, replica in enumerate(
+        filter(None, os.environ.get('OLISTPHONE_REPLICAS', '').split(','))):
+    alias = 'replica{}'.format(index + 1)
+    DATABASES[alias] = dict(DATABASES['default'])
+    if DATABASES[alias]['ENGINE'] == 'django.db.backends.sqlite3':
+        DATABASES[alias]['NAME'] = replica
+    else:
+        DATABASES[alias]['HOST'] = replica
+    DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+    DATABASE_REPLICAS.append(alias)
+
+# Databases the data of the subscribers is sharded across, by a hash of
+# their number (see rest.shards). Set OLISTPHONE_SHARDS in the
+# environment to a comma separated list of database files on SQLite, or
+# of database names on PostgreSQL, "default" standing for the default
+# database. The default database keeps the data shared by every shard.
+# Migrate each of them with migrate --database.
+SHARDS = ['default']
+shard_names = list(
+    filter(None, os.environ.get('OLISTPHONE_SHARDS', '').split(','))
+)
+if shard_names:
+    SHARDS = []
+for index, name in enumerate(shard_names):
+    alias = 'default' if name == 'default' else 'shard{}'.format(index + 1)
+    if alias != 'default':
+        DATABASES[alias] = dict(DATABASES['default'])
+        DATABASES[alias]['NAME'] = name
+    SHARDS.append(alias)
+
+# The shards take the models holding data of a subscriber, the replicas
+# may serve the others
+DATABASE_ROUTERS = [
+    'rest.shards.ShardRouter',
+    'rest.routers.ReplicaRouter',
+]
+
+# Seconds the replicas may lag behind the primary. Clients are pinned to
+# the primary for as long after they write.
+REPLICA_MAX_LAG = 5
+
+# Directory of the files the calls of archived months are moved to (see
+# rest.archive), which every server process must be able to read
+ARCHIVE_DIR = os.path.join(BASE_DIR, 'archive')
+
+# Monthly partitions created ahead of the current month, on PostgreSQL.
+# They are created after every migrate, and by the create_partitions
+# command, which should run at least monthly (e.g. from cron)
+PARTITION_MONTHS_AHEAD = 3
+
+# PRAGMAs run on every new SQLite connection (see rest.signals).
+# In WAL mode billing reads go on while records are written, and with
+# synchronous=NORMAL commits wait for no fsync (a power loss may undo
+# the last ones, but never corrupts the database). The journal mode is
+# stored in the database file, the others are set per connection.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    # Bytes of the file read through memory mapping
+    'mmap_size': 256 * 2**20,
+    # Pages cached per connection, or KiB if negative
+    'cache_size': -64 * 2**10,
+    # How long to wait for a lock held by another connection, in ms
+    'busy_timeout': 5000,
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
@@ -120,3 +212,63 @@ USE_TZ = False
 # https://docs.djangoproject.com/en/2.0/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Billing
+
+# How long clients may use the statement of a closed month before
+# revalidating it, in seconds. A closed statement still changes when
+# a late call is billed and the month is closed again.
+CLOSED_STATEMENT_MAX_AGE = 3600
+
+# Cache the statements computed on request are stored in
+STATEMENT_CACHE = 'statements'
+
+
+# Ingest
+
+# Whether /records/ spools the records it receives and answers 202
+# Accepted, leaving them to the apply_spool command
+INGEST_ASYNC = False
+
+# Directory of the spool, which must be on a local disk
+INGEST_SPOOL_DIR = os.path.join(BASE_DIR, 'spool')
+
+# How long an append waits for others before they are fsynced together,
+# in seconds. Longer waits fsync less often, at the cost of latency
+INGEST_SPOOL_FLUSH_INTERVAL = 0.005
+
+# Period covered by each segment file of the spool, in seconds
+INGEST_SPOOL_SEGMENT_SECONDS = 3600
+
+# Records apply_spool stores per transaction
+INGEST_APPLY_BATCH_SIZE = 1000
+
+# How long apply_spool sleeps when the spool is drained, in seconds
+INGEST_APPLY_INTERVAL = 0.5
+
+
+# Cache
+# https://docs.djangoproject.com/en/2.0/topics/cache/
+
+# Local memory caches are private to each process, so a process would
+# keep serving statements from before a tariff change another one
+# recorded. Servers running more than one process should use the file
+# based backend instead, e.g.
+# 'django.core.cache.backends.filebased.FileBasedCache' with a LOCATION
+# directory all of them can write to.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    STATEMENT_CACHE: {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'statements',
+        # Entries of old versions of a statement are never read again,
+        # and are left to expire
+        'TIMEOUT': 3600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+}
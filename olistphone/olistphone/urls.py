@@ -21,6 +21,11 @@ urlpatterns = [
     path(r'api-auth/', include('rest_framework.urls',
                                namespace='rest_framework')),
     path(r'records/', views.CallRecordView.as_view()),
+    path(r'records/bulk/', views.BulkCallRecordView.as_view()),
+    path(r'records/spool/<str:position>/',
+         views.RecordStatusView.as_view()),
+    path(r'records/rejected/', views.RejectedRecordsView.as_view()),
+    path(r'billing/cache/', views.StatementCacheView.as_view()),
     path(r'billing/<str:phone_number>/',
          views.MonthlyBillingView.as_view()),
     path(r'billing/<str:phone_number>/<str:year_month>/',
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class RestConfig(AppConfig):
     name = 'rest'
+
+    def ready(self):
+        # Connects the signal receivers
+        import rest.signals
@@ -0,0 +1,314 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from calendar import timegm
+from datetime import datetime, timedelta
+from decimal import Context, Decimal
+from django.conf import settings
+from rest.models import ArchivedCall, Call, CallRecord, chunks
+from threading import Lock
+import heapq
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+
+# The calls of old months are moved out of the database by the
+# archive_records command, to a file per month in ARCHIVE_DIR, which
+# /billing/ reads instead. The file is columnar: a header, then each
+# field of every call stored contiguously, as fixed-width little-endian
+# integers. Phone numbers are stored as numbers, with a leading 1 so
+# the leading zeros and the length survive, timestamps in microseconds
+# since the epoch (UTC) and charges in cents. Calls are sorted by
+# source, then end timestamp, so the calls of a subscriber are found by
+# binary search over the memory-mapped source column, without reading
+# the rest of the file. The records of the archived calls are deleted
+# from the database, and ArchivedCall keeps the source and month of
+# each call_id, so the records of a call are rebuilt from its file when
+# they are sent again.
+
+MAGIC = b'OLCA'
+VERSION = 1
+# Magic, version, number of calls and when the file was written, in
+# microseconds since the epoch
+HEADER = struct.Struct('<4sIqq')
+# Columns, in the order they are stored. Those of 8 byte integers come
+# first, so every column is aligned on its item size.
+COLUMNS = (
+    ('source', 'q'),
+    ('destination', 'q'),
+    ('start', 'q'),
+    ('end', 'q'),
+    ('charge', 'q'),
+    ('call_id', 'I'),
+    ('duration', 'I'),
+)
+
+EPOCH = datetime(1970, 1, 1)
+# Charges are converted exactly, whatever the precision of the current
+# decimal context
+CENTS = Context(prec=28)
+
+
+def encode_number(number):
+    '''
+    Stores a phone number as an integer
+    '''
+    return int('1' + number)
+
+
+def decode_number(value):
+    '''
+    Gets back a phone number stored as an integer
+    '''
+    return str(value)[1:]
+
+
+def encode_timestamp(timestamp):
+    '''
+    Stores a (naive, UTC) timestamp as microseconds since the epoch
+    '''
+    return (
+        timegm(timestamp.utctimetuple()) * 10**6 + timestamp.microsecond
+    )
+
+
+def decode_timestamp(value):
+    '''
+    Gets back a timestamp stored as microseconds since the epoch
+    '''
+    return EPOCH + timedelta(microseconds=value)
+
+
+def archive_path(reference_start):
+    '''
+    Gets the path of the archive of the month starting at reference_start
+    '''
+    return os.path.join(
+        settings.ARCHIVE_DIR,
+        'calls-{:%Y-%m}.olca'.format(reference_start)
+    )
+
+
+class CallArchive(object):
+    '''
+    The calls of an archived month, read from a memory-mapped file
+    '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as archive:
+            self.map = mmap.mmap(
+                archive.fileno(),
+                0,
+                access=mmap.ACCESS_READ
+            )
+        magic, version, self.count, self.written_at = HEADER.unpack_from(
+            self.map
+        )
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not a call archive.'.format(path))
+        self.columns = {}
+        offset = HEADER.size
+        view = memoryview(self.map)
+        for name, typecode in COLUMNS:
+            size = array(typecode).itemsize * self.count
+            column = view[offset:offset+size]
+            # The columns are read in place on little-endian machines
+            if sys.byteorder == 'little':
+                column = column.cast(typecode)
+            else:
+                column = array(typecode, column.tobytes())
+                column.byteswap()
+            self.columns[name] = column
+            offset += size
+
+    def positions(self, subscriber):
+        '''
+        Gets the range of the positions of a subscriber's calls
+        '''
+        source = encode_number(subscriber)
+        sources = self.columns['source']
+        return (
+            bisect_left(sources, source),
+            bisect_right(sources, source)
+        )
+
+    def calls_of(self, subscriber):
+        '''
+        Gets the calls of a subscriber, as unsaved Calls ordered by their
+        end timestamp. Their id is their call_id.
+        '''
+        first, end = self.positions(subscriber)
+        columns = self.columns
+        return [
+            Call(
+                id=columns['call_id'][position],
+                call_id=columns['call_id'][position],
+                source=subscriber,
+                destination=decode_number(
+                    columns['destination'][position]
+                ),
+                start_timestamp=decode_timestamp(
+                    columns['start'][position]
+                ),
+                end_timestamp=decode_timestamp(columns['end'][position]),
+                duration=columns['duration'][position],
+                charge=Decimal(columns['charge'][position]).scaleb(
+                    -2,
+                    CENTS
+                )
+            ) for position in range(first, end)
+        ]
+
+    def rows(self):
+        '''
+        Iterates over every call of the archive, as column tuples in the
+        order of COLUMNS
+        '''
+        columns = [self.columns[name] for name, _ in COLUMNS]
+        for position in range(self.count):
+            yield tuple(column[position] for column in columns)
+
+
+# Archives opened by this process, by path, along with the inode, size
+# and modification time of the file they were opened from
+_archives = {}
+_lock = Lock()
+
+
+def open_archive(reference_start):
+    '''
+    Gets the archive of a month, or None if it was not archived. Each
+    process maps a file once, and again when it is archived anew.
+    '''
+    path = archive_path(reference_start)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    version = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    cached = _archives.get(path)
+    if cached is None or cached[0] != version:
+        with _lock:
+            cached = (version, CallArchive(path))
+            _archives[path] = cached
+    return cached[1]
+
+
+def call_row(call):
+    '''
+    Gets the column tuple of a Call
+    '''
+    return (
+        encode_number(call.source),
+        encode_number(call.destination),
+        encode_timestamp(call.start_timestamp),
+        encode_timestamp(call.end_timestamp),
+        int(call.charge.scaleb(2, CENTS)),
+        call.call_id,
+        call.duration,
+    )
+
+
+def write_archive(reference_start, rows):
+    '''
+    Writes the archive of a month from column tuples sorted by source
+    and end timestamp, replacing the previous one at once. Returns the
+    path and the number of calls.
+    '''
+    columns = [array(typecode) for _, typecode in COLUMNS]
+    for row in rows:
+        for column, value in zip(columns, row):
+            column.append(value)
+    count = len(columns[0])
+    path = archive_path(reference_start)
+    os.makedirs(settings.ARCHIVE_DIR, exist_ok=True)
+    descriptor, temporary = tempfile.mkstemp(dir=settings.ARCHIVE_DIR)
+    try:
+        with os.fdopen(descriptor, 'wb') as archive:
+            archive.write(HEADER.pack(
+                MAGIC,
+                VERSION,
+                count,
+                int(time.time() * 10**6)
+            ))
+            for column in columns:
+                if sys.byteorder != 'little':
+                    column.byteswap()
+                column.tofile(archive)
+            # The rows are deleted from the database once the file is
+            # on disk
+            archive.flush()
+            os.fsync(archive.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+    return path, count
+
+
+def merge_rows(archive, rows):
+    '''
+    Merges the rows of an archive with column tuples of calls, sorted by
+    source and end timestamp, the latter replacing archived calls with
+    their call_id
+    '''
+    # Numbers of different lengths sort differently as integers
+    rows = sorted(rows, key=lambda row: (row[0], row[3]))
+    if archive is None:
+        return rows
+    call_ids = {row[5] for row in rows}
+    archived = (
+        row for row in archive.rows() if row[5] not in call_ids
+    )
+    return heapq.merge(archived, rows, key=lambda row: (row[0], row[3]))
+
+
+def has_archives():
+    '''
+    Checks whether any month was archived
+    '''
+    try:
+        with os.scandir(settings.ARCHIVE_DIR) as entries:
+            return any(entry.name.endswith('.olca') for entry in entries)
+    except FileNotFoundError:
+        return False
+
+
+def archived_records(call_ids):
+    '''
+    Gets the start and end records of the archived calls among call_ids,
+    in the current shard, rebuilt from their archive files
+    '''
+    # Ingest only looks the keys up once there is an archive
+    if not has_archives():
+        return []
+    # (period, source) -> call_ids archived
+    archived = {}
+    for chunk in chunks(call_ids):
+        for call_id, source, period in ArchivedCall.objects.filter(
+                call_id__in=chunk).values_list('call_id', 'source', 'period'):
+            archived.setdefault((period, source), set()).add(call_id)
+    records = []
+    for (period, source), ids in archived.items():
+        archive = open_archive(period)
+        # A file removed by hand takes its calls along
+        if archive is None:
+            continue
+        for call in archive.calls_of(source):
+            if call.call_id not in ids:
+                continue
+            records.append(CallRecord(
+                type='S',
+                timestamp=call.start_timestamp,
+                call_id=call.call_id,
+                source=call.source,
+                destination=call.destination
+            ))
+            records.append(CallRecord(
+                type='E',
+                timestamp=call.end_timestamp,
+                call_id=call.call_id
+            ))
+    return records
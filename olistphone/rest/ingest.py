@@ -0,0 +1,193 @@
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+from rest.models import CallRecord, CallRecordFacts
+import rest.archive as archive
+import rest.shards as shards
+
+# Bulk ingestion of call records.
+# Instead of running the CallRecord.validate_* chain (and its queries)
+# once per record, we prefetch every fact the batch needs with a few
+# set-based queries, run the same rules in memory and write the
+# accepted records with a single bulk_create.
+
+# Fields a bulk item may carry
+RECORD_FIELDS = ('type', 'timestamp', 'call_id', 'source', 'destination')
+
+# Clients retry on timeouts, so records are often sent more than once.
+# A record whose type and call_id are stored already is acknowledged as
+# a duplicate if it is the same as the stored one, without running the
+# validations, and reported as a conflict otherwise.
+CONFLICT_MESSAGE = (
+    'A different record with this type and call_id already exists.'
+)
+
+
+def build_record(item):
+    '''
+    Turns one item of a bulk payload into an unsaved CallRecord,
+    running every check that does not need the database.
+    Raises ValidationError if the item is invalid.
+    '''
+    if not isinstance(item, dict):
+        raise ValidationError('Each record must be a JSON object.')
+    record = CallRecord(**{field: item.get(field) for field in RECORD_FIELDS})
+    # End records must not have numbers, which is checked below with a
+    # friendlier message than the "cannot be blank" from clean_fields
+    exclude = ['source', 'destination'] if record.type == 'E' else []
+    record.clean_fields(exclude=exclude)
+    # The model field parses timezone-aware timestamps, but the database
+    # is configured without timezone support. We store them as UTC,
+    # the same way the serializer does for single records
+    if not settings.USE_TZ and timezone.is_aware(record.timestamp):
+        record.timestamp = timezone.make_naive(record.timestamp, timezone.utc)
+    record.validate_end_record_with_numbers()
+    record.validate_source_and_destination()
+    return record
+
+
+def validate_record(record, facts):
+    '''
+    Runs the CallRecord.validate_save rules that need the database
+    against the prefetched facts. Raises ValidationError on the first
+    failure.
+    '''
+    record.validate_source_and_timestamp(facts)
+    record.validate_destination_and_timestamp(facts)
+    record.validate_call_id(facts)
+    record.validate_end_call_timestamp(facts)
+    record.validate_overlap(facts)
+    # The unique_together constraints would otherwise abort the whole
+    # bulk insert, so duplicates are rejected here as well
+    if facts.is_duplicate(record):
+        raise ValidationError(
+            'A record with this type and call_id or call_id and'
+            + ' timestamp already exists.'
+        )
+
+
+def ingest_records(items):
+    '''
+    Validates and stores a batch of raw call records, in order.
+    Returns a list with the accept/reject result of each item.
+    '''
+    results = [None] * len(items)
+    candidates = []
+    # First pass: field and in-memory checks
+    for index, item in enumerate(items):
+        try:
+            candidates.append((index, build_record(item)))
+        except ValidationError as err:
+            results[index] = rejected(index, err)
+    # The records of each shard are stored in a transaction of their
+    # own. Those whose subscribers were moved meanwhile are sent again
+    # to their new shard
+    while candidates:
+        moved = []
+        for alias, shard_candidates in shards.split(candidates):
+            try:
+                with shards.using_shard(alias):
+                    ingest_shard(shard_candidates, results)
+            except shards.ShardMoved:
+                moved.extend(shard_candidates)
+        candidates = sorted(moved, key=lambda candidate: candidate[0])
+    return results
+
+
+def ingest_shard(candidates, results):
+    '''
+    Validates and stores the (index, record) pairs of a batch that go to
+    the current shard, setting their results
+    '''
+    with transaction.atomic(using=shards.current()):
+        facts = CallRecordFacts([record for _, record in candidates])
+        # Second pass: database rules, against the prefetched facts.
+        # Records are processed in payload order, so an end record can
+        # pair with a start record sent earlier in the same batch
+        accepted = []
+        for index, record in candidates:
+            # The stored records sharing call_ids with the batch were
+            # loaded with the facts, and the accepted ones added since
+            stored = facts.records_by_call.get(
+                (record.type, record.call_id)
+            )
+            if stored is not None:
+                results[index] = resent(index, record, stored)
+                continue
+            try:
+                validate_record(record, facts)
+            except ValidationError as err:
+                results[index] = rejected(index, err)
+                continue
+            facts.add(record)
+            accepted.append((index, record))
+        # Nothing to write when every record was a resend or invalid
+        if accepted:
+            try:
+                with transaction.atomic(using=shards.current()):
+                    shards.register_calls(
+                        [record for _, record in accepted]
+                    )
+                    CallRecord.objects.bulk_create(
+                        [record for _, record in accepted]
+                    )
+                    facts.save_last_calls()
+                    facts.save_calls()
+            # Someone else wrote a conflicting record since we loaded the
+            # facts. Fall back to saving one by one, with full validation
+            except IntegrityError:
+                for index, record in list(accepted):
+                    try:
+                        with transaction.atomic(using=shards.current()):
+                            record.save()
+                    except (ValidationError, IntegrityError) as err:
+                        accepted.remove((index, record))
+                        stored = find_stored(record)
+                        if stored is None:
+                            results[index] = rejected(index, err)
+                        else:
+                            results[index] = resent(index, record, stored)
+    for index, _ in accepted:
+        results[index] = {'index': index, 'status': 'accepted'}
+
+
+def find_stored(record):
+    '''
+    Gets the stored record with the type and call_id of a record, or
+    None if there is none, with a lookup on their unique index. The
+    records of archived calls are rebuilt from the archive.
+    '''
+    for stored in CallRecord.objects.filter(
+            type=record.type,
+            call_id=record.call_id)[:1]:
+        return stored
+    for stored in archive.archived_records([record.call_id]):
+        if stored.type == record.type:
+            return stored
+    return None
+
+
+def resent(index, record, stored):
+    '''
+    Builds the result of an item whose type and call_id are stored
+    already: a duplicate if it is the same record, a conflict if not
+    '''
+    if record.is_resend_of(stored):
+        return {'index': index, 'status': 'duplicate'}
+    return {
+        'index': index,
+        'status': 'conflict',
+        'errors': [CONFLICT_MESSAGE]
+    }
+
+
+def rejected(index, err):
+    '''
+    Builds the result of a rejected item
+    '''
+    if isinstance(err, ValidationError):
+        errors = err.messages
+    else:
+        errors = [str(err)]
+    return {'index': index, 'status': 'rejected', 'errors': errors}
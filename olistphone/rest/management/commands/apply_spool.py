@@ -0,0 +1,79 @@
+import fcntl
+import os
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import rest.spool as spool
+
+# Lock file in the spool directory, held by the command applying it
+LOCK_NAME = 'apply.lock'
+
+
+class Command(BaseCommand):
+    help = (
+        'Validates and stores the call records spooled by /records/ in'
+        + ' the asynchronous ingest mode, in the order they arrived.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Apply what is spooled and exit, instead of waiting for'
+            + ' more.'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=settings.INGEST_APPLY_BATCH_SIZE,
+            help='Records stored per transaction.'
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('The batch size must be at least 1.')
+        directory = settings.INGEST_SPOOL_DIR
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, LOCK_NAME), 'w') as lock:
+            # Records must be applied in order, so by one process only
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise CommandError('The spool is being applied already.')
+            accepted, rejected = self.apply(
+                directory,
+                options['batch_size'],
+                options['once']
+            )
+        self.stdout.write(
+            'Applied the spool: {} accepted, {} rejected'.format(
+                accepted,
+                rejected
+            )
+        )
+
+    def apply(self, directory, batch_size, once):
+        '''
+        Applies the spool batch by batch, until it is drained if once
+        is set, or until interrupted otherwise
+        '''
+        accepted = 0
+        rejected = 0
+        try:
+            while True:
+                batch_accepted, batch_rejected = spool.apply_spool(
+                    directory,
+                    batch_size
+                )
+                accepted += batch_accepted
+                rejected += batch_rejected
+                if batch_accepted or batch_rejected:
+                    continue
+                if once:
+                    break
+                time.sleep(settings.INGEST_APPLY_INTERVAL)
+        # The batch being applied was rolled back, and is applied again
+        # on the next run
+        except KeyboardInterrupt:
+            pass
+        return accepted, rejected
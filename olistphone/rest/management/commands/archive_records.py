@@ -0,0 +1,82 @@
+from datetime import datetime
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from rest.models import ArchivedCall, Call, CallRecord, chunks
+import rest.archive as archive
+import rest.services as services
+import rest.shards as shards
+
+
+class Command(BaseCommand):
+    help = (
+        'Moves the calls that ended in a month and their records out of'
+        + ' the database to an archive file, which /billing/ then reads.'
+        + ' Resent records of the calls are checked against the file.'
+        + ' Running it again archives the calls that ended since.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'period',
+            help='The month to archive, as YYYY-MM.'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            date = datetime.strptime(options['period'], '%Y-%m')
+        except ValueError:
+            raise CommandError('The period must be given as YYYY-MM.')
+        reference_start, reference_end = services.get_monthly_period(date)
+        # Records of an open month may still arrive
+        if reference_end >= timezone.now():
+            raise CommandError('The period has not ended yet.')
+        rows = []
+        # alias -> archived calls of each shard
+        archived = {}
+        for alias in settings.SHARDS:
+            calls = []
+            with shards.using_shard(alias):
+                for call in Call.objects.filter(
+                        end_timestamp__gte=reference_start,
+                        end_timestamp__lte=reference_end).iterator():
+                    rows.append(archive.call_row(call))
+                    calls.append(call)
+            archived[alias] = calls
+        path, count = archive.write_archive(
+            reference_start,
+            archive.merge_rows(archive.open_archive(reference_start), rows)
+        )
+        # The calls are read from the file from now on. Their records
+        # are deleted along with them, and only their keys are kept, so
+        # resent records are still recognized.
+        period = reference_start.date()
+        for alias, calls in archived.items():
+            with shards.using_shard(alias), transaction.atomic(using=alias):
+                for chunk in chunks(calls):
+                    call_ids = [call.call_id for call in chunk]
+                    # Calls stored again after they were archived are
+                    # keyed already
+                    keyed = set(ArchivedCall.objects.filter(
+                        call_id__in=call_ids
+                    ).values_list('call_id', flat=True))
+                    ArchivedCall.objects.bulk_create([
+                        ArchivedCall(
+                            call_id=call.call_id,
+                            source=call.source,
+                            period=period
+                        ) for call in chunk if call.call_id not in keyed
+                    ])
+                    CallRecord.objects.filter(call_id__in=call_ids).delete()
+                    Call.objects.filter(
+                        id__in=[call.id for call in chunk]
+                    ).delete()
+        self.stdout.write(
+            'Archived {} calls of {} to {} ({} calls in the file)'.format(
+                len(rows),
+                options['period'],
+                path,
+                count
+            )
+        )
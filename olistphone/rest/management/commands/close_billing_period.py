@@ -0,0 +1,139 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils import timezone
+import rest.services as services
+import rest.shards as shards
+
+# Shards per worker. Having more shards than workers evens out the
+# load when some number ranges make more calls than others.
+SHARDS_PER_WORKER = 4
+
+
+def close_shard(alias, reference_start, reference_end, sources):
+    '''
+    Closes the period for a range of subscribers of a database shard, in
+    a worker process
+    '''
+    with shards.using_shard(alias):
+        return services.close_period(
+            reference_start,
+            reference_end,
+            sources
+        )
+
+
+class Command(BaseCommand):
+    help = (
+        'Bills every call that ended in a month and stores the statement'
+        + ' of each subscriber, which /billing/ then serves as is.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'period',
+            help='The month to close, as YYYY-MM.'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Number of processes closing shards of subscribers.'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            date = datetime.strptime(options['period'], '%Y-%m')
+        except ValueError:
+            raise CommandError('The period must be given as YYYY-MM.')
+        reference_start, reference_end = services.get_monthly_period(date)
+        # Records of an open month may still arrive
+        if reference_end >= timezone.now():
+            raise CommandError('The period has not ended yet.')
+        workers = options['workers']
+        if workers < 1:
+            raise CommandError('There must be at least one worker.')
+        began = time.perf_counter()
+        statements = 0
+        calls = 0
+        # Each database shard holds the calls of its own subscribers
+        for alias in settings.SHARDS:
+            if workers == 1:
+                with shards.using_shard(alias):
+                    shard_statements, shard_calls = services.close_period(
+                        reference_start,
+                        reference_end
+                    )
+            else:
+                shard_statements, shard_calls = self.close_in_parallel(
+                    alias,
+                    reference_start,
+                    reference_end,
+                    workers
+                )
+            statements += shard_statements
+            calls += shard_calls
+        elapsed = time.perf_counter() - began
+        self.stdout.write(
+            'Closed {}: {} statements, {} calls in {:.1f}s'.format(
+                options['period'],
+                statements,
+                calls,
+                elapsed
+            )
+        )
+
+    def close_in_parallel(self, alias, reference_start, reference_end,
+                          workers):
+        '''
+        Closes the period in a database shard with a pool of worker
+        processes, each closing ranges of its subscribers with its own
+        database connection
+        '''
+        connection = connections[alias]
+        if (connection.vendor == 'sqlite'
+                and connection.creation.is_in_memory_db(
+                    connection.settings_dict['NAME'])):
+            raise CommandError(
+                'An in-memory database cannot be shared with workers.'
+            )
+        # The workers would not see what the transaction wrote, and
+        # closing its connection before forking would abort it
+        if connection.in_atomic_block:
+            raise CommandError(
+                'The workers cannot see the writes of an open transaction.'
+            )
+        with shards.using_shard(alias):
+            ranges = services.shard_sources(
+                reference_start,
+                reference_end,
+                workers * SHARDS_PER_WORKER
+            )
+        # The workers are forked from this process, whatever the default
+        # start method of the platform, so they inherit its settings and
+        # loaded apps. Closing its connections first makes each of them
+        # open its own.
+        connections.close_all()
+        statements = 0
+        calls = 0
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('fork')) as executor:
+            results = [
+                executor.submit(
+                    close_shard,
+                    alias,
+                    reference_start,
+                    reference_end,
+                    sources
+                ) for sources in ranges
+            ]
+            for result in results:
+                shard_statements, shard_calls = result.result()
+                statements += shard_statements
+                calls += shard_calls
+        return statements, calls
@@ -0,0 +1,51 @@
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+import rest.partitions as partitions
+
+
+class Command(BaseCommand):
+    help = (
+        'Creates the monthly partitions of the call records, calls and'
+        + ' bills up to some months ahead, on PostgreSQL. Rows of their'
+        + ' months are moved over from the default partitions.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--from',
+            dest='first_month',
+            help='The first month to create partitions for, as YYYY-MM.'
+            + ' The current month by default.'
+        )
+        parser.add_argument(
+            '--ahead',
+            type=int,
+            default=settings.PARTITION_MONTHS_AHEAD,
+            help='Months after the current one to create partitions for.'
+        )
+
+    def handle(self, *args, **options):
+        if not partitions.supports_partitions(connection):
+            raise CommandError('Only PostgreSQL tables are partitioned.')
+        first_month = None
+        if options['first_month']:
+            try:
+                first_month = datetime.strptime(
+                    options['first_month'],
+                    '%Y-%m'
+                ).date()
+            except ValueError:
+                raise CommandError('The month must be given as YYYY-MM.')
+        if options['ahead'] < 0:
+            raise CommandError('The months ahead cannot be negative.')
+        last_month = timezone.now().date().replace(day=1) + relativedelta(
+            months=options['ahead']
+        )
+        created = partitions.ensure_partitions(first_month, last_month)
+        for name in created:
+            self.stdout.write('Created {}'.format(name))
+        self.stdout.write('{} partitions created'.format(len(created)))
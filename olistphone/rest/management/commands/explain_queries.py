@@ -0,0 +1,147 @@
+import re
+from datetime import datetime, timedelta
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import RequestFactory
+from rest.models import CallRecord, Call
+from rest.views import MonthlyBillingView
+import rest.services as services
+import rest.statement_cache as statement_cache
+
+# Numbers and timestamps for the sample records. They are far from any
+# real traffic, and everything is rolled back in the end anyway.
+SAMPLE_SOURCE = '10000000000'
+SAMPLE_DESTINATION = '10000000001'
+SAMPLE_CALL_ID = 4000000000
+SAMPLE_START = datetime(1901, 1, 10, 12, 0, 0)
+
+# Plan lines that read a whole table
+FULL_SCAN_PATTERNS = {
+    # "SCAN rest_callrecord", or "SCAN TABLE rest_callrecord" on SQLite
+    # before 3.36. Index scans read "SCAN ... USING (COVERING) INDEX".
+    'sqlite': re.compile(r'^SCAN (TABLE )?\w+$'),
+    'postgresql': re.compile(r'Seq Scan'),
+    'mysql': re.compile(r'\bALL\b'),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Prints the query plan of every query on the hot paths (record'
+        + ' ingest and monthly billing), flagging full table scans.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Exit with an error if any query scans a whole table.'
+        )
+
+    def handle(self, *args, **options):
+        queries = self.capture_hot_queries()
+        full_scans = 0
+        for number, (sql, params) in enumerate(queries, start=1):
+            self.stdout.write('{}. {}'.format(number, sql))
+            for line in self.explain(sql, params):
+                if self.is_full_scan(line):
+                    full_scans += 1
+                    self.stdout.write(self.style.ERROR('   ' + line))
+                else:
+                    self.stdout.write('   ' + line)
+            self.stdout.write('')
+        summary = '{} queries, {} full table scans'.format(
+            len(queries),
+            full_scans
+        )
+        if full_scans and options['check']:
+            raise CommandError(summary)
+        self.stdout.write(summary)
+
+    def capture_hot_queries(self):
+        '''
+        Runs the hot paths on sample records inside a transaction that
+        is rolled back, returning the distinct SELECTs they issued
+        '''
+        queries = []
+
+        def capture(execute, sql, params, many, context):
+            if sql.lstrip().upper().startswith('SELECT') and not any(
+                    sql == captured for captured, _ in queries):
+                queries.append((sql, params))
+            return execute(sql, params, many, context)
+
+        with transaction.atomic():
+            with connection.execute_wrapper(capture):
+                self.run_hot_paths()
+            transaction.set_rollback(True)
+        return queries
+
+    def run_hot_paths(self):
+        '''
+        Ingests a call, a late call and bills the sample subscriber,
+        whole and paginated
+        '''
+        records = (
+            # A call, in order...
+            ('S', SAMPLE_START, SAMPLE_CALL_ID),
+            ('E', SAMPLE_START + timedelta(minutes=5), SAMPLE_CALL_ID),
+            ('S', SAMPLE_START + timedelta(hours=1), SAMPLE_CALL_ID + 1),
+            # ...and a start record arriving late
+            ('S', SAMPLE_START - timedelta(hours=1), SAMPLE_CALL_ID + 2),
+        )
+        for type, timestamp, call_id in records:
+            record = CallRecord(
+                type=type,
+                timestamp=timestamp,
+                call_id=call_id
+            )
+            if type == 'S':
+                record.source = SAMPLE_SOURCE
+                record.destination = SAMPLE_DESTINATION
+            try:
+                record.save()
+            # Real data may conflict with the samples. The queries were
+            # issued all the same.
+            except ValidationError:
+                pass
+        cursor = services.encode_cursor(Call(
+            id=0,
+            end_timestamp=SAMPLE_START
+        ))
+        # The whole statement, and a page of it after the first call
+        for query in ({}, {'limit': 1, 'after': cursor}):
+            request = RequestFactory().get('/billing/', query)
+            response = MonthlyBillingView.as_view()(
+                request,
+                phone_number=SAMPLE_SOURCE,
+                year_month=SAMPLE_START.strftime('%m-%Y')
+            )
+            # The statement of the rolled back calls is not left cached
+            if 'limit' not in query:
+                statement_cache.invalidate_statement(
+                    SAMPLE_SOURCE,
+                    SAMPLE_START,
+                    response['ETag'].strip('"')
+                )
+
+    def explain(self, sql, params):
+        '''
+        Returns the lines of the query plan of a query
+        '''
+        if connection.vendor == 'sqlite':
+            prefix = 'EXPLAIN QUERY PLAN '
+        else:
+            prefix = 'EXPLAIN '
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + sql, params)
+            rows = cursor.fetchall()
+        if connection.vendor == 'sqlite':
+            # (id, parent, unused, detail)
+            return [row[-1] for row in rows]
+        return [' '.join(str(column) for column in row) for row in rows]
+
+    def is_full_scan(self, line):
+        pattern = FULL_SCAN_PATTERNS.get(connection.vendor)
+        return pattern is not None and pattern.search(line) is not None
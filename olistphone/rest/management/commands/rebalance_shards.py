@@ -0,0 +1,84 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import rest.shards as shards
+
+
+class Command(BaseCommand):
+    help = (
+        'Moves subscribers between the database shards. Subscribers are'
+        + ' moved with the others of their bucket, while records keep'
+        + ' arriving. Without arguments, moves every bucket stored out of'
+        + ' the shard the map gives it, e.g. after adding a shard.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--subscriber',
+            help='A phone number whose bucket is moved.'
+        )
+        parser.add_argument(
+            '--bucket',
+            type=int,
+            help='The bucket to move.'
+        )
+        parser.add_argument(
+            '--to',
+            dest='target',
+            help='The alias of the shard to move the bucket to.'
+        )
+
+    def handle(self, *args, **options):
+        if not shards.is_sharded():
+            raise CommandError('There is a single shard.')
+        bucket = options['bucket']
+        if options['subscriber'] is not None:
+            bucket = shards.bucket_of(options['subscriber'])
+        target = options['target']
+        if bucket is None:
+            if target is not None:
+                raise CommandError('--to needs a subscriber or bucket.')
+            moves = self.misplaced()
+        else:
+            if not 0 <= bucket < shards.BUCKETS:
+                raise CommandError(
+                    'Buckets go from 0 to {}.'.format(shards.BUCKETS - 1)
+                )
+            if target not in settings.SHARDS:
+                raise CommandError(
+                    '--to must be one of {}.'.format(
+                        ', '.join(settings.SHARDS)
+                    )
+                )
+            source = shards.get_map().shard_of(bucket)
+            if source == target:
+                raise CommandError(
+                    'Bucket {} is in {} already.'.format(bucket, target)
+                )
+            moves = [(bucket, source, target)]
+        for bucket, source, target in moves:
+            subscribers, rows = shards.move_bucket(bucket, source, target)
+            self.stdout.write(
+                'Moved bucket {} ({} subscribers, {} rows)'
+                ' from {} to {}'.format(
+                    bucket,
+                    subscribers,
+                    rows,
+                    source,
+                    target
+                )
+            )
+        self.stdout.write('{} buckets moved'.format(len(moves)))
+
+    def misplaced(self):
+        '''
+        Lists the (bucket, source, target) moves of the buckets with
+        data out of their shard
+        '''
+        shard_map = shards.get_map()
+        moves = []
+        for source in settings.SHARDS:
+            for bucket in sorted(shards.subscribers_in(source)):
+                target = shard_map.shard_of(bucket)
+                if target != source:
+                    moves.append((bucket, source, target))
+        return moves
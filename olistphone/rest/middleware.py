@@ -0,0 +1,34 @@
+from django.conf import settings
+import rest.routers as routers
+
+# Cookie pinning a client to the primary database after it wrote
+PIN_COOKIE = 'olistphone_primary'
+
+# Methods of requests that may write, and pin the client once they did
+WRITE_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+
+
+class ReplicaPinningMiddleware(object):
+    '''
+    Lets clients read their own writes when statements are read from
+    replicas. A request that wrote sets a cookie expiring after
+    REPLICA_MAX_LAG seconds, and the requests that carry it read from
+    the primary only. Writes of safe requests, like the bills stored
+    while billing, are the application's own and pin nobody.
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        routers.reset(pinned=PIN_COOKIE in request.COOKIES)
+        response = self.get_response(request)
+        if (routers.replicas() and routers.wrote()
+                and request.method in WRITE_METHODS):
+            response.set_cookie(
+                PIN_COOKIE,
+                '1',
+                max_age=settings.REPLICA_MAX_LAG,
+                httponly=True
+            )
+        return response
@@ -0,0 +1,63 @@
+# Generated by Django 2.0.6 on 2026-10-18 05:42
+
+import django.core.validators
+from django.db import migrations, models
+
+
+def populate_last_calls(apps, schema_editor):
+    '''
+    Fills LastCall with the latest call of every source already stored
+    '''
+    CallRecord = apps.get_model('rest', 'CallRecord')
+    LastCall = apps.get_model('rest', 'LastCall')
+    last_calls = {}
+    starts = CallRecord.objects.filter(type='S').order_by('timestamp')
+    for start in starts.iterator():
+        last_calls[start.source] = start
+    call_ids = {start.call_id for start in last_calls.values()}
+    ends = {
+        call_id: timestamp for call_id, timestamp in CallRecord.objects.filter(
+            type='E'
+        ).values_list('call_id', 'timestamp').iterator()
+        if call_id in call_ids
+    }
+    LastCall.objects.bulk_create([
+        LastCall(
+            source=source,
+            call_id=start.call_id,
+            start_timestamp=start.timestamp,
+            end_timestamp=ends.get(start.call_id)
+        ) for source, start in last_calls.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest', '0011_auto_20180611_2006'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LastCall',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=11, unique=True, validators=[django.core.validators.RegexValidator(code='invalid_phone_number', message='Phone numbers must be all digits, with 2 area code digits and 8 or 9 phone number digits.', regex='^\\d{10,11}$')])),
+                ('call_id', models.PositiveIntegerField(validators=[django.core.validators.MinValueValidator(0)])),
+                ('start_timestamp', models.DateTimeField()),
+                ('end_timestamp', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='callrecord',
+            index=models.Index(fields=['source', 'timestamp'], name='callrecord_source_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='callrecord',
+            index=models.Index(fields=['destination', 'timestamp'], name='callrecord_dest_time_idx'),
+        ),
+        migrations.RunPython(
+            populate_last_calls,
+            migrations.RunPython.noop
+        ),
+    ]
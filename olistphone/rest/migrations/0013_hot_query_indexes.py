@@ -0,0 +1,33 @@
+# Generated by Django 2.0.6 on 2026-10-18 05:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest', '0012_last_call'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='callrecord',
+            name='callrecord_source_time_idx',
+        ),
+        migrations.AddIndex(
+            model_name='callrecord',
+            index=models.Index(fields=['source', 'type', 'timestamp'], name='callrecord_source_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='callrecord',
+            index=models.Index(fields=['type', 'timestamp', 'call_id'], name='callrecord_type_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='calltariff',
+            index=models.Index(fields=['valid_after'], name='calltariff_valid_after_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='phonebill',
+            index=models.Index(fields=['destination', 'start_timestamp'], name='phonebill_dest_start_idx'),
+        ),
+    ]
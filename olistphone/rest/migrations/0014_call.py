@@ -0,0 +1,126 @@
+# Generated by Django 2.0.6 on 2026-10-18 05:48
+
+from datetime import timedelta
+from decimal import Context, Decimal, localcontext
+import django.core.validators
+from django.db import migrations, models
+
+# The pricing of calls as it was when this migration was written, so
+# later changes to rest.services do not change the calls it creates.
+# Charges were worked out in the two digit decimal context of the app.
+PRICING_CONTEXT = Context(prec=2)
+
+
+def calculate_period(timestamp):
+    '''
+    Gets whether a timestamp is in the discount period, and the time
+    until the next change of period
+    '''
+    if 6 <= timestamp.hour < 22:
+        change = timestamp.replace(hour=22, minute=0, second=0)
+        return False, change - timestamp
+    if timestamp.hour < 6:
+        change = timestamp.replace(hour=6, minute=0, second=0)
+    else:
+        change = (timestamp + timedelta(days=1)).replace(
+            hour=6,
+            minute=0,
+            second=0
+        )
+    return True, change - timestamp
+
+
+def calculate_pricing(start, end, call_tariff):
+    '''
+    Calculates the charge of a call, one period at a time. Only the
+    full minutes of each period are charged.
+    '''
+    tariff = 0
+    current = start
+    with localcontext(PRICING_CONTEXT):
+        while True:
+            is_discount_period, to_break = calculate_period(current)
+            stretch_end = min(current + to_break, end)
+            minutes = (stretch_end - current).seconds // 60
+            if is_discount_period:
+                tariff += minutes * call_tariff.discount_charge
+            else:
+                tariff += minutes * call_tariff.minute_charge
+            if stretch_end == end:
+                break
+            current = stretch_end
+        return tariff + call_tariff.base_tariff
+
+
+def populate_calls(apps, schema_editor):
+    '''
+    Pairs the call records already stored into calls
+    '''
+    CallRecord = apps.get_model('rest', 'CallRecord')
+    CallTariff = apps.get_model('rest', 'CallTariff')
+    Call = apps.get_model('rest', 'Call')
+    ends = dict(CallRecord.objects.filter(
+        type='E'
+    ).values_list('call_id', 'timestamp').iterator())
+    tariffs = list(CallTariff.objects.order_by('valid_after'))
+    # The tariff set in the spec, used when there is none stored
+    spec_tariff = CallTariff(
+        base_tariff=Decimal('0.36'),
+        minute_charge=Decimal('0.09'),
+        discount_charge=Decimal('0.00')
+    )
+    calls = []
+    for start in CallRecord.objects.filter(type='S').iterator():
+        # Calls still going on have no end record yet
+        end = ends.get(start.call_id)
+        if end is None:
+            continue
+        tariff = spec_tariff
+        for candidate in tariffs:
+            if candidate.valid_after <= start.timestamp.date():
+                tariff = candidate
+        calls.append(Call(
+            call_id=start.call_id,
+            source=start.source,
+            destination=start.destination,
+            start_timestamp=start.timestamp,
+            end_timestamp=end,
+            duration=(end - start.timestamp).total_seconds(),
+            charge=calculate_pricing(start.timestamp, end, tariff)
+        ))
+    Call.objects.bulk_create(calls)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest', '0013_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Call',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('call_id', models.PositiveIntegerField(unique=True, validators=[django.core.validators.MinValueValidator(0)])),
+                ('source', models.CharField(max_length=11, validators=[django.core.validators.RegexValidator(code='invalid_phone_number', message='Phone numbers must be all digits, with 2 area code digits and 8 or 9 phone number digits.', regex='^\\d{10,11}$')])),
+                ('destination', models.CharField(max_length=11, validators=[django.core.validators.RegexValidator(code='invalid_phone_number', message='Phone numbers must be all digits, with 2 area code digits and 8 or 9 phone number digits.', regex='^\\d{10,11}$')])),
+                ('start_timestamp', models.DateTimeField()),
+                ('end_timestamp', models.DateTimeField()),
+                ('duration', models.PositiveIntegerField(validators=[django.core.validators.MinValueValidator(0)])),
+                ('charge', models.DecimalField(decimal_places=2, max_digits=15, validators=[django.core.validators.MinValueValidator(Decimal('0.00'))])),
+            ],
+        ),
+        migrations.RemoveIndex(
+            model_name='callrecord',
+            name='callrecord_type_time_idx',
+        ),
+        migrations.AddIndex(
+            model_name='call',
+            index=models.Index(fields=['source', 'end_timestamp'], name='call_source_end_idx'),
+        ),
+        migrations.RunPython(
+            populate_calls,
+            migrations.RunPython.noop
+        ),
+    ]
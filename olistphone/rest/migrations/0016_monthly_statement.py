@@ -0,0 +1,31 @@
+# Generated by Django 2.0.6 on 2026-10-18 05:58
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest', '0015_cache_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlyStatement',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subscriber', models.CharField(max_length=11, validators=[django.core.validators.RegexValidator(code='invalid_phone_number', message='Phone numbers must be all digits, with 2 area code digits and 8 or 9 phone number digits.', regex='^\\d{10,11}$')])),
+                ('period', models.DateField()),
+                ('content', models.TextField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='call',
+            index=models.Index(fields=['end_timestamp'], name='call_end_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='monthlystatement',
+            unique_together={('subscriber', 'period')},
+        ),
+    ]
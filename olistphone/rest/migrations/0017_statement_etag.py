@@ -0,0 +1,41 @@
+# Generated by Django 2.0.6 on 2026-10-18 06:12
+
+from hashlib import md5
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def fill_etags(apps, schema_editor):
+    '''
+    Computes the ETag of the statements already stored
+    '''
+    MonthlyStatement = apps.get_model('rest', 'MonthlyStatement')
+    for statement in MonthlyStatement.objects.iterator():
+        statement.etag = md5(statement.content.encode('utf-8')).hexdigest()
+        statement.save(update_fields=['etag'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest', '0016_monthly_statement'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='monthlystatement',
+            name='closed_at',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='monthlystatement',
+            name='etag',
+            field=models.CharField(default='', max_length=32),
+            preserve_default=False,
+        ),
+        migrations.RunPython(
+            fill_etags,
+            migrations.RunPython.noop
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.0.6 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest', '0017_statement_etag'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RejectedRecord',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.CharField(max_length=64, unique=True)),
+                ('record', models.TextField()),
+                ('errors', models.TextField()),
+                ('rejected_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SpoolCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('segment', models.CharField(max_length=32)),
+                ('offset', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,274 @@
+# Generated by Django 2.0.6 on 2026-10-18 11:40
+
+from django.db import migrations
+
+# On PostgreSQL, CallRecord, Call and PhoneBill are turned into tables
+# partitioned by month (see rest.partitions), with a default partition
+# holding every row until the monthly ones are created after migrating.
+# Other databases keep the plain tables.
+#
+# The primary key and unique constraints of a partitioned table must
+# include its partition key, so they are only enforced per partition.
+# The id primary key becomes (id, partition key), ids still coming from
+# the table's sequence, and (call_id, timestamp) is unaffected. The
+# unique (type, call_id) of CallRecord and the unique call_id of Call
+# are kept across partitions by key tables, which triggers fill in the
+# same statement as the rows, so a duplicate still fails the insert
+# with an IntegrityError.
+#
+# The migration state keeps those two constraints, which the plain
+# tables of other databases still have. Only this migration replaces
+# them, and only on PostgreSQL. A later migration changing either of
+# them must skip PostgreSQL, or change the key tables there instead.
+
+# Model, partition key, unique constraints as they become on the
+# partitioned table, and columns kept unique across partitions
+PARTITIONED_MODELS = (
+    ('CallRecord', 'timestamp', [('call_id', 'timestamp')],
+     ('type', 'call_id')),
+    ('Call', 'end_timestamp', [('call_id', 'end_timestamp')],
+     ('call_id', )),
+    ('PhoneBill', 'start_timestamp', [], ()),
+)
+
+# Unique constraints of the plain tables, restored when reverting
+PLAIN_UNIQUE_TOGETHER = {
+    'CallRecord': [('type', 'call_id'), ('call_id', 'timestamp')],
+    'Call': [('call_id', )],
+    'PhoneBill': [],
+}
+
+# Keeps the key table of a partitioned table in step with its rows.
+# An insert of a key that is taken fails with a unique violation.
+KEY_TRIGGER_FUNCTION = '''
+CREATE FUNCTION {function}() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM {key_table} WHERE {old_match};
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO {key_table} ({columns}) VALUES ({new_values});
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+'''
+
+# Empties the key table along with its partitioned table, as TRUNCATE,
+# which flush uses, skips the row triggers
+KEY_TRUNCATE_FUNCTION = '''
+CREATE FUNCTION {function}() RETURNS trigger AS $$
+BEGIN
+    TRUNCATE {key_table};
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+'''
+
+
+def supports_partitions(connection):
+    '''
+    Checks whether a database connection partitions the tables
+    '''
+    return connection.vendor == 'postgresql'
+
+
+def default_partition_name(table):
+    '''
+    Gets the name of the default partition of a table
+    '''
+    return table + '_default'
+
+
+def key_table_name(table):
+    '''
+    Gets the name of the table keeping keys of a partitioned table
+    unique across its partitions, also used for its trigger
+    '''
+    return table + '_key'
+
+
+def key_truncate_name(table):
+    '''
+    Gets the name of the trigger emptying the key table of a
+    partitioned table, and of its function
+    '''
+    return key_table_name(table) + '_truncate'
+
+
+def replace_table(schema_editor, model, create_statements, primary_key,
+                  unique_together):
+    '''
+    Replaces the table of a model by one with the same columns, created
+    by create_statements, moving the rows and the id sequence over and
+    recreating the constraints and indexes
+    '''
+    quote = schema_editor.quote_name
+    table = model._meta.db_table
+    old_table = table + '_old'
+    schema_editor.execute('ALTER TABLE {} RENAME TO {}'.format(
+        quote(table),
+        quote(old_table)
+    ))
+    for statement in create_statements:
+        schema_editor.execute(statement.format(
+            table=quote(table),
+            old_table=quote(old_table),
+            default=quote(default_partition_name(table))
+        ))
+    # The sequence would be dropped along with the table owning it
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT pg_get_serial_sequence(%s, 'id')",
+            [old_table]
+        )
+        sequence = cursor.fetchone()[0]
+    schema_editor.execute('ALTER SEQUENCE {} OWNED BY {}.{}'.format(
+        sequence,
+        quote(table),
+        quote('id')
+    ))
+    schema_editor.execute('INSERT INTO {} SELECT * FROM {}'.format(
+        quote(table),
+        quote(old_table)
+    ))
+    # Dropped before the constraints and indexes are recreated, as
+    # their names are taken until then
+    schema_editor.execute('DROP TABLE {}'.format(quote(old_table)))
+    schema_editor.execute('ALTER TABLE {} ADD PRIMARY KEY ({})'.format(
+        quote(table),
+        ', '.join(quote(column) for column in primary_key)
+    ))
+    for fields in unique_together:
+        schema_editor.execute(schema_editor._create_unique_sql(
+            model,
+            [model._meta.get_field(field).column for field in fields]
+        ))
+    for index in model._meta.indexes:
+        schema_editor.add_index(model, index)
+
+
+def create_key_table(schema_editor, table, columns):
+    '''
+    Creates the key table of a partitioned table, with the keys of its
+    rows, and the trigger keeping it up to date
+    '''
+    quote = schema_editor.quote_name
+    key_table = key_table_name(table)
+    column_list = ', '.join(quote(column) for column in columns)
+    schema_editor.execute(
+        'CREATE TABLE {key_table} AS SELECT {columns} FROM {table}'.format(
+            key_table=quote(key_table),
+            columns=column_list,
+            table=quote(table)
+        )
+    )
+    schema_editor.execute('ALTER TABLE {} ADD PRIMARY KEY ({})'.format(
+        quote(key_table),
+        column_list
+    ))
+    schema_editor.execute(KEY_TRIGGER_FUNCTION.format(
+        function=quote(key_table),
+        key_table=quote(key_table),
+        columns=column_list,
+        old_match=' AND '.join(
+            '{0} = OLD.{0}'.format(quote(column)) for column in columns
+        ),
+        new_values=', '.join('NEW.' + quote(column) for column in columns)
+    ))
+    # Row triggers of a partitioned table run on each of its partitions
+    schema_editor.execute(
+        'CREATE TRIGGER {trigger} AFTER INSERT OR DELETE OR UPDATE OF'
+        ' {columns} ON {table} FOR EACH ROW EXECUTE PROCEDURE'
+        ' {function}()'.format(
+            trigger=quote(key_table),
+            columns=column_list,
+            table=quote(table),
+            function=quote(key_table)
+        )
+    )
+    truncate = quote(key_truncate_name(table))
+    schema_editor.execute(KEY_TRUNCATE_FUNCTION.format(
+        function=truncate,
+        key_table=quote(key_table)
+    ))
+    schema_editor.execute(
+        'CREATE TRIGGER {trigger} AFTER TRUNCATE ON {table}'
+        ' FOR EACH STATEMENT EXECUTE PROCEDURE {function}()'.format(
+            trigger=truncate,
+            table=quote(table),
+            function=truncate
+        )
+    )
+
+
+def partition_tables(apps, schema_editor):
+    '''
+    Partitions the tables by month, on PostgreSQL
+    '''
+    if not supports_partitions(schema_editor.connection):
+        return
+    for name, key, unique_together, key_columns in PARTITIONED_MODELS:
+        model = apps.get_model('rest', name)
+        column = model._meta.get_field(key).column
+        replace_table(
+            schema_editor,
+            model,
+            [
+                'CREATE TABLE {table} (LIKE {old_table} INCLUDING DEFAULTS'
+                ' INCLUDING CONSTRAINTS) PARTITION BY RANGE ('
+                + schema_editor.quote_name(column) + ')',
+                'CREATE TABLE {default} PARTITION OF {table} DEFAULT',
+            ],
+            ('id', column),
+            unique_together
+        )
+        if key_columns:
+            create_key_table(
+                schema_editor,
+                model._meta.db_table,
+                [model._meta.get_field(field).column for field in key_columns]
+            )
+
+
+def unpartition_tables(apps, schema_editor):
+    '''
+    Turns the partitioned tables back into plain ones, on PostgreSQL
+    '''
+    if not supports_partitions(schema_editor.connection):
+        return
+    quote = schema_editor.quote_name
+    for name, _, _, key_columns in PARTITIONED_MODELS:
+        model = apps.get_model('rest', name)
+        table = model._meta.db_table
+        if key_columns:
+            key_table = quote(key_table_name(table))
+            truncate = quote(key_truncate_name(table))
+            for trigger in (key_table, truncate):
+                schema_editor.execute(
+                    'DROP TRIGGER {} ON {}'.format(trigger, quote(table))
+                )
+                schema_editor.execute('DROP FUNCTION {}()'.format(trigger))
+            schema_editor.execute('DROP TABLE {}'.format(key_table))
+        # The partitions are dropped with the partitioned table
+        replace_table(
+            schema_editor,
+            model,
+            [
+                'CREATE TABLE {table} (LIKE {old_table} INCLUDING DEFAULTS'
+                ' INCLUDING CONSTRAINTS)',
+            ],
+            ('id', ),
+            PLAIN_UNIQUE_TOGETHER[name]
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest', '0018_spool'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_tables, unpartition_tables),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.0.6 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest', '0019_partitions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CallShard',
+            fields=[
+                ('call_id', models.PositiveIntegerField(primary_key=True, serialize=False)),
+                ('bucket', models.PositiveSmallIntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ShardBucket',
+            fields=[
+                ('bucket', models.PositiveSmallIntegerField(primary_key=True, serialize=False)),
+                ('shard', models.CharField(max_length=50)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.0.6 on 2026-10-18 16:10
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest', '0020_shards'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedCall',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('call_id', models.PositiveIntegerField(unique=True, validators=[django.core.validators.MinValueValidator(0)])),
+                ('source', models.CharField(max_length=11, validators=[django.core.validators.RegexValidator(code='invalid_phone_number', message='Phone numbers must be all digits, with 2 area code digits and 8 or 9 phone number digits.', regex='^\\d{10,11}$')])),
+                ('period', models.DateField()),
+            ],
+        ),
+    ]
@@ -1,6 +1,10 @@
-from django.db import models
+from django.db import connections, models, transaction, IntegrityError
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import F, Q, OuterRef, Subquery
 from django.core.validators import RegexValidator, MinValueValidator
 from django.core.exceptions import ValidationError
+from django.utils import timezone
+import rest.shards as shards
 from decimal import *
 getcontext().prec = 2
 
@@ -23,6 +27,86 @@ phone_validator_regex = RegexValidator(
 )
 
 
+# SQLite builds older than 3.32 refuse statements with more than 999
+# parameters, so IN (...) lists are split into chunks of this size
+IN_CLAUSE_CHUNK_SIZE = 450
+# Records validated per query, which builds five IN (...) lists
+RECORDS_PER_QUERY = 150
+
+
+def chunks(values, size=IN_CLAUSE_CHUNK_SIZE):
+    '''
+    Splits a collection of values into lists of at most "size" elements
+    '''
+    values = list(values)
+    for index in range(0, len(values), size):
+        yield values[index:index+size]
+
+
+# The validations check what is stored before the records are inserted,
+# so two workers ingesting overlapping calls of the same source at once
+# could both pass them. Ingest locks the phone numbers of its start
+# records before reading anything, until it commits, so the records of
+# a number are validated one transaction after another. On PostgreSQL
+# numbers are spread over LOCK_STRIPES advisory locks, and ingest of
+# other numbers goes on in parallel. End records need no lock: they
+# only pass once their start is committed, and a new call of their
+# source is rejected until they are. The stripes are the buckets of
+# rest.shards, whose moves between shards take the same locks.
+LOCK_STRIPES = shards.BUCKETS
+# Key of the advisory locks, the stripe being the second key
+INGEST_LOCK = 73100022
+
+
+def lock_stripes(stripes, using=DEFAULT_DB_ALIAS):
+    '''
+    Locks some stripes of phone numbers until the end of the current
+    transaction
+    '''
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        stripes = sorted(stripes)
+        if not stripes:
+            return
+        # Always taken in the same order, so two batches cannot deadlock
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_advisory_xact_lock(%s, stripe) FROM ('
+                'SELECT unnest(%s) AS stripe ORDER BY stripe) AS stripes',
+                [INGEST_LOCK, stripes]
+            )
+    else:
+        lock_for_write(using)
+
+
+def lock_for_write(using=DEFAULT_DB_ALIAS):
+    '''
+    Takes the write lock of a SQLite database until the end of the
+    current transaction. Other databases lock rows as they are written.
+    '''
+    if connections[using].vendor == 'sqlite':
+        # SQLite has a single writer. Django begins transactions in the
+        # deferred mode, so one that read first fails to write if
+        # another committed meanwhile. A write that matches no row takes
+        # the write lock up front instead, like BEGIN IMMEDIATE, waiting
+        # for it up to the busy timeout.
+        LastCall.objects.using(using).filter(pk=0).update(call_id=0)
+
+
+class ShardedManager(models.Manager):
+    '''
+    Manager of the models holding data of a single subscriber, which
+    are routed to the shard of the current rest.shards.using_shard()
+    block
+    '''
+
+    def for_subscriber(self, number):
+        '''
+        Gets the rows in the shard holding the data of a subscriber
+        '''
+        return self.get_queryset().using(shards.shard_for(number))
+
+
 # CallRecord models the start and end of a phone call
 class CallRecord(models.Model):
     # Call records can be either Start or End records
@@ -42,18 +126,35 @@ class CallRecord(models.Model):
         validators=[MinValueValidator(0)]
     )
 
+    # Stored in the shard of the subscriber
+    objects = ShardedManager()
+
     # Since call_id is not unique, but a unique-pair, we need to define
     # a combination of fields for uniqueness
     class Meta:
         # This makes it so we can have one Start record
         # and one End record with the same call_id, but never more than
-        # one of each.
+        # one of each. On PostgreSQL, where the table is partitioned, a
+        # key table keeps it across the partitions (see migration 0019).
         # Additionally, we can prevent repeated records by checking
         # the call_id and timestamp
         unique_together = (
             ('type', 'call_id'),
             ('call_id', 'timestamp')
         )
+        # Look up the records of a number by time, for the validations.
+        # The type goes before the timestamp so a source's start records
+        # are a single range of the index.
+        indexes = [
+            models.Index(
+                fields=['source', 'type', 'timestamp'],
+                name='callrecord_source_time_idx'
+            ),
+            models.Index(
+                fields=['destination', 'timestamp'],
+                name='callrecord_dest_time_idx'
+            ),
+        ]
 
     # Source (caller) phone number.
     # Uses phone_validator_regex for validation
@@ -103,60 +204,70 @@ class CallRecord(models.Model):
                     'Cannot create a call with destination and no source'
                 )
 
-    def validate_source_and_timestamp(self):
+    def is_resend_of(self, other):
+        '''
+        Checks whether the record is the same as another, as sent again
+        by a client retrying
+        '''
+        return (
+            self.type == other.type
+            and self.call_id == other.call_id
+            and self.timestamp == other.timestamp
+            and self.source == other.source
+            and self.destination == other.destination
+        )
+
+    def validation_facts(self):
+        '''
+        Loads the database state the validations below check against,
+        in at most two queries
+        '''
+        return CallRecordFacts([self])
+
+    def validate_source_and_timestamp(self, facts=None):
         '''
         Validates the uniqueness between a call's source and timestamp
         i.e. a person cannot call two people at once
         '''
         if self.source is not None:
-            conflict = CallRecord.objects.filter(
-                source=self.source,
-                timestamp=self.timestamp
-            )
-            if self.id is not None:
-                conflict = conflict.exclude(pk=self.id)
-            if conflict.exists():
+            if facts is None:
+                facts = self.validation_facts()
+            if (self.source, self.timestamp) in facts.source_timestamps:
                 raise ValidationError(
                     'Cannot create a call when there is already a record for'
                     + ' this source and timestamp'
                 )
 
-    def validate_destination_and_timestamp(self):
+    def validate_destination_and_timestamp(self, facts=None):
         '''
         Validates the uniqueness between a call's destination and
         timestamp, i.e. a person cannot receive two calls at once
         '''
         if self.destination is not None:
-            conflict = CallRecord.objects.filter(
-                destination=self.destination,
-                timestamp=self.timestamp
-            )
-            if self.id is not None:
-                conflict = conflict.exclude(pk=self.id)
-            if conflict.exists():
+            if facts is None:
+                facts = self.validation_facts()
+            if ((self.destination, self.timestamp)
+                    in facts.destination_timestamps):
                 raise ValidationError(
                     'Cannot create a call when there is already a record for'
                     + ' this destination and timestamp'
                 )
 
-    
-    def validate_call_id(self):
+    def validate_call_id(self, facts=None):
         '''
         Validates the existence of a start call record if there is an
         attempt to insert an end call record with a given call_id
         '''
         if self.type == 'E':
-            start = CallRecord.objects.filter(
-                type='S',
-                call_id=self.call_id
-            )
-            if not start.exists():
+            if facts is None:
+                facts = self.validation_facts()
+            if facts.start_of(self.call_id) is None:
                 raise ValidationError(
                     'Cannot create an end call report with no previous'
                     + ' start call report (no start report with this call ID)'
                 )
 
-    def validate_overlap(self):
+    def validate_overlap(self, facts=None):
         '''
         Validates that calls cannot start before another call has ended
         and if there's an attempt to add a start call record, that it
@@ -164,44 +275,39 @@ class CallRecord(models.Model):
         after its own
         '''
         if self.type == 'S':
-            started_calls = CallRecord.objects.filter(
-                source=self.source,
-                type='S',
-                timestamp__lte=self.timestamp
-            )
-            ended_calls = CallRecord.objects.filter(
-                call_id__in=[call.call_id for call in started_calls],
-                type='E',
-            )
-            conflict = ended_calls.filter(
-                timestamp__gte=self.timestamp
-            )
-            if conflict.exists():
+            if facts is None:
+                facts = self.validation_facts()
+            # Calls of a source never overlap, so the latest call it
+            # started up to this record is the only possible conflict
+            last_call = facts.last_call_before(self.source, self.timestamp)
+            if last_call is None:
+                return
+            _, end = last_call
+            if end is not None and end >= self.timestamp:
                 raise ValidationError(
                     'Cannot create a start call report when there is an'
                     + ' end call report with a later timestamp for the'
                     + ' same source'
                 )
-            unended_calls = started_calls.exclude(
-                call_id__in=[call.call_id for call in ended_calls]
-            )
-            if unended_calls.exists():
+            if end is None:
                 raise ValidationError(
                     'Cannot create a start call report when there is an'
                     + ' unfinished call report for the same source'
                     + ' (Unpaired call_id)'
                 )
 
-    def validate_end_call_timestamp(self):
+    def validate_end_call_timestamp(self, facts=None):
         '''
         Validates that an end call record cannot have a timestamp
         before its own start call record pair
         '''
         if self.type == 'E':
-            started_call = CallRecord.objects.get(
-                call_id=self.call_id,
-                type='S'
-            )
+            if facts is None:
+                facts = self.validation_facts()
+            started_call = facts.start_of(self.call_id)
+            # A missing start record is reported by validate_call_id
+            if started_call is None:
+                return
             if self.timestamp <= started_call.timestamp:
                 raise ValidationError(
                     'The end call record timestamp cannot be a period in'
@@ -223,18 +329,444 @@ class CallRecord(models.Model):
         self.validate_numbers()
         self.validate_end_record_with_numbers()
         self.validate_source_and_destination()
-        self.validate_source_and_timestamp()
-        self.validate_destination_and_timestamp()
-        self.validate_call_id()
-        self.validate_end_call_timestamp()
-        self.validate_overlap()
+        # Everything the remaining rules need from the database is
+        # fetched at once, and the rules then run in memory
+        facts = self.validation_facts()
+        self.validate_source_and_timestamp(facts)
+        self.validate_destination_and_timestamp(facts)
+        self.validate_call_id(facts)
+        self.validate_end_call_timestamp(facts)
+        self.validate_overlap(facts)
+        return facts
 
     # We override the models.Model.save() method to ensure
     # we don't create a record in which there are invalid or
     # inconsistent fields, using the custom validation methods
     def save(self, *args, **kwargs):
-        self.validate_save()
-        super(CallRecord, self).save(*args, **kwargs)
+        # The record goes to the shard of its subscriber, if not saved
+        # within the block of one (see rest.shards)
+        alias = shards.current(self)
+        with shards.using_shard(alias), transaction.atomic(using=alias):
+            facts = self.validate_save()
+            # The call_id is taken in every shard
+            shards.register_calls([self])
+            super(CallRecord, self).save(*args, **kwargs)
+            # Keep the latest call of the source up to date, and store
+            # the call an end record completes
+            facts.add(self)
+            facts.save_last_calls()
+            facts.save_calls()
+
+
+# CallRecordFacts holds the database state the CallRecord validations
+# are checked against. It is loaded for a whole list of records with
+# a couple of set-based queries, so it serves both a single save and
+# a bulk ingest, and can be kept up to date in memory as records of
+# a batch get accepted with add().
+class CallRecordFacts(object):
+
+    def __init__(self, records=()):
+        # (type, call_id) -> stored record, with the fields below only
+        self.records_by_call = {}
+        # (call_id, timestamp) pairs already taken
+        self.call_timestamps = set()
+        # (number, timestamp) pairs already taken
+        self.source_timestamps = set()
+        self.destination_timestamps = set()
+        # source -> LastCall of the source, if it has made any call
+        self.last_calls = {}
+        # Sources whose LastCall changed and needs to be saved
+        self.changed_sources = set()
+        # source -> {call_id: [start, end or None]} of accepted records
+        self.accepted_calls = {}
+        # Calls completed by the accepted end records, to be saved
+        self.ended_calls = []
+        records = list(records)
+        if records:
+            self.load(records)
+
+    def load(self, records):
+        '''
+        Fetches the facts for a list of records, locking their numbers
+        first when in a transaction
+        '''
+        stripes = {
+            shards.bucket_of(number)
+            for record in records if record.type == 'S'
+            for number in (record.source, record.destination)
+            if number is not None
+        }
+        # With several shards, the subscribers of the end records are
+        # locked as well, so they are not moved to another shard while
+        # their calls are stored here
+        if shards.is_sharded():
+            shards.locate([
+                record for record in records
+                if getattr(record, 'bucket', None) is None
+            ])
+            stripes.update(
+                record.bucket for record in records
+                if record.type == 'E' and record.bucket is not None
+            )
+        lock_stripes(stripes, using=shards.current())
+        shards.check_buckets(records)
+        # A record being updated must not conflict with itself
+        own_ids = [record.pk for record in records if record.pk is not None]
+        stored = CallRecord.objects.exclude(pk__in=own_ids)
+        # Records sharing a call_id with the list (duplicates and the
+        # start records of end records) or taken by the same numbers at
+        # the same instants. All lookups go in one indexed query, split
+        # for large batches
+        for group in chunks(records, RECORDS_PER_QUERY):
+            existing = stored.filter(
+                Q(call_id__in={record.call_id for record in group})
+                | Q(
+                    type='S',
+                    source__in={record.source for record in group},
+                    timestamp__in={record.timestamp for record in group}
+                )
+                | Q(
+                    destination__in={
+                        record.destination for record in group
+                    },
+                    timestamp__in={record.timestamp for record in group}
+                )
+            ).values_list(
+                'type',
+                'call_id',
+                'timestamp',
+                'source',
+                'destination'
+            )
+            for record in existing:
+                self.register(CallRecord(
+                    type=record[0],
+                    call_id=record[1],
+                    timestamp=record[2],
+                    source=record[3],
+                    destination=record[4]
+                ))
+        # The records of archived calls are no longer stored, and are
+        # rebuilt from the archive files instead
+        missing = {record.call_id for record in records} - {
+            call_id for _, call_id in self.records_by_call
+        }
+        if missing:
+            # Imported here since the archive depends on the models
+            from rest.archive import archived_records
+            for record in archived_records(missing):
+                self.register(record)
+        # The latest call of every source involved: the callers of the
+        # start records, and of the calls the end records close
+        sources = {record.source for record in records if record.type == 'S'}
+        for record in records:
+            start = self.start_of(record.call_id)
+            if record.type == 'E' and start is not None:
+                sources.add(start.source)
+        for chunk in chunks(sources):
+            for last_call in LastCall.objects.filter(source__in=chunk):
+                self.last_calls[last_call.source] = last_call
+
+    def register(self, record):
+        '''
+        Registers a stored record in the lookups by call and timestamp
+        '''
+        self.records_by_call[(record.type, record.call_id)] = record
+        self.call_timestamps.add((record.call_id, record.timestamp))
+        if record.source is not None:
+            self.source_timestamps.add((record.source, record.timestamp))
+        if record.destination is not None:
+            self.destination_timestamps.add(
+                (record.destination, record.timestamp)
+            )
+
+    def add(self, record):
+        '''
+        Registers a newly accepted record, updating every fact it
+        affects, including the latest call of its source
+        '''
+        self.register(record)
+        if record.type == 'S':
+            self.accepted_calls.setdefault(record.source, {})[
+                record.call_id
+            ] = [record.timestamp, None]
+            last_call = self.last_calls.get(record.source)
+            # A start record older than the source's latest call is a
+            # late arrival, which does not change the latest call
+            if last_call is None:
+                last_call = LastCall(source=record.source)
+                self.last_calls[record.source] = last_call
+            elif last_call.start_timestamp > record.timestamp:
+                return
+            last_call.call_id = record.call_id
+            last_call.start_timestamp = record.timestamp
+            last_call.end_timestamp = None
+            self.changed_sources.add(record.source)
+        else:
+            start = self.start_of(record.call_id)
+            if start is None:
+                return
+            self.ended_calls.append(Call(
+                call_id=record.call_id,
+                source=start.source,
+                destination=start.destination,
+                start_timestamp=start.timestamp,
+                end_timestamp=record.timestamp,
+                duration=(record.timestamp - start.timestamp).total_seconds()
+            ))
+            call = self.accepted_calls.get(start.source, {}).get(
+                record.call_id
+            )
+            if call is not None:
+                call[1] = record.timestamp
+            last_call = self.last_calls.get(start.source)
+            if last_call is not None and last_call.call_id == record.call_id:
+                last_call.end_timestamp = record.timestamp
+                self.changed_sources.add(start.source)
+
+    def save_last_calls(self):
+        '''
+        Stores the latest calls changed by the accepted records
+        '''
+        changed = [self.last_calls[source] for source in self.changed_sources]
+        # A single change (e.g. CallRecord.save) is one UPDATE or
+        # INSERT, a batch of them is replaced in two statements
+        if len(changed) == 1:
+            changed[0].save()
+        elif changed:
+            # In the same order everywhere, so batches cannot deadlock
+            for chunk in chunks(sorted(self.changed_sources)):
+                LastCall.objects.filter(source__in=chunk).delete()
+            LastCall.objects.bulk_create(changed)
+        self.changed_sources = set()
+
+    def save_calls(self):
+        '''
+        Prices and stores the calls completed by the accepted end records
+        '''
+        # Imported here since the services depend on the models
+        from rest.services import charge_calls
+        calls = self.ended_calls
+        charge_calls(calls)
+        if len(calls) == 1:
+            calls[0].save()
+        elif calls:
+            Call.objects.bulk_create(calls)
+        # Statements cached for the months of these calls are not used
+        # again, as the calls change their version (see statement_cache)
+        if calls:
+            drop_statements(calls)
+        self.ended_calls = []
+
+    def start_of(self, call_id):
+        '''
+        Returns the stored start record of a call, if any
+        '''
+        return self.records_by_call.get(('S', call_id))
+
+    def last_call_before(self, source, timestamp):
+        '''
+        Returns the (start, end) timestamps of the latest call the
+        source started at or before a timestamp, or None if there is
+        no such call. Unended calls have None as their end.
+        '''
+        last_call = self.last_calls.get(source)
+        if last_call is None:
+            return None
+        if last_call.start_timestamp <= timestamp:
+            return (last_call.start_timestamp, last_call.end_timestamp)
+        # The record arrived late, after calls that started later than
+        # itself. We look the call up in the index, considering the
+        # records accepted in this batch as well.
+        calls = [
+            tuple(call) for call in self.accepted_calls.get(
+                source, {}
+            ).values() if call[0] <= timestamp
+        ]
+        end_timestamp = CallRecord.objects.filter(
+            type='E',
+            call_id=OuterRef('call_id')
+        ).values('timestamp')[:1]
+        calls.extend(CallRecord.objects.filter(
+            type='S',
+            source=source,
+            timestamp__lte=timestamp
+        ).annotate(
+            end_timestamp=Subquery(end_timestamp)
+        ).order_by('-timestamp').values_list(
+            'timestamp',
+            'end_timestamp'
+        )[:1])
+        return max(calls, key=lambda call: call[0], default=None)
+
+    def is_duplicate(self, record):
+        '''
+        Checks whether a record would break one of the unique_together
+        constraints of CallRecord
+        '''
+        return (
+            (record.type, record.call_id) in self.records_by_call
+            or (record.call_id, record.timestamp) in self.call_timestamps
+        )
+
+
+# LastCall keeps the latest call started by each source and whether
+# it has ended. Calls of a source cannot overlap, so this is the only
+# call a new start record can conflict with, and the overlap check
+# costs one indexed lookup however long the source's history is.
+class LastCall(models.Model):
+    # Source (caller) phone number, one row per source
+    source = models.CharField(
+        validators=[phone_validator_regex],
+        max_length=11,
+        unique=True
+    )
+
+    # The call_id of the latest call
+    call_id = models.PositiveIntegerField(
+        validators=[MinValueValidator(0)]
+    )
+
+    # Timestamps of the start and end records of the latest call.
+    # The end timestamp is NULL while the call is ongoing.
+    start_timestamp = models.DateTimeField()
+    end_timestamp = models.DateTimeField(null=True)
+
+    # Stored in the shard of the subscriber
+    objects = ShardedManager()
+
+
+# Call is a start and end record pair, stored when the end record is
+# accepted. Monthly statements read it instead of joining the records
+# by call_id, so they are a range scan over the subscriber's own calls.
+class Call(models.Model):
+    # The call_id shared by the start and end records. Kept unique by
+    # a key table on PostgreSQL, as for the (type, call_id) of CallRecord
+    call_id = models.PositiveIntegerField(
+        validators=[MinValueValidator(0)],
+        unique=True
+    )
+
+    # Source and destination numbers, from the start record
+    source = models.CharField(
+        validators=[phone_validator_regex],
+        max_length=11
+    )
+    destination = models.CharField(
+        validators=[phone_validator_regex],
+        max_length=11
+    )
+
+    # Timestamps of the start and end records
+    start_timestamp = models.DateTimeField()
+    end_timestamp = models.DateTimeField()
+
+    # The duration of the call in seconds
+    duration = models.PositiveIntegerField(
+        validators=[MinValueValidator(0)]
+    )
+
+    # The full value charge of the call, with the tariff in effect
+    # when it started
+    charge = models.DecimalField(
+        decimal_places=2,
+        max_digits=15,
+        validators=[MinValueValidator(Decimal('0.00'))]
+    )
+
+    # Stored in the shard of the subscriber
+    objects = ShardedManager()
+
+    class Meta:
+        # Calls are billed in the month they end in, for one subscriber
+        # or, when a month is closed, for all of them
+        indexes = [
+            models.Index(
+                fields=['source', 'end_timestamp'],
+                name='call_source_end_idx'
+            ),
+            models.Index(
+                fields=['end_timestamp'],
+                name='call_end_idx'
+            ),
+        ]
+
+
+# ArchivedCall keeps the key of each call moved to an archive file by
+# the archive_records command, which deletes its records along with it.
+# Resent records of the call are compared with the records rebuilt
+# from the file (see rest.archive.archived_records).
+class ArchivedCall(models.Model):
+    # The call_id of the start and end records
+    call_id = models.PositiveIntegerField(
+        validators=[MinValueValidator(0)],
+        unique=True
+    )
+
+    # The source phone number, which the calls of the file are sorted by
+    source = models.CharField(
+        validators=[phone_validator_regex],
+        max_length=11
+    )
+
+    # The first day of the month of the file
+    period = models.DateField()
+
+    # Stored in the shard of the subscriber
+    objects = ShardedManager()
+
+
+# MonthlyStatement is the statement of a subscriber for a closed month,
+# stored as rendered by the /billing/ route when the month is closed.
+class MonthlyStatement(models.Model):
+    # The subscriber (source) phone number
+    subscriber = models.CharField(
+        validators=[phone_validator_regex],
+        max_length=11
+    )
+
+    # The first day of the month
+    period = models.DateField()
+
+    # The JSON response of the statement
+    content = models.TextField()
+
+    # Version token of the content, sent as its ETag
+    etag = models.CharField(max_length=32)
+
+    # When the period was closed, sent as the Last-Modified date
+    closed_at = models.DateTimeField(auto_now_add=True)
+
+    # Stored in the shard of the subscriber
+    objects = ShardedManager()
+
+    class Meta:
+        # One statement per subscriber and month
+        unique_together = (
+            ('subscriber', 'period'),
+        )
+
+
+def drop_statements(calls):
+    '''
+    Drops the statements stored for the closed months some calls ended
+    in, which miss these late calls. Their subscribers get statements
+    computed on request until the month is closed again.
+    '''
+    # Only past months are closed, so the calls that just ended in the
+    # current one skip the query
+    current_period = timezone.now().date().replace(day=1)
+    subscribers_by_period = {}
+    for call in calls:
+        period = call.end_timestamp.date().replace(day=1)
+        if period < current_period:
+            subscribers_by_period.setdefault(period, set()).add(call.source)
+    for period, subscribers in subscribers_by_period.items():
+        for chunk in chunks(subscribers):
+            MonthlyStatement.objects.filter(
+                period=period,
+                subscriber__in=chunk
+            ).delete()
 
 
 # PhoneBill represents a single billing of a pair of call records
@@ -264,6 +796,18 @@ class PhoneBill(models.Model):
         validators=[MinValueValidator(Decimal('0.00'))]
     )
 
+    # Stored in the shard of the subscriber
+    objects = ShardedManager()
+
+    class Meta:
+        # Bills are looked up by the destination and start of a call
+        indexes = [
+            models.Index(
+                fields=['destination', 'start_timestamp'],
+                name='phonebill_dest_start_idx'
+            ),
+        ]
+
     # We override the models.Model.save() method to ensure
     # we don't create a record in which there are invalid or
     # inconsistent fields
@@ -301,6 +845,16 @@ class CallTariff(models.Model):
     # the next tariff's valid_after field
     valid_after = models.DateField()
 
+    class Meta:
+        # The tariff in effect at a given date is the latest one
+        # valid after it
+        indexes = [
+            models.Index(
+                fields=['valid_after'],
+                name='calltariff_valid_after_idx'
+            ),
+        ]
+
     def validate_discount(self):
         '''
         Validates that a discount tariff can't be greater than the
@@ -319,3 +873,106 @@ class CallTariff(models.Model):
         self.clean_fields()
         self.validate_discount()
         super(CallTariff, self).save(*args, **kwargs)
+
+
+# CacheVersion counts the changes of data cached in the memory of each
+# process, e.g. the tariffs. Whoever changes the data bumps its version
+# in the same transaction, and the other processes compare it with the
+# version they cached to know when to reload.
+class CacheVersion(models.Model):
+    # Name of the cached data
+    key = models.CharField(
+        max_length=50,
+        unique=True
+    )
+
+    # Number of changes to the data so far
+    version = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def get(cls, key, using=None):
+        '''
+        Gets the current version of some cached data
+        '''
+        try:
+            return cls.objects.db_manager(using).values_list(
+                'version',
+                flat=True
+            ).get(key=key)
+        # Data that never changed has no row yet
+        except cls.DoesNotExist:
+            return 0
+
+    @classmethod
+    def bump(cls, key, using=None):
+        '''
+        Registers a change to some cached data
+        '''
+        versions = cls.objects.db_manager(using)
+        if not versions.filter(key=key).update(version=F('version')+1):
+            try:
+                with transaction.atomic(using=using):
+                    versions.create(key=key, version=1)
+            # Someone else created it in the meantime
+            except IntegrityError:
+                versions.filter(key=key).update(version=F('version')+1)
+
+
+# SpoolCheckpoint records how far the ingest spool was applied. It is
+# updated in the transaction that stores the records read up to there,
+# so after a crash the spool is applied again from the last commit.
+class SpoolCheckpoint(models.Model):
+    # Segment file of the spool being applied
+    segment = models.CharField(max_length=32)
+
+    # Offset of the next record to apply in that segment
+    offset = models.BigIntegerField(default=0)
+
+    @classmethod
+    def load(cls):
+        '''
+        Gets the checkpoint of the spool, starting at its beginning if
+        nothing was applied yet
+        '''
+        checkpoint, _ = cls.objects.get_or_create(pk=1)
+        return checkpoint
+
+
+# RejectedRecord keeps the spooled records that failed validation when
+# they were applied, since their senders were already answered
+class RejectedRecord(models.Model):
+    # Position of the record in the spool, as "segment:offset"
+    position = models.CharField(
+        max_length=64,
+        unique=True
+    )
+
+    # The record as it was received
+    record = models.TextField()
+
+    # The validation errors, as a JSON list of messages
+    errors = models.TextField()
+
+    # When the record was rejected
+    rejected_at = models.DateTimeField(auto_now_add=True)
+
+
+# CallShard is the directory of the calls when the data is sharded: the
+# bucket of the subscriber who started each call. End records carry no
+# number, so their shard is looked up here (see rest.shards).
+class CallShard(models.Model):
+    # The call_id of the start record
+    call_id = models.PositiveIntegerField(primary_key=True)
+
+    # The bucket of its source
+    bucket = models.PositiveSmallIntegerField()
+
+
+# ShardBucket records the buckets of subscribers that were moved out of
+# the shard their number picks, by the rebalance_shards command
+class ShardBucket(models.Model):
+    # The bucket of subscribers (see rest.shards.bucket_of)
+    bucket = models.PositiveSmallIntegerField(primary_key=True)
+
+    # The alias of the database holding the bucket
+    shard = models.CharField(max_length=50)
@@ -0,0 +1,35 @@
+from django.conf import settings
+from rest_framework.parsers import BaseParser
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils import json
+
+
+class NDJSONParser(BaseParser):
+    '''
+    Parses newline-delimited JSON (one JSON document per line) into a
+    list, so bulk payloads exported line by line by the switch can be
+    posted without wrapping them in an array first.
+    '''
+    media_type = 'application/x-ndjson'
+    renderer_class = JSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        items = []
+        for line_number, line in enumerate(stream, start=1):
+            line = line.decode(encoding).strip()
+            # Blank lines (e.g. a trailing newline) carry no record
+            if not line:
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError as exc:
+                raise ParseError(
+                    'NDJSON parse error on line {} - {}'.format(
+                        line_number,
+                        exc
+                    )
+                )
+        return items
@@ -0,0 +1,172 @@
+from datetime import date
+from dateutil.relativedelta import relativedelta
+from django.conf import settings
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.utils import timezone
+
+# On PostgreSQL, the tables that grow with the traffic are partitioned
+# by month on the timestamp they are queried by, so a month of billing
+# reads a single partition and old months can be detached or dropped
+# as a whole. Rows of a month without its own partition go to a
+# default one. Monthly partitions are created ahead of time, after
+# every migrate and by the create_partitions command, moving the rows
+# of their month out of the default partition.
+
+# Partitioned tables, their partition keys and the columns their key
+# tables keep unique across partitions (see migration 0019)
+PARTITIONED_TABLES = (
+    ('rest_callrecord', 'timestamp', ('type', 'call_id')),
+    ('rest_call', 'end_timestamp', ('call_id', )),
+    ('rest_phonebill', 'start_timestamp', ()),
+)
+
+# Key of the advisory lock held while partitions are created
+PARTITION_LOCK = 73100021
+
+
+def supports_partitions(connection):
+    '''
+    Checks whether a database connection partitions the tables
+    '''
+    return connection.vendor == 'postgresql'
+
+
+def partition_name(table, month):
+    '''
+    Gets the name of the partition of a table for a month
+    '''
+    return '{}_{:%Y_%m}'.format(table, month)
+
+
+def default_partition_name(table):
+    '''
+    Gets the name of the default partition of a table
+    '''
+    return table + '_default'
+
+
+def key_table_name(table):
+    '''
+    Gets the name of the table keeping keys of a partitioned table
+    unique across its partitions
+    '''
+    return table + '_key'
+
+
+def is_partitioned(cursor, table):
+    '''
+    Checks whether a table was partitioned by the migrations
+    '''
+    cursor.execute(
+        'SELECT 1 FROM pg_partitioned_table'
+        + ' JOIN pg_class ON pg_class.oid = pg_partitioned_table.partrelid'
+        + ' WHERE pg_class.relname = %s',
+        [table]
+    )
+    return cursor.fetchone() is not None
+
+
+def list_partitions(cursor, table):
+    '''
+    Gets the names of the partitions of a table
+    '''
+    cursor.execute(
+        'SELECT child.relname FROM pg_inherits'
+        + ' JOIN pg_class parent ON parent.oid = pg_inherits.inhparent'
+        + ' JOIN pg_class child ON child.oid = pg_inherits.inhrelid'
+        + ' WHERE parent.relname = %s',
+        [table]
+    )
+    return {row[0] for row in cursor.fetchall()}
+
+
+def create_partition(cursor, table, column, key_columns, month):
+    '''
+    Creates the partition of a table for a month, moving the rows of
+    that month out of the default partition first
+    '''
+    quote = cursor.db.ops.quote_name
+    name = partition_name(table, month)
+    cursor.execute(
+        'CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'
+        .format(quote(name), quote(table))
+    )
+    cursor.execute(
+        'WITH moved AS (DELETE FROM {default} WHERE {column} >= %s'
+        ' AND {column} < %s RETURNING *)'
+        ' INSERT INTO {partition} SELECT * FROM moved'.format(
+            default=quote(default_partition_name(table)),
+            column=quote(column),
+            partition=quote(name)
+        ),
+        [month, month + relativedelta(months=1)]
+    )
+    # The key trigger of the default partition dropped the keys of the
+    # rows moved out of it, and the new table has no trigger until it
+    # is attached, so they are put back. Other transactions wait for
+    # this one on the keys deleted, and then find them taken again.
+    if key_columns:
+        columns = ', '.join(quote(key) for key in key_columns)
+        cursor.execute(
+            'INSERT INTO {} ({}) SELECT {} FROM {}'.format(
+                quote(key_table_name(table)),
+                columns,
+                columns,
+                quote(name)
+            )
+        )
+    # Bounds must be literals. Attaching builds the indexes of the
+    # table on the partition, and checks the default partition has no
+    # row of the month left
+    cursor.execute(
+        "ALTER TABLE {} ATTACH PARTITION {}"
+        " FOR VALUES FROM ('{:%Y-%m-%d}') TO ('{:%Y-%m-%d}')".format(
+            quote(table),
+            quote(name),
+            month,
+            month + relativedelta(months=1)
+        )
+    )
+
+
+def ensure_partitions(first_month=None, last_month=None,
+                      using=DEFAULT_DB_ALIAS):
+    '''
+    Creates the monthly partitions missing from first_month (the
+    current month by default) to last_month (PARTITION_MONTHS_AHEAD
+    months after the current one by default). Returns the names of the
+    partitions created.
+    '''
+    connection = connections[using]
+    if not supports_partitions(connection):
+        return []
+    current = timezone.now().date().replace(day=1)
+    if first_month is None:
+        first_month = current
+    if last_month is None:
+        last_month = current + relativedelta(
+            months=settings.PARTITION_MONTHS_AHEAD
+        )
+    created = []
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        # Runs that overlap would create the same partitions
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', [PARTITION_LOCK])
+        for table, column, key_columns in PARTITIONED_TABLES:
+            # Before the migration partitioning it
+            if not is_partitioned(cursor, table):
+                continue
+            existing = list_partitions(cursor, table)
+            month = date(first_month.year, first_month.month, 1)
+            while month <= last_month:
+                name = partition_name(table, month)
+                if name not in existing:
+                    create_partition(
+                        cursor,
+                        table,
+                        column,
+                        key_columns,
+                        month
+                    )
+                    created.append(name)
+                month += relativedelta(months=1)
+    return created
@@ -0,0 +1,104 @@
+from contextlib import ContextDecorator
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+import random
+import threading
+
+# Billing statements may be read from replicas of the database, the
+# aliases listed in DATABASE_REPLICAS. Everything else, and every write,
+# goes to the primary (the default database). Replicas are only read
+# inside read_from_replicas() blocks, so ingest never validates records
+# against a copy lagging behind the primary. Once a write is routed,
+# the rest of the thread's reads go to the primary, so a request reads
+# its own writes, and ReplicaPinningMiddleware keeps the client on the
+# primary for REPLICA_MAX_LAG seconds after a request that wrote.
+
+# Models read to decide what to write, which must see the primary. The
+# billing view creates the PhoneBill rows it does not find.
+PRIMARY_MODELS = {'phonebill'}
+
+# Routing state of the current thread, i.e. of the request it serves
+_state = threading.local()
+
+
+class read_from_replicas(ContextDecorator):
+    '''
+    Sends the reads of a block, or of a decorated function, to the
+    replicas, unless the thread is pinned to the primary
+    '''
+
+    def __enter__(self):
+        _state.replica_reads = getattr(_state, 'replica_reads', 0) + 1
+        return self
+
+    def __exit__(self, *exc_info):
+        _state.replica_reads -= 1
+        return False
+
+
+def reset(pinned=False):
+    '''
+    Starts routing a new request, pinned to the primary or not
+    '''
+    _state.pinned = pinned
+    _state.wrote = False
+
+
+def pinned():
+    '''
+    Checks whether the thread is kept off the replicas, if there are any
+    '''
+    return bool(replicas()) and getattr(
+        _state,
+        'pinned',
+        False
+    )
+
+
+def wrote():
+    '''
+    Checks whether a write was routed since the last reset
+    '''
+    return getattr(_state, 'wrote', False)
+
+
+def is_primary(alias):
+    '''
+    Checks whether a database alias points at the primary database
+    '''
+    replica = connections[alias].settings_dict
+    primary = connections[DEFAULT_DB_ALIAS].settings_dict
+    return all(
+        replica[key] == primary[key] for key in ('NAME', 'HOST', 'PORT')
+    )
+
+
+def replicas():
+    '''
+    Gets the aliases of the replicas, leaving out those pointing at the
+    primary database itself, as test mirrors do
+    '''
+    return [
+        alias for alias in settings.DATABASE_REPLICAS
+        if not is_primary(alias)
+    ]
+
+
+class ReplicaRouter(object):
+
+    def db_for_read(self, model, **hints):
+        if (not getattr(_state, 'replica_reads', 0)
+                or pinned()
+                or model._meta.model_name in PRIMARY_MODELS):
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas() or [DEFAULT_DB_ALIAS])
+
+    def db_for_write(self, model, **hints):
+        # The reads that follow must see this write
+        _state.pinned = True
+        _state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same rows as the primary
+        return True
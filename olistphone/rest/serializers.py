@@ -1,7 +1,14 @@
 from rest.models import CallRecord, PhoneBill, CallTariff
-from rest_framework import serializers
+from rest_framework import serializers, ISO_8601
+from rest_framework.settings import api_settings
 from collections import OrderedDict
 from rest_framework.fields import SkipField
+from django.conf import settings
+from django.utils.functional import cached_property
+from operator import attrgetter
+from functools import lru_cache
+from datetime import datetime
+import decimal
 
 
 # Class responsible for serializing CallRecord objects
@@ -16,6 +23,10 @@ class CallRecordSerializer(serializers.ModelSerializer):
             'source',
             'destination'
         )
+        # Records sent again are told apart from conflicting ones by
+        # the view, with a single lookup, so the unique_together
+        # validators and their queries are left out
+        validators = []
 
     # We want to omit NULL/None fields from the representation,
     # so we need to override the Serializer methods.
@@ -25,10 +36,8 @@ class CallRecordSerializer(serializers.ModelSerializer):
         Object instance -> Dict of primitive datatypes.
         """
         ret = OrderedDict()
-        fields = [field for field in self.fields.values()
-                  if not field.write_only]
 
-        for field in fields:
+        for field in self.readable_fields:
             try:
                 attribute = field.get_attribute(instance)
             except SkipField:
@@ -47,6 +56,13 @@ class CallRecordSerializer(serializers.ModelSerializer):
 
         return ret
 
+    # The fields are the same for every instance, so they are only
+    # filtered once per serializer
+    @cached_property
+    def readable_fields(self):
+        return [field for field in self.fields.values()
+                if not field.write_only]
+
 
 class PhoneBillSerializer(serializers.ModelSerializer):
     class Meta:
@@ -59,6 +75,13 @@ class PhoneBillSerializer(serializers.ModelSerializer):
         )
 
 
+# The totals of a statement, as aggregated from its calls
+class StatementTotalsSerializer(serializers.Serializer):
+    calls = serializers.IntegerField()
+    duration = serializers.IntegerField()
+    charge = serializers.DecimalField(max_digits=15, decimal_places=2)
+
+
 class CallTariffSerializer(serializers.ModelSerializer):
     class Meta:
         model = CallTariff
@@ -68,3 +91,110 @@ class CallTariffSerializer(serializers.ModelSerializer):
             'discount_charge',
             'valid_after'
         )
+
+
+# Serializers look every field of every instance up and check it for
+# None, one call at a time, which is most of the cost of rendering a
+# statement with many calls. Bills come from the database complete, so
+# they skip all of that.
+
+# Gets the values of a bill, in the order of PhoneBillSerializer
+get_bill_values = attrgetter(*PhoneBillSerializer.Meta.fields)
+
+
+def represent_bills(bills):
+    '''
+    Gives bills the representation PhoneBillSerializer does, as a list
+    of dicts. Nothing is validated, so this is only for output.
+    '''
+    return represent_bill_values(map(get_bill_values, bills))
+
+
+def represent_bill_values(rows):
+    '''
+    Gives tuples of bill values, in the order of PhoneBillSerializer,
+    the representation it does, as a list of dicts
+    '''
+    convert_timestamp, convert_charge = get_bill_converters()
+    # Calls are charged a few distinct amounts, so each is converted
+    # once
+    charges = Representations(convert_charge)
+    return [
+        {
+            'destination': str(destination),
+            'start_timestamp': convert_timestamp(start_timestamp),
+            'call_duration': int(call_duration),
+            'charge': charges[charge]
+        } for destination, start_timestamp, call_duration, charge in rows
+    ]
+
+
+class Representations(dict):
+    '''
+    The representations of values, converted on their first lookup.
+    Equal values share a representation, which holds for the amounts
+    of bills (a negative zero would be written as a zero).
+    '''
+
+    def __init__(self, convert):
+        self.convert = convert
+
+    def __missing__(self, value):
+        representation = self[value] = self.convert(value)
+        return representation
+
+
+@lru_cache(maxsize=None)
+def get_bill_converters():
+    '''
+    Gets the converters of the start timestamp and charge of bills,
+    prepared once from the serializer fields
+    '''
+    fields = PhoneBillSerializer().fields
+    return (
+        get_converter(fields['start_timestamp']),
+        get_converter(fields['charge'])
+    )
+
+
+def get_converter(field):
+    '''
+    Gets a function giving values the representation a serializer field
+    does. Decimals and datetimes with the default settings get a faster
+    one, other values use the field itself.
+    '''
+    to_representation = field.to_representation
+    # Quantized to at most 6 places, str writes decimals the way
+    # the field does, without an exponent
+    if (type(field) is serializers.DecimalField
+            and field.decimal_places is not None
+            and field.decimal_places <= 6
+            and getattr(field, 'coerce_to_string',
+                        api_settings.COERCE_DECIMAL_TO_STRING)
+            and not field.localize):
+        context = decimal.getcontext().copy()
+        if field.max_digits is not None:
+            context.prec = field.max_digits
+        if field.rounding is not None:
+            context.rounding = field.rounding
+        exponent = decimal.Decimal('.1') ** field.decimal_places
+
+        def convert_decimal(value):
+            if type(value) is not decimal.Decimal:
+                return to_representation(value)
+            return str(value.quantize(exponent, context=context))
+        return convert_decimal
+    output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+    # With no time zones, naive datetimes are written as they are
+    if (type(field) is serializers.DateTimeField
+            and not settings.USE_TZ
+            and getattr(field, 'timezone', None) is None
+            and isinstance(output_format, str)
+            and output_format.lower() == ISO_8601):
+
+        def convert_datetime(value):
+            if type(value) is not datetime or value.tzinfo is not None:
+                return to_representation(value)
+            return value.isoformat()
+        return convert_datetime
+    return to_representation
@@ -1,11 +1,24 @@
-from itertools import groupby
+from itertools import groupby, islice
+from hashlib import md5
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from dateutil.relativedelta import relativedelta
-from math import floor
-from rest.models import PhoneBill, CallTariff
+from rest.models import Call, PhoneBill, CallTariff, MonthlyStatement, chunks
+from rest.models import lock_for_write
+from rest.serializers import represent_bills
+from rest_framework.renderers import JSONRenderer
+from django.db import router, transaction
+from django.db.models import Count, Max, Sum
+from django.db.models.functions import Substr
+from rest.tariffs import get_timeline
 from django.utils import dateparse, timezone
 from datetime import datetime
 from decimal import *
 getcontext().prec = 2
+# NumPy is only needed to price calls in batches, with price_calls
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Main service functionalities to be called by the views
 
@@ -14,202 +27,659 @@ def calculate_bills(records):
     Gets the call records and transforms them into bills.
     This returns a list of PhoneBill objects.
     '''
+    return bill_calls(pair_records(records))
+
+
+def pair_records(records):
+    '''
+    Joins start and end records, ordered by call_id, into (unsaved)
+    Call objects
+    '''
     # Group our records by call_id. This makes it so the start and end
     # records are joined inside one key
-    calls = groupby(records, lambda call: call.call_id)
-    bills = []
+    grouped_records = groupby(records, lambda call: call.call_id)
+    calls = []
     # Iterating over the grouped call records
-    for _, call_records in calls:
-        # Initialize variables to avoid scope conflicts
-        start = ""
-        end = ""
-        destination = ""
+    for call_id, call_records in grouped_records:
+        call = Call(call_id=call_id)
         # Since the records are grouped by call_id, we have both the
         # start and end records inside the set
         # We check the type and extract the necessary data from each
         # of them
         for call_record in call_records:
             if call_record.type == "S":
-                start = call_record.timestamp
-                destination = call_record.destination
+                call.start_timestamp = call_record.timestamp
+                call.source = call_record.source
+                call.destination = call_record.destination
             else:
-                end = call_record.timestamp
-        # If that record already exists, get it from the database
-        # This is cacheable, and it might be a good idea to do so
-        try:
-            bill = PhoneBill.objects.get(
-                destination=destination,
-                start_timestamp=start
-            )
-        # If it doesn't, it needs to be calculated and created
-        except PhoneBill.DoesNotExist:
-            # Get the latest tariffs for that time period
-            try:
-                tariff = CallTariff.objects.filter(
-                    valid_after__lte=start
-                ).order_by('-valid_after')[0]
-            # If for some reason they aren't there, initialize the
-            # database with a tariff set (in this case, the one in
-            # the spec)
-            except IndexError:
-                tariff = CallTariff(
-                    valid_after=timezone.now().replace(year=1900),
-                    base_tariff=Decimal('0.36'),
-                    minute_charge=Decimal('0.09'),
-                    discount_charge=Decimal('0.00')
-                )
-                tariff.save()
-            # Calculate the charge for this particular call
-            charge = calculate_pricing(start, end, tariff)
-            # Calculate the duration of this call
-            duration = calculate_time_delta(start, end)
-            # Create the PhoneBill object
+                call.end_timestamp = call_record.timestamp
+        call.duration = calculate_time_delta(
+            call.start_timestamp,
+            call.end_timestamp
+        ).total_seconds()
+        calls.append(call)
+    return calls
+
+
+def bill_calls(calls):
+    '''
+    Gets the bills of a list of calls, creating the missing ones.
+    This returns a list of PhoneBill objects.
+    '''
+    calls = list(calls)
+    # Fetch the bills that already exist, keyed the way they are
+    # looked up, in one query per chunk of calls
+    stored_bills = {}
+    for chunk in chunks(calls):
+        bills = PhoneBill.objects.filter(
+            destination__in={call.destination for call in chunk},
+            start_timestamp__in={call.start_timestamp for call in chunk}
+        )
+        for bill in bills:
+            stored_bills[(bill.destination, bill.start_timestamp)] = bill
+    # Stored calls were already priced when their end record was
+    # accepted, the others need the tariffs
+    charge_calls([call for call in calls if call.charge is None])
+    bills = []
+    missing_bills = []
+    for call in calls:
+        bill = stored_bills.get((call.destination, call.start_timestamp))
+        # If it doesn't exist, it needs to be created
+        if bill is None:
             bill = PhoneBill(
-                destination=destination,
-                start_timestamp=start,
-                call_duration=duration.total_seconds(),
-                charge=charge
+                destination=call.destination,
+                start_timestamp=call.start_timestamp,
+                call_duration=call.duration,
+                charge=call.charge
             )
-            bill.save()
+            # A call may be billed twice in a statement only if it
+            # was recorded twice, which the records validation forbids
+            stored_bills[(call.destination, call.start_timestamp)] = bill
+            missing_bills.append(bill)
         # Add the bill to the list
         bills.append(bill)
+    # The bills come from validated records, so they are written at
+    # once without going through PhoneBill.save
+    PhoneBill.objects.bulk_create(missing_bills)
     return bills
 
-# Functions to calculate the pricing of a given call
-# They are separated in case of a pricing calculation change,
-# e.g. making the discount tariff a percentage of the full tariff
 
-def calculate_basic_tariff(start, end, call_tariff):
+def charge_calls(calls):
     '''
-    Function to calculate the usual tariff between two time periods
+    Calculates the charge of each call of a list with the tariff in
+    effect when it started
     '''
-    # Get the time delta between the start and end of the call
-    delta = end - start
-    # We only count full minutes
-    call_minutes = floor(delta.seconds/60)
-    tariff = call_minutes * call_tariff.minute_charge
-    return tariff
+    if not calls:
+        return
+    # The tariffs are cached in memory, so this is at most one query
+    # to check they did not change
+    timeline = get_timeline()
+    for call in calls:
+        tariff = timeline.tariff_at(call.start_timestamp)
+        # If for some reason they aren't there, initialize the
+        # database with a tariff set (in this case, the one in
+        # the spec)
+        if tariff is None:
+            tariff = CallTariff(
+                valid_after=timezone.now().replace(year=1900),
+                base_tariff=Decimal('0.36'),
+                minute_charge=Decimal('0.09'),
+                discount_charge=Decimal('0.00')
+            )
+            tariff.save()
+            timeline = get_timeline()
+        call.charge = calculate_pricing(
+            call.start_timestamp,
+            call.end_timestamp,
+            tariff
+        )
 
 
-def calculate_discount_tariff(start, end, call_tariff):
+def build_statement(subscriber, reference_start, bills):
     '''
-    Function to calculate a discounted tariff between two time periods
+    Builds the statement of a subscriber for the period starting at
+    reference_start, as returned by the /billing/ route
     '''
-    # Get the time delta between the start and end of the call
-    delta = end - start
-    # We only count full minutes
-    call_minutes = floor(delta.seconds/60)
-    tariff = call_minutes * call_tariff.discount_charge
-    return tariff
+    reference_period = "{}/{}".format(
+        reference_start.month,
+        reference_start.year
+    )
+    # Create the response dict with the subscriber and reference
+    # period fields. The bills are read from the database, so they are
+    # represented without going through PhoneBillSerializer.
+    return {
+        "subscriber": subscriber,
+        "reference_period": reference_period,
+        "billed_calls": represent_bills(bills)
+    }
+
+
+# Bills per page of a paginated statement, by default and at most
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def summarize_calls(calls):
+    '''
+    Gets the number of calls in a queryset, their total duration and
+    charge, and the id of the latest one, aggregated by the database.
+    Calls of archived months come as a list, summed here instead.
+    '''
+    if isinstance(calls, list):
+        # Summed exactly, as the database does
+        with localcontext() as context:
+            context.prec = 28
+            charge = sum(
+                (call.charge for call in calls),
+                Decimal('0.00')
+            )
+        return {
+            'calls': len(calls),
+            'duration': sum(call.duration for call in calls),
+            'charge': charge,
+            'last_call': max((call.id for call in calls), default=None)
+        }
+    totals = calls.aggregate(
+        calls=Count('id'),
+        duration=Sum('duration'),
+        charge=Sum('charge'),
+        last_call=Max('id')
+    )
+    # Sums of nothing are NULL
+    if totals['duration'] is None:
+        totals['duration'] = 0
+        totals['charge'] = Decimal('0.00')
+    return totals
+
+
+def encode_cursor(call):
+    '''
+    Gets the cursor of the page starting after a call
+    '''
+    position = '{},{}'.format(call.end_timestamp.isoformat(), call.id)
+    return urlsafe_b64encode(position.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    '''
+    Gets the (end_timestamp, id) position encoded in a cursor. Raises
+    ValueError if the cursor is not one.
+    '''
+    # Padding was stripped from the cursor
+    padding = '=' * (-len(cursor) % 4)
+    end_timestamp, call_id = urlsafe_b64decode(
+        cursor + padding
+    ).decode().split(',')
+    end_timestamp = dateparse.parse_datetime(end_timestamp)
+    if end_timestamp is None:
+        raise ValueError('Invalid cursor.')
+    return end_timestamp, int(call_id)
+
+
+def page_calls(calls, limit, after=None):
+    '''
+    Gets a page of at most "limit" calls of a subscriber's queryset,
+    starting after a decoded cursor, and the cursor of the next page
+    (None on the last one).
+    The calls of a subscriber never overlap, so they are in the same
+    order by start and by end. Pages are read by end, from the
+    (source, end_timestamp) index, with the id breaking ties between
+    calls with no duration. Calls of archived months come as a list
+    ordered the same way.
+    '''
+    if isinstance(calls, list):
+        if after is not None:
+            calls = [
+                call for call in calls
+                if (call.end_timestamp, call.id) > after
+            ]
+        return page_of(calls, limit)
+    if after is not None:
+        end_timestamp, call_id = after
+        calls = calls.filter(end_timestamp__gte=end_timestamp).exclude(
+            end_timestamp=end_timestamp,
+            id__lte=call_id
+        )
+    # One more call than needed tells whether there is a next page
+    return page_of(
+        list(calls.order_by('end_timestamp', 'id')[:limit+1]),
+        limit
+    )
+
+
+def page_of(calls, limit):
+    '''
+    Cuts a page of at most "limit" calls from a list of the calls after
+    a cursor, returning it with the cursor of the next page
+    '''
+    if len(calls) > limit:
+        return calls[:limit], encode_cursor(calls[limit-1])
+    return calls, None
+
+
+# Calls billed at once when streaming a statement. Each chunk costs a
+# query for its bills, plus an insert for the missing ones.
+STREAM_CHUNK_SIZE = 450
+
+
+def stream_statement(subscriber, reference_start, calls):
+    '''
+    Renders the statement of a subscriber for the period starting at
+    reference_start as JSON, piece by piece: the envelope first, then
+    the bills of each chunk of calls as they are billed. The output is
+    the same as rendering build_statement, but only a chunk of calls is
+    in memory at a time.
+    '''
+    renderer = JSONRenderer()
+    # The envelope is rendered with no calls, and the calls are then
+    # written between its brackets
+    envelope = renderer.render(build_statement(
+        subscriber,
+        reference_start,
+        []
+    ))
+    opening, closing = envelope[:-2], envelope[-2:]
+    yield opening
+    calls = iter(calls)
+    separator = b''
+    while True:
+        chunk = list(islice(calls, STREAM_CHUNK_SIZE))
+        if not chunk:
+            break
+        # The chunk is rendered as a list, without its brackets
+        bills = renderer.render(represent_bills(bill_calls(chunk)))
+        yield separator + bills[1:-1]
+        separator = b','
+    yield closing
+
+
+# Calls billed at once when closing a period, across subscribers
+CLOSE_BATCH_SIZE = 2000
+# Subscribers are split into shards by the first digits of their number
+SHARD_PREFIX_LENGTH = 4
+
+
+def close_period(reference_start, reference_end, sources=(None, None)):
+    '''
+    Bills every call that ended in a period, and stores the statement
+    of every subscriber that made them. sources limits it to a range
+    of subscribers, from the first one to the end one (exclusive),
+    either of them being None for an open range.
+    Returns the number of statements and calls.
+    '''
+    period = reference_start.date()
+    first_source, end_source = sources
+    statements = MonthlyStatement.objects.filter(period=period)
+    # The calls of the period are scanned once, grouped by subscriber
+    calls = Call.objects.filter(
+        end_timestamp__gte=reference_start,
+        end_timestamp__lte=reference_end
+    ).order_by('source', 'end_timestamp')
+    if first_source is not None:
+        statements = statements.filter(subscriber__gte=first_source)
+        calls = calls.filter(source__gte=first_source)
+    if end_source is not None:
+        statements = statements.filter(subscriber__lt=end_source)
+        calls = calls.filter(source__lt=end_source)
+    # Closing a period again replaces its statements
+    statements.delete()
+    statement_count = 0
+    call_count = 0
+    batch = []
+    batch_size = 0
+    for subscriber, subscriber_calls in groupby(
+            calls.iterator(),
+            lambda call: call.source):
+        subscriber_calls = list(subscriber_calls)
+        batch.append((subscriber, subscriber_calls))
+        batch_size += len(subscriber_calls)
+        if batch_size >= CLOSE_BATCH_SIZE:
+            store_statements(reference_start, batch)
+            statement_count += len(batch)
+            call_count += batch_size
+            batch = []
+            batch_size = 0
+    store_statements(reference_start, batch)
+    return statement_count + len(batch), call_count + batch_size
+
+
+def store_statements(reference_start, batch):
+    '''
+    Bills the calls of a batch of subscribers and stores their
+    statements. The batch is a list of (subscriber, calls) pairs.
+    '''
+    renderer = JSONRenderer()
+    # The bills and statements of a batch are stored together or not
+    # at all. Parallel closes of SQLite take turns, each taking the
+    # write lock before reading the bills it may have to create.
+    using = router.db_for_write(MonthlyStatement)
+    with transaction.atomic(using=using):
+        lock_for_write(using)
+        # The bills of the whole batch are fetched and created at once
+        bills = iter(bill_calls(
+            call for _, calls in batch for call in calls
+        ))
+        statements = []
+        for subscriber, calls in batch:
+            content = renderer.render(build_statement(
+                subscriber,
+                reference_start,
+                list(islice(bills, len(calls)))
+            ))
+            statements.append(MonthlyStatement(
+                subscriber=subscriber,
+                period=reference_start.date(),
+                content=content.decode('utf-8'),
+                etag=md5(content).hexdigest()
+            ))
+        MonthlyStatement.objects.bulk_create(statements)
+
+
+def shard_sources(reference_start, reference_end, shards):
+    '''
+    Splits the subscribers with calls ending in a period into about
+    "shards" ranges of numbers with similar numbers of calls, for
+    close_period. The ranges cover every possible number.
+    '''
+    # Calls per number prefix, counted by the database in one query
+    prefixes = Call.objects.filter(
+        end_timestamp__gte=reference_start,
+        end_timestamp__lte=reference_end
+    ).annotate(
+        prefix=Substr('source', 1, SHARD_PREFIX_LENGTH)
+    ).values_list('prefix').annotate(
+        calls=Count('id')
+    ).order_by('prefix')
+    prefixes = list(prefixes)
+    shard_size = sum(calls for _, calls in prefixes) / max(shards, 1)
+    # Contiguous prefixes are grouped until a shard is full
+    boundaries = []
+    size = 0
+    for prefix, calls in prefixes:
+        if size and size + calls > shard_size:
+            boundaries.append(prefix)
+            size = 0
+        size += calls
+    boundaries = [None] + boundaries + [None]
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
 
 # Functions to calculate the whole bill of a record
 
+# The normal period goes from 06:00 to 22:00, and the discount period
+# for the rest of the day. Times below are in seconds.
+DAY_SECONDS = 24 * 3600
+NORMAL_START = 6 * 3600
+NORMAL_SECONDS = 16 * 3600
+# Full minutes in a whole normal or discount period
+NORMAL_PERIOD_MINUTES = NORMAL_SECONDS // 60
+DISCOUNT_PERIOD_MINUTES = (DAY_SECONDS - NORMAL_SECONDS) // 60
+
+
 def calculate_pricing(start, end, call_tariff):
     '''
     This function calculates the full price of a given call from
     timestamp start to timestamp end, given a set of call tariffs
     '''
-    # Safety measure for scope problems
-    tariff = 0
-    # Get the measurement of time between the timestamps
-    delta = calculate_time_delta(start, end)
-    current = start
-    # While we still have time to process...
-    while delta_hours(delta) >= 0:
-        # Get if we are inside the discount period and how much time
-        # is left until the next period change
-        is_discount_period, to_break = calculate_period(current)
-        # If the next break period comes before the call ends...
-        if delta > to_break:
-            # ...check if it's the discount period and add the tariff
-            # from the current time until the period flip
-            if is_discount_period:
-                tariff += calculate_discount_tariff(
-                    current,
-                    (current+to_break),
-                    call_tariff
-                )
-            else:
-                tariff += calculate_basic_tariff(
-                    current,
-                    (current+to_break),
-                    call_tariff
-                )
-            # Take off the time we just processed from the delta
-            delta -= to_break
-            # and add the time passed to our 'current' timestamp
-            current += to_break
-        # If we don't cross any periods until the call ends, then it's
-        # easy happy dreamland
-        else:
-            # Check if we're in a discount period and add the tariff
-            if is_discount_period:
-                tariff += calculate_discount_tariff(current, end, call_tariff)
-            else:
-                tariff += calculate_basic_tariff(current, end, call_tariff)
-            # If we did not cross a billing period then we're done by here
-            break
+    first_is_normal, head, periods, last_is_normal, tail = (
+        calculate_stretches(start, end)
+    )
+    charges = (call_tariff.minute_charge, call_tariff.discount_charge)
+    # The charges are rounded to the precision of the context after
+    # every operation, so the stretches are added up in the order of
+    # the call, as when walking it one period at a time
+    tariff = head * charges[not first_is_normal]
+    if periods:
+        tariff = add_periods(
+            tariff,
+            (
+                NORMAL_PERIOD_MINUTES * charges[0],
+                DISCOUNT_PERIOD_MINUTES * charges[1]
+            ),
+            not first_is_normal,
+            periods
+        )
+    if tail:
+        tariff += tail * charges[not last_is_normal]
     # Add up the base tariff to the minute charges
-    tariff += call_tariff.base_tariff
+    return tariff + call_tariff.base_tariff
+
+
+def add_periods(tariff, period_charges, is_normal, periods):
+    '''
+    Adds up the charges of a number of whole periods, alternately
+    normal and discount ones, to a tariff. The first one is a normal
+    period if is_normal.
+    '''
+    while periods:
+        before = tariff
+        tariff += period_charges[not is_normal]
+        periods -= 1
+        if periods:
+            tariff += period_charges[is_normal]
+            periods -= 1
+            # Once a normal and a discount period leave the rounded
+            # tariff as it was, so do all the next ones
+            if tariff == before:
+                periods %= 2
     return tariff
 
-# Helper functions
 
-def calculate_period(timestamp):
-    '''
-    Calculates the rates and time until the next change in tariff rate
-    from a given timestamp
-    '''
-    # If the time period is between the two discount periods
-    if (timestamp.hour >= 6) and (timestamp.hour < 22):
-        # No discount for you :(
-        is_discount_period = False
-        # The next discount period starts at 22:00:00
-        # so we calculate the delta between the timestamp and that
-        # start timestamp
-        to_break = (
-            timestamp.replace(hour=22, minute=0, second=0)
-            - timestamp
-        )
-    # If the time period is inside one of the discount periods
-    elif timestamp.hour < 6:
-        # We get the discount!
-        is_discount_period = True
-        # The normal period starts at 06:00:00
-        # so we calculate the delta between the timestamp and that
-        # start timestamp
-        to_break = (
-            timestamp.replace(hour=6, minute=0, second=0)
-            - timestamp
-        )
-    elif timestamp.hour >= 22:
-        # We also get the discount!
-        is_discount_period = True
-        # There is a day flip until the next normal period, so we
-        # need to add a day to the current date...
-        next_day = timestamp + relativedelta(days=1)
-        # and then get the delta to the next 06:00:00 timestamp
-        to_break = (
-            next_day.replace(hour=6, minute=0, second=0)
-            - timestamp
+def calculate_stretches(start, end):
+    '''
+    Splits a call into the full minutes of the stretch in its first
+    period, the number of whole periods it then goes through and the
+    full minutes of the stretch in its last period. Each stretch only
+    counts its own full minutes, e.g. a call from 21:59:30 to 22:00:30
+    has no full minute in either period.
+    Returns whether the first and the last periods are normal ones,
+    along with the stretches.
+    '''
+    # Periods change on the second of the start timestamp, so its
+    # microseconds never make up a full minute, and neither do the
+    # ones of the duration
+    delta = end - start
+    # Count time from the start of the first normal period, so normal
+    # periods are [0, 16h) of every day and discount ones [16h, 24h)
+    first = (
+        start.hour * 3600 + start.minute * 60 + start.second
+        - NORMAL_START
+    ) % DAY_SECONDS
+    last = first + delta.days * DAY_SECONDS + delta.seconds
+    # The usual call, inside the normal period of a single day
+    if last <= NORMAL_SECONDS:
+        return True, (last - first) // 60, 0, True, 0
+    return split_stretches(first, last)
+
+
+def split_stretches(first, last):
+    '''
+    Splits the time between two instants, in seconds since the start
+    of a normal period, as calculate_stretches does
+    '''
+    # The first period change after the start of the call...
+    first_day, first_time = divmod(first, DAY_SECONDS)
+    first_is_normal = first_time < NORMAL_SECONDS
+    first_change = first_day * DAY_SECONDS + (
+        NORMAL_SECONDS if first_is_normal else DAY_SECONDS
+    )
+    # ...which may be after its end
+    if last <= first_change:
+        return (
+            first_is_normal,
+            (last - first) // 60,
+            0,
+            first_is_normal,
+            0
         )
-    return is_discount_period, to_break
+    # The last period change up to the end of the call
+    last_day, last_time = divmod(last, DAY_SECONDS)
+    last_is_normal = last_time < NORMAL_SECONDS
+    last_change = last_day * DAY_SECONDS + (
+        0 if last_is_normal else NORMAL_SECONDS
+    )
+    # Every period between the two changes is billed whole. Numbering
+    # the changes, even ones start normal periods and odd ones discount
+    # periods
+    periods = (
+        2 * last_day + (not last_is_normal)
+        - 2 * (first_change // DAY_SECONDS) - first_is_normal
+    )
+    return (
+        first_is_normal,
+        (first_change - first) // 60,
+        periods,
+        last_is_normal,
+        (last - last_change) // 60
+    )
 
 
-def calculate_time_delta(start, end):
+# Batch pricing of arrays of calls, for repricing millions of calls at
+# once. It follows the same rules as calculate_stretches and
+# split_stretches, on whole arrays, in integer cents.
+
+
+def price_calls(starts, ends, tariffs):
     '''
-    Helper function that calculates a time delta between two time
-    periods. Not strictly necessary, just for added readability
+    Calculates the charges of many calls at once, in integer cents.
+    starts and ends are NumPy datetime64 arrays, and each call is
+    priced with the tariff set in effect when it started. Charges are
+    rounded as calculate_pricing rounds them in the current decimal
+    context.
+    This needs NumPy to be installed.
     '''
-    return end - start
+    if numpy is None:
+        raise ImportError('Batch pricing requires NumPy to be installed')
+    # Timestamps as microseconds, and their whole seconds. Floor
+    # division also floors the timestamps before 1970
+    starts = numpy.asarray(starts).astype('datetime64[us]').astype('int64')
+    ends = numpy.asarray(ends).astype('datetime64[us]').astype('int64')
+    seconds = (ends - starts) // 10**6
+    first = (starts // 10**6 - NORMAL_START) % DAY_SECONDS
+    last = first + seconds
+    # The first period change after the start of the call. Since
+    # "first" falls on its first day, that is 22:00 or 06:00
+    first_is_normal = first < NORMAL_SECONDS
+    first_change = numpy.where(first_is_normal, NORMAL_SECONDS, DAY_SECONDS)
+    # The last period change up to the end of the call
+    last_day, last_time = numpy.divmod(last, DAY_SECONDS)
+    last_is_normal = last_time < NORMAL_SECONDS
+    last_change = last_day * DAY_SECONDS + numpy.where(
+        last_is_normal,
+        0,
+        NORMAL_SECONDS
+    )
+    # Calls inside a single period are all head, and the others are
+    # split as in split_stretches
+    single = last <= first_change
+    head = numpy.where(
+        single,
+        (last - first) // 60,
+        (first_change - first) // 60
+    )
+    periods = numpy.where(
+        single,
+        0,
+        2 * last_day + ~last_is_normal
+        - 2 * (first_change // DAY_SECONDS) - first_is_normal
+    )
+    tail = numpy.where(single, 0, (last - last_change) // 60)
+    # The tariffs in effect at the start of each call
+    tariffs = sorted(tariffs, key=lambda tariff: tariff.valid_after)
+    valid_after = numpy.array(
+        [tariff.valid_after for tariff in tariffs],
+        dtype='datetime64[D]'
+    ).astype('int64')
+    start_days = starts // (DAY_SECONDS * 10**6)
+    tariff_index = numpy.searchsorted(valid_after, start_days, side='right')
+    if len(tariffs) == 0 or tariff_index.min() == 0:
+        raise ValueError('There is no tariff in effect for some calls')
+    tariff_index -= 1
+    base_tariff, minute_charge, discount_charge = (
+        numpy.array(
+            [to_cents(getattr(tariff, field)) for tariff in tariffs]
+        )[tariff_index]
+        for field in ('base_tariff', 'minute_charge', 'discount_charge')
+    )
+    # The stretches are added up in the order of the call, rounding
+    # after every operation, as calculate_pricing does
+    precision = getcontext().prec
+    tariff = round_cents(
+        head * numpy.where(first_is_normal, minute_charge, discount_charge),
+        precision
+    )
+    period_charges = (
+        round_cents(NORMAL_PERIOD_MINUTES * minute_charge, precision),
+        round_cents(DISCOUNT_PERIOD_MINUTES * discount_charge, precision)
+    )
+    is_normal = ~first_is_normal
+    while periods.any():
+        before = tariff
+        # A normal and a discount period, as add_periods does
+        for _ in range(2):
+            adding = periods > 0
+            tariff = numpy.where(
+                adding,
+                round_cents(
+                    tariff + numpy.where(is_normal, *period_charges),
+                    precision
+                ),
+                tariff
+            )
+            periods = periods - adding
+            is_normal = ~is_normal
+        periods = numpy.where(tariff == before, periods % 2, periods)
+    tariff = round_cents(
+        tariff + round_cents(
+            tail * numpy.where(last_is_normal, minute_charge, discount_charge),
+            precision
+        ),
+        precision
+    )
+    return round_cents(tariff + base_tariff, precision)
 
 
-def delta_hours(delta):
+def round_cents(cents, precision):
     '''
-    Helper function that calulates a given time delta in hours.
-    Also not strictly necessary, but helps understanding
+    Rounds an array of non-negative integer cents to a number of
+    significant digits, half to even, as a decimal context of that
+    precision rounds the charges
     '''
-    return floor(delta.seconds/3600)
+    # Cents that fit in the precision are never rounded
+    if precision >= 18:
+        return cents
+    # The power of ten each value is rounded to
+    scale = numpy.ones_like(cents)
+    while True:
+        over = cents >= scale * 10**precision
+        if not over.any():
+            break
+        scale = numpy.where(over, scale * 10, scale)
+    quotient, remainder = numpy.divmod(cents, scale)
+    half = scale // 2
+    up = (remainder > half) | (
+        (remainder == half) & (quotient % 2 == 1) & (scale > 1)
+    )
+    return (quotient + up) * scale
+
+
+def to_cents(value):
+    '''
+    Converts a Decimal value with two decimal places to integer cents
+    '''
+    # Regardless of the precision of the current context
+    with localcontext() as context:
+        context.prec = 28
+        return int(value * 100)
+
+# Helper functions
+
+def calculate_time_delta(start, end):
+    '''
+    Helper function that calculates a time delta between two time
+    periods. Not strictly necessary, just for added readability
+    '''
+    return end - start
 
 
 def get_last_month():
@@ -0,0 +1,479 @@
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import IntegrityError, OperationalError, DEFAULT_DB_ALIAS
+from django.db import transaction
+from threading import Lock
+import threading
+import zlib
+
+# The data of each subscriber, i.e. its call records, latest call,
+# calls, bills, statements and archived calls, may be spread over
+# several databases, the aliases listed in SHARDS. The data shared by
+# every subscriber (tariffs, the spool, ...) stays in the default
+# database, along with the directory of the shards.
+#
+# Subscribers are hashed into BUCKETS buckets, which are also the
+# stripes ingest locks (see rest.models.lock_stripes). A bucket is in
+# the shard its number picks modulo the number of shards, unless it was
+# moved to another one by the rebalance_shards command. The moved
+# buckets are recorded in ShardBucket, cached in each process like the
+# tariffs. End records carry no number, so the bucket of every start
+# record is recorded in CallShard, a call_id -> bucket directory.
+#
+# Code runs against a shard inside a using_shard() block, where
+# ShardRouter sends the queries of the sharded models to it. Requests
+# enter the block of their subscriber's shard, so each talks to one
+# shard. With a single shard, which is the default, nothing is looked
+# up and the models are routed as if there were no shards.
+
+BUCKETS = 1024
+
+# Models holding data of a single subscriber
+SHARDED_MODELS = {
+    'callrecord',
+    'lastcall',
+    'call',
+    'phonebill',
+    'monthlystatement',
+    'archivedcall',
+}
+
+# Key of the shard map in CacheVersion
+SHARD_MAP_CACHE_KEY = 'shards'
+
+# Shard of the current thread, if in a using_shard() block
+_state = threading.local()
+
+
+class ShardMoved(OperationalError):
+    '''
+    Raised when the bucket of a record moved to another shard while its
+    ingest waited for the bucket's lock. Sending the record again stores
+    it in its new shard.
+    '''
+
+
+def is_sharded():
+    '''
+    Checks whether there are several shards
+    '''
+    return len(settings.SHARDS) > 1
+
+
+def bucket_of(number):
+    '''
+    Gets the bucket of a phone number. hash() of a string differs
+    between processes, a CRC does not.
+    '''
+    return zlib.crc32(number.encode()) % BUCKETS
+
+
+class ShardMap(object):
+    '''
+    The shard of every bucket
+    '''
+
+    def __init__(self, moved, version=0):
+        # bucket -> shard of the buckets moved by rebalance_shards
+        self.moved = moved
+        self.version = version
+
+    def shard_of(self, bucket):
+        '''
+        Gets the shard a bucket is in
+        '''
+        shard = self.moved.get(bucket)
+        if shard is None:
+            shard = settings.SHARDS[bucket % len(settings.SHARDS)]
+        return shard
+
+
+# The shard map of this process, loaded lazily and replaced as a whole
+_map = None
+_lock = Lock()
+
+
+def get_map():
+    '''
+    Gets the shard map, reloading it if buckets moved since it was
+    cached. This costs one query for the version, plus one for the
+    moved buckets after a move.
+    '''
+    # Imported here since the models depend on this module
+    from rest.models import CacheVersion, ShardBucket
+    global _map
+    version = CacheVersion.get(SHARD_MAP_CACHE_KEY, using=DEFAULT_DB_ALIAS)
+    shard_map = _map
+    if shard_map is None or shard_map.version != version:
+        with _lock:
+            shard_map = ShardMap(
+                dict(ShardBucket.objects.using(
+                    DEFAULT_DB_ALIAS
+                ).values_list('bucket', 'shard')),
+                version
+            )
+            _map = shard_map
+    return shard_map
+
+
+def invalidate_map():
+    '''
+    Drops the shard map of this process and tells the other processes
+    to drop theirs
+    '''
+    # Imported here since the models depend on this module
+    from rest.models import CacheVersion
+    global _map
+    CacheVersion.bump(SHARD_MAP_CACHE_KEY, using=DEFAULT_DB_ALIAS)
+    _map = None
+
+
+def shard_for(number):
+    '''
+    Gets the shard holding the data of a subscriber
+    '''
+    if not is_sharded():
+        return settings.SHARDS[0]
+    return get_map().shard_of(bucket_of(number))
+
+
+@contextmanager
+def using_shard(alias):
+    '''
+    Sends the queries of the sharded models in a block to a shard
+    '''
+    previous = getattr(_state, 'shard', None)
+    _state.shard = alias
+    try:
+        yield alias
+    finally:
+        _state.shard = previous
+
+
+def current(record=None):
+    '''
+    Gets the shard of the current using_shard() block. Outside of one,
+    the shard of a record if given, or else the first shard.
+    '''
+    alias = getattr(_state, 'shard', None)
+    if alias is not None:
+        return alias
+    if record is not None:
+        return locate([record])[0]
+    return settings.SHARDS[0]
+
+
+def keep_shard(iterable):
+    '''
+    Iterates in the shard of the current block, e.g. a response that
+    is streamed after the view returned
+    '''
+    alias = current()
+    iterator = iter(iterable)
+    while True:
+        with using_shard(alias):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def locate(records):
+    '''
+    Gets the shard of each record of a list, setting the bucket of its
+    subscriber as record.bucket. End records are located through the
+    start records before them in the list or in the directory, and are
+    left without a bucket if their call is not found.
+    '''
+    if not is_sharded():
+        return [settings.SHARDS[0]] * len(records)
+    # Imported here since the models depend on this module
+    from rest.models import ArchivedCall, CallRecord, CallShard
+    buckets = {}
+    ended = set()
+    for record in records:
+        if record.type == 'S':
+            record.bucket = bucket_of(record.source)
+            buckets.setdefault(record.call_id, record.bucket)
+        elif record.call_id not in buckets:
+            ended.add(record.call_id)
+    for chunk in chunks(ended):
+        buckets.update(CallShard.objects.using(DEFAULT_DB_ALIAS).filter(
+            call_id__in=chunk
+        ).values_list('call_id', 'bucket'))
+    # Calls started before the database was sharded may be missing from
+    # the directory. Their start record, or their key if they were
+    # archived, is looked for in every shard
+    missing = ended - set(buckets)
+    for alias in settings.SHARDS if missing else ():
+        for chunk in chunks(missing):
+            buckets.update(
+                (call_id, bucket_of(source))
+                for call_id, source in CallRecord.objects.using(
+                    alias
+                ).filter(
+                    type='S',
+                    call_id__in=chunk
+                ).values_list('call_id', 'source')
+            )
+            buckets.update(
+                (call_id, bucket_of(source))
+                for call_id, source in ArchivedCall.objects.using(
+                    alias
+                ).filter(
+                    call_id__in=chunk
+                ).values_list('call_id', 'source')
+            )
+    shard_map = get_map()
+    shards = []
+    for record in records:
+        if record.type == 'E':
+            record.bucket = buckets.get(record.call_id)
+        # Calls that were never started are rejected in any shard
+        if record.bucket is None:
+            shards.append(settings.SHARDS[0])
+        else:
+            shards.append(shard_map.shard_of(record.bucket))
+    return shards
+
+
+def split(candidates):
+    '''
+    Splits a list of (index, record) pairs by shard, keeping their order
+    within each shard. Returns a list of (shard, pairs) pairs.
+    '''
+    groups = {}
+    shards = locate([record for _, record in candidates])
+    for alias, candidate in zip(shards, candidates):
+        groups.setdefault(alias, []).append(candidate)
+    return list(groups.items())
+
+
+def check_buckets(records):
+    '''
+    Checks that the buckets of records are still in the current shard,
+    once they are locked. Raises ShardMoved if one moved.
+    '''
+    if not is_sharded():
+        return
+    shard_map = get_map()
+    alias = current()
+    for record in records:
+        bucket = getattr(record, 'bucket', None)
+        if bucket is not None and shard_map.shard_of(bucket) != alias:
+            raise ShardMoved(
+                'The subscriber of this record moved to another shard.'
+                + ' Please send it again.'
+            )
+
+
+def register_calls(records):
+    '''
+    Records the bucket of the start records of a list in the directory.
+    Raises IntegrityError if one of their call_ids was started by a
+    subscriber of another bucket, i.e. possibly in another shard.
+    '''
+    if not is_sharded():
+        return
+    # Imported here since the models depend on this module
+    from rest.models import CallShard
+    starts = {
+        record.call_id: bucket_of(record.source)
+        for record in records if record.type == 'S'
+    }
+    known = {}
+    for chunk in chunks(starts):
+        known.update(CallShard.objects.using(DEFAULT_DB_ALIAS).filter(
+            call_id__in=chunk
+        ).values_list('call_id', 'bucket'))
+    for call_id, bucket in known.items():
+        if starts[call_id] != bucket:
+            raise IntegrityError(
+                'A start record with this call_id already exists.'
+            )
+    CallShard.objects.using(DEFAULT_DB_ALIAS).bulk_create([
+        CallShard(call_id=call_id, bucket=bucket)
+        for call_id, bucket in starts.items() if call_id not in known
+    ])
+
+
+def subscribers_in(alias):
+    '''
+    Gets the subscribers with data in a shard, as a dict of bucket ->
+    set of numbers
+    '''
+    # Imported here since the models depend on this module
+    from rest.models import ArchivedCall, Call, CallRecord, LastCall
+    from rest.models import MonthlyStatement
+    numbers = set(CallRecord.objects.using(alias).filter(
+        type='S'
+    ).values_list('source', flat=True).distinct())
+    numbers.update(ArchivedCall.objects.using(alias).values_list(
+        'source',
+        flat=True
+    ).distinct())
+    numbers.update(LastCall.objects.using(alias).values_list(
+        'source',
+        flat=True
+    ))
+    numbers.update(Call.objects.using(alias).values_list(
+        'source',
+        flat=True
+    ).distinct())
+    numbers.update(MonthlyStatement.objects.using(alias).values_list(
+        'subscriber',
+        flat=True
+    ).distinct())
+    subscribers = {}
+    for number in numbers:
+        subscribers.setdefault(bucket_of(number), set()).add(number)
+    return subscribers
+
+
+def subscriber_rows(numbers, alias):
+    '''
+    Gets the rows of some subscribers in a shard, as a list of
+    (model, rows) pairs. Bills are left out, being created again when
+    calls are billed.
+    '''
+    # Imported here since the models depend on this module
+    from rest.models import ArchivedCall, Call, CallRecord, LastCall
+    from rest.models import MonthlyStatement
+    call_ids = set()
+    for chunk in chunks(numbers):
+        call_ids.update(CallRecord.objects.using(alias).filter(
+            type='S',
+            source__in=chunk
+        ).values_list('call_id', flat=True))
+    rows = [
+        (CallRecord, [], 'call_id', call_ids),
+        (LastCall, [], 'source', numbers),
+        (Call, [], 'source', numbers),
+        (MonthlyStatement, [], 'subscriber', numbers),
+        (ArchivedCall, [], 'source', numbers),
+    ]
+    for model, instances, field, values in rows:
+        for chunk in chunks(values):
+            instances.extend(model.objects.using(alias).filter(
+                **{field + '__in': chunk}
+            ))
+    return [(model, instances) for model, instances, _, _ in rows]
+
+
+def delete_rows(rows, alias):
+    '''
+    Deletes rows of subscribers from a shard, along with the bills of
+    their calls
+    '''
+    # Imported here since the models depend on this module
+    from rest.models import Call, PhoneBill
+    for model, instances in rows:
+        if model is Call:
+            calls = {
+                (call.destination, call.start_timestamp)
+                for call in instances
+            }
+            for chunk in chunks(instances):
+                PhoneBill.objects.using(alias).filter(
+                    pk__in=[
+                        bill.pk for bill in PhoneBill.objects.using(
+                            alias
+                        ).filter(
+                            destination__in={
+                                call.destination for call in chunk
+                            },
+                            start_timestamp__in={
+                                call.start_timestamp for call in chunk
+                            }
+                        ) if (bill.destination, bill.start_timestamp)
+                        in calls
+                    ]
+                ).delete()
+        for chunk in chunks(instances):
+            model.objects.using(alias).filter(
+                pk__in=[instance.pk for instance in chunk]
+            ).delete()
+
+
+def move_bucket(bucket, source, target):
+    '''
+    Moves the data of the subscribers of a bucket from a shard to
+    another, and points the shard map to it. Returns the number of
+    subscribers and of rows moved.
+    '''
+    # Imported here since the models depend on this module
+    from rest.models import ShardBucket, lock_stripes
+    with transaction.atomic(using=source):
+        # Ingest of the bucket waits for the move, then finds out that
+        # it moved (see check_buckets)
+        lock_stripes({bucket}, using=source)
+        numbers = subscribers_in(source).get(bucket, set())
+        rows = subscriber_rows(numbers, source)
+        with transaction.atomic(using=target):
+            lock_stripes({bucket}, using=target)
+            stored = subscriber_rows(numbers, target)
+            # The map points to the target already if a move was
+            # interrupted before its source was cleaned up. What the
+            # target holds is current then, and the source is dropped.
+            if (get_map().shard_of(bucket) != target
+                    or not any(instances for _, instances in stored)):
+                # Leftovers of a move interrupted before the map changed
+                delete_rows(stored, target)
+                # The rows get new ids in the target. Statements get the
+                # time of the move as the time they were closed.
+                for model, instances in rows:
+                    model.objects.using(target).bulk_create([
+                        model(**{
+                            field.attname: getattr(instance, field.attname)
+                            for field in model._meta.concrete_fields
+                            if not field.primary_key
+                        }) for instance in instances
+                    ])
+        # The target is committed, so the bucket is served from it once
+        # the map points there. Ingest of the bucket in the source still
+        # waits, until its data is deleted there.
+        default = settings.SHARDS[bucket % len(settings.SHARDS)]
+        ShardBucket.objects.using(DEFAULT_DB_ALIAS).filter(
+            bucket=bucket
+        ).delete()
+        if target != default:
+            ShardBucket.objects.using(DEFAULT_DB_ALIAS).create(
+                bucket=bucket,
+                shard=target
+            )
+        invalidate_map()
+        delete_rows(rows, source)
+    return len(numbers), sum(len(instances) for _, instances in rows)
+
+
+def chunks(values):
+    '''
+    Splits values into IN (...) lists, like rest.models.chunks
+    '''
+    # Imported here since the models depend on this module
+    from rest.models import chunks
+    return chunks(values)
+
+
+class ShardRouter(object):
+    '''
+    Routes the sharded models to the shard of the current block, or of
+    the instance they were loaded from. Other models, and every model
+    if there is a single shard, are left to the next router.
+    '''
+
+    def route(self, model, hints):
+        if (not is_sharded()
+                or model._meta.model_name not in SHARDED_MODELS):
+            return None
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db is not None:
+            return instance._state.db
+        return current()
+
+    def db_for_read(self, model, **hints):
+        return self.route(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self.route(model, hints)
@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, post_delete, post_migrate
+from django.dispatch import receiver
+from rest.models import CallTariff
+from rest.tariffs import invalidate_timeline
+import rest.partitions as partitions
+import rest.statement_cache as statement_cache
+
+
+@receiver(post_save, sender=CallTariff)
+@receiver(post_delete, sender=CallTariff)
+def tariff_changed(sender, instance, **kwargs):
+    '''
+    Invalidates the cached tariff timeline, and the statements of the
+    periods the tariff covers, when a tariff changes
+    '''
+    invalidate_timeline()
+    statement_cache.invalidate_tariff_periods(instance.valid_after)
+
+
+@receiver(connection_created)
+def tune_sqlite(sender, connection, **kwargs):
+    '''
+    Applies the SQLITE_PRAGMAS settings to a new SQLite connection
+    '''
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+
+
+@receiver(post_migrate)
+def create_partitions(sender, using, **kwargs):
+    '''
+    Creates the partitions of the coming months after migrating, on
+    databases where the tables are partitioned
+    '''
+    if sender.name == 'rest':
+        partitions.ensure_partitions(using=using)
@@ -0,0 +1,329 @@
+import json
+import os
+import threading
+import time
+from django.conf import settings
+from django.db import transaction
+from rest.models import SpoolCheckpoint, RejectedRecord
+from rest.ingest import ingest_records
+
+# In the asynchronous ingest mode, CallRecordView appends the records it
+# receives to the spool and answers right away. The spool is a directory
+# of append-only NDJSON segment files, each named after the period of
+# INGEST_SPOOL_SEGMENT_SECONDS it was written in, so segments are read
+# in the order they were written and removed once applied. The
+# apply_spool command validates and stores the spooled records in
+# batches, one transaction per batch.
+
+SEGMENT_SUFFIX = '.ndjson'
+# A segment may still get records for a while after its period ended,
+# from requests that picked it just before
+SEGMENT_GRACE_SECONDS = 60
+
+
+def segment_name(timestamp):
+    '''
+    Gets the name of the segment records are appended to at a time
+    '''
+    return '{:012d}'.format(
+        int(timestamp // settings.INGEST_SPOOL_SEGMENT_SECONDS)
+    )
+
+
+def segment_sealed(segment, now):
+    '''
+    Checks whether a segment can no longer get records
+    '''
+    end = (int(segment) + 1) * settings.INGEST_SPOOL_SEGMENT_SECONDS
+    return now >= end + SEGMENT_GRACE_SECONDS
+
+
+def list_segments(directory):
+    '''
+    Gets the names of the segments in the spool, oldest first
+    '''
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return sorted(
+        name[:-len(SEGMENT_SUFFIX)] for name in names
+        if name.endswith(SEGMENT_SUFFIX)
+    )
+
+
+def segment_path(directory, segment):
+    '''
+    Gets the path of a segment file
+    '''
+    return os.path.join(directory, segment + SEGMENT_SUFFIX)
+
+
+def parse_position(position):
+    '''
+    Gets the (segment, offset) pair of a "segment:offset" position.
+    Raises ValueError if it is not one.
+    '''
+    segment, offset = position.split(':')
+    if not segment.isdigit():
+        raise ValueError('Invalid position.')
+    return segment, int(offset)
+
+
+class SpoolWriter(object):
+    '''
+    Appends records to the spool of a process. Appends are written at
+    once, and fsynced in groups: the first append waiting for the disk
+    waits flush_interval more seconds, then fsyncs every append made
+    until then, while the others wait for it.
+    '''
+
+    def __init__(self, directory, flush_interval):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.condition = threading.Condition()
+        # The file descriptor of each segment written since the last
+        # fsync, and the ticket of the last append to it
+        self.files = {}
+        self.segment = None
+        # Appends made, appends known to be on disk, and whether one of
+        # them is being fsynced
+        self.written = 0
+        self.synced = 0
+        self.flushing = False
+
+    def open_segment(self, segment):
+        '''
+        Opens a segment for appending, creating it if needed
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        descriptor = os.open(
+            segment_path(self.directory, segment),
+            os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+            0o644
+        )
+        # The new file is only found after a crash if its directory
+        # entry is on disk as well
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        return descriptor
+
+    def append(self, item):
+        '''
+        Appends a record to the spool, returning its position once it
+        is on disk
+        '''
+        line = (json.dumps(item, separators=(',', ':')) + '\n').encode()
+        with self.condition:
+            segment = segment_name(time.time())
+            if segment not in self.files:
+                self.files[segment] = [self.open_segment(segment), 0]
+            self.segment = segment
+            descriptor = self.files[segment][0]
+            # Other processes append to the segment as well. Appends are
+            # single writes, which are never interleaved, and they leave
+            # the descriptor at the end of our own record
+            os.write(descriptor, line)
+            offset = os.lseek(descriptor, 0, os.SEEK_CUR) - len(line)
+            self.written += 1
+            ticket = self.written
+            self.files[segment][1] = ticket
+        self.sync(ticket)
+        return '{}:{}'.format(segment, offset)
+
+    def sync(self, ticket):
+        '''
+        Waits until the append with a given ticket is on disk,
+        fsyncing it along with the others if no one else is
+        '''
+        while True:
+            with self.condition:
+                while self.flushing and self.synced < ticket:
+                    self.condition.wait()
+                if self.synced >= ticket:
+                    return
+                self.flushing = True
+            synced = None
+            try:
+                # Appends made while we wait are fsynced with this one
+                time.sleep(self.flush_interval)
+                with self.condition:
+                    target = self.written
+                    descriptors = [
+                        descriptor for descriptor, _ in self.files.values()
+                    ]
+                for descriptor in descriptors:
+                    os.fsync(descriptor)
+                synced = target
+            finally:
+                with self.condition:
+                    self.flushing = False
+                    if synced is not None:
+                        self.synced = max(self.synced, synced)
+                        self.close_past_segments()
+                    self.condition.notify_all()
+
+    def close_past_segments(self):
+        '''
+        Closes the segments that get no more appends and are on disk
+        '''
+        for segment, (descriptor, last_ticket) in list(self.files.items()):
+            if segment != self.segment and last_ticket <= self.synced:
+                del self.files[segment]
+                os.close(descriptor)
+
+    def close(self):
+        '''
+        Closes the segment files
+        '''
+        with self.condition:
+            for descriptor, _ in self.files.values():
+                os.close(descriptor)
+            self.files = {}
+            self.segment = None
+
+
+# The writer of this process. Workers forked from a process that
+# already had one open a new one.
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    '''
+    Gets the spool writer of this process
+    '''
+    global _writer, _writer_pid
+    with _writer_lock:
+        if (_writer is None or _writer_pid != os.getpid()
+                or _writer.directory != settings.INGEST_SPOOL_DIR):
+            _writer = SpoolWriter(
+                settings.INGEST_SPOOL_DIR,
+                settings.INGEST_SPOOL_FLUSH_INTERVAL
+            )
+            _writer_pid = os.getpid()
+        return _writer
+
+
+def append(item):
+    '''
+    Appends a record to the spool, returning its position once it is
+    on disk
+    '''
+    return get_writer().append(item)
+
+
+def read_records(path, offset, limit):
+    '''
+    Reads up to "limit" records of a segment from an offset. Returns
+    the (offset, line) pairs read, and the offset after them. A last
+    line without its newline is still being written, so it is left
+    for later.
+    '''
+    records = []
+    with open(path, 'rb') as segment:
+        segment.seek(offset)
+        while len(records) < limit:
+            line = segment.readline()
+            if not line.endswith(b'\n'):
+                break
+            records.append((offset, line))
+            offset += len(line)
+    return records, offset
+
+
+def apply_spool(directory, batch_size):
+    '''
+    Validates and stores the next batch of spooled records, in the
+    order they were spooled, in a single transaction with the
+    checkpoint. Returns the number of records accepted and rejected,
+    both 0 when there was nothing to apply.
+    '''
+    checkpoint = SpoolCheckpoint.load()
+    now = time.time()
+    for segment in list_segments(directory):
+        path = segment_path(directory, segment)
+        # Applied already, and removed after the commit
+        if segment < checkpoint.segment:
+            os.remove(path)
+            continue
+        offset = checkpoint.offset if segment == checkpoint.segment else 0
+        lines, end = read_records(path, offset, batch_size)
+        sealed = segment_sealed(segment, now)
+        # The tail of a sealed segment was cut by a crash while it was
+        # written, and is rejected below along with the batch
+        if not lines and sealed and end < os.path.getsize(path):
+            with open(path, 'rb') as segment_file:
+                segment_file.seek(end)
+                lines = [(end, segment_file.read())]
+            end = os.path.getsize(path)
+        if lines:
+            return apply_records(checkpoint, segment, end, lines)
+        if not sealed:
+            return 0, 0
+        # A sealed segment that was applied to its end is done with
+        checkpoint.segment = segment
+        checkpoint.offset = end
+        checkpoint.save()
+        os.remove(path)
+    return 0, 0
+
+
+def apply_records(checkpoint, segment, end, lines):
+    '''
+    Validates and stores the records read from a segment, moving the
+    checkpoint past them. Returns the number of records accepted and
+    rejected.
+    '''
+    items = []
+    malformed = {}
+    for index, (offset, line) in enumerate(lines):
+        try:
+            items.append(json.loads(line.decode()))
+        except ValueError:
+            # Counts as not being a JSON object, and is rejected as such
+            items.append(None)
+            malformed[index] = ['Malformed record.']
+    with transaction.atomic():
+        results = ingest_records(items)
+        rejected = []
+        for index, result in enumerate(results):
+            # Records stored already are acknowledged like new ones
+            if result['status'] in ('accepted', 'duplicate'):
+                continue
+            offset, line = lines[index]
+            rejected.append(RejectedRecord(
+                position='{}:{}'.format(segment, offset),
+                record=line.decode(errors='replace').rstrip('\n'),
+                errors=json.dumps(malformed.get(index, result['errors']))
+            ))
+        RejectedRecord.objects.bulk_create(rejected)
+        checkpoint.segment = segment
+        checkpoint.offset = end
+        checkpoint.save()
+    return len(results) - len(rejected), len(rejected)
+
+
+def record_status(position):
+    '''
+    Gets the status of the record spooled at a position: "pending",
+    "accepted" or "rejected" with its errors. Raises ValueError if the
+    position is not a valid one.
+    '''
+    segment, offset = parse_position(position)
+    checkpoint = SpoolCheckpoint.load()
+    if (segment, offset) >= (checkpoint.segment, checkpoint.offset):
+        return {'position': position, 'status': 'pending'}
+    try:
+        rejected = RejectedRecord.objects.get(position=position)
+    except RejectedRecord.DoesNotExist:
+        return {'position': position, 'status': 'accepted'}
+    return {
+        'position': position,
+        'status': 'rejected',
+        'errors': json.loads(rejected.errors)
+    }
@@ -0,0 +1,148 @@
+from time import time
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+# Statements computed on request, cached per subscriber and month in the
+# cache named by STATEMENT_CACHE. Entries are keyed by the version of
+# the statement, the count and latest id of its calls that make up its
+# ETag as well, so a call ending in its month moves readers to a new
+# key and the old entry is left to expire. Nothing has to be dropped
+# when calls are stored, which could not be ordered with readers that
+# computed a statement from the calls before they were committed.
+# Tariff changes are recorded in the cache as well, and entries of the
+# periods a change covers are ignored from then on, until they expire.
+
+# Keys of the hit and miss counters
+HITS_KEY = 'statements:hits'
+MISSES_KEY = 'statements:misses'
+
+# Key of the tariff changes, a (since, changes) pair. Entries written
+# before since are never used, in case changes were evicted with the
+# key. Each change is a (changed_at, covers_from) pair.
+TARIFF_CHANGES_KEY = 'statements:tariff-changes'
+
+
+def get_cache():
+    '''
+    Gets the cache the statements are stored in
+    '''
+    return caches[settings.STATEMENT_CACHE]
+
+
+def statement_key(subscriber, timestamp, version):
+    '''
+    Gets the cache key of a version of the statement of a subscriber for
+    the month containing a timestamp
+    '''
+    return 'statement:{}:{:%Y-%m}:{}'.format(subscriber, timestamp, version)
+
+
+def get_statement(subscriber, reference_start, reference_end, version):
+    '''
+    Gets the data cached for a version of a statement, or None if it is
+    not cached or a tariff changed for its period since
+    '''
+    cache = get_cache()
+    key = statement_key(subscriber, reference_start, version)
+    values = cache.get_many([key, TARIFF_CHANGES_KEY])
+    entry = values.get(key)
+    tariff_changes = values.get(TARIFF_CHANGES_KEY)
+    if entry is None or tariff_changes is None:
+        count(cache, MISSES_KEY)
+        return None
+    written_at, data = entry
+    since, changes = tariff_changes
+    if written_at < since or any(
+            changed_at >= written_at and covers_from <= reference_end.date()
+            for changed_at, covers_from in changes):
+        count(cache, MISSES_KEY)
+        return None
+    count(cache, HITS_KEY)
+    return data
+
+
+def set_statement(subscriber, reference_start, version, data,
+                  timeout=DEFAULT_TIMEOUT):
+    '''
+    Caches a version of a statement for "timeout" seconds (the cache's
+    default timeout by default)
+    '''
+    cache = get_cache()
+    written_at = time()
+    # Without a record of the tariff changes no entry can be trusted,
+    # so one is started for the entries written from now on
+    cache.add(TARIFF_CHANGES_KEY, (written_at, []), None)
+    cache.set(
+        statement_key(subscriber, reference_start, version),
+        (written_at, data),
+        timeout
+    )
+
+
+def invalidate_statement(subscriber, timestamp, version):
+    '''
+    Drops a version of the cached statement of a subscriber for the
+    month containing a timestamp
+    '''
+    get_cache().delete(statement_key(subscriber, timestamp, version))
+
+
+def invalidate_tariff_periods(covers_from):
+    '''
+    Records a change of the tariffs valid after a date, so the cached
+    statements of the periods ending on or after it are not used again
+    '''
+    cache = get_cache()
+    changed_at = time()
+    tariff_changes = cache.get(TARIFF_CHANGES_KEY)
+    if tariff_changes is None:
+        since, changes = changed_at, []
+    else:
+        since, changes = tariff_changes
+        # Changes older than any entry that did not expire yet no
+        # longer matter
+        if cache.default_timeout is not None:
+            changes = [
+                change for change in changes
+                if change[0] > changed_at - cache.default_timeout
+            ]
+    changes.append((changed_at, covers_from))
+    cache.set(TARIFF_CHANGES_KEY, (since, changes), None)
+
+
+def count(cache, key):
+    '''
+    Increments a counter in the cache. Counters are best effort: they
+    start over if evicted, and backends without atomic increments may
+    lose concurrent ones.
+    '''
+    if not cache.add(key, 1, None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Evicted between the two calls
+            cache.set(key, 1, None)
+
+
+def get_stats():
+    '''
+    Gets the hit and miss counts of the statement cache, and its hit
+    rate (None before any read)
+    '''
+    counters = get_cache().get_many([HITS_KEY, MISSES_KEY])
+    hits = counters.get(HITS_KEY, 0)
+    misses = counters.get(MISSES_KEY, 0)
+    reads = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / reads if reads else None
+    }
+
+
+def clear():
+    '''
+    Drops every cached statement and resets the counters
+    '''
+    get_cache().clear()
@@ -0,0 +1,69 @@
+from bisect import bisect_right
+from threading import Lock
+from rest.models import CallTariff, CacheVersion
+
+# The tariffs in effect over time, cached in the memory of each process.
+# Tariffs change a few times a year while every priced call needs one,
+# so the lookup is a bisect over the cached dates instead of a query.
+
+# Key of the tariffs in CacheVersion
+TARIFFS_CACHE_KEY = 'tariffs'
+
+
+class TariffTimeline(object):
+    '''
+    The tariff sets ordered by the date they become valid
+    '''
+
+    def __init__(self, tariffs, version=0):
+        tariffs = sorted(tariffs, key=lambda tariff: tariff.valid_after)
+        self.tariffs = tariffs
+        self.dates = [tariff.valid_after for tariff in tariffs]
+        self.version = version
+
+    def tariff_at(self, timestamp):
+        '''
+        Gets the tariffs in effect at a given time, or None if there
+        are no tariffs valid that early
+        '''
+        index = bisect_right(self.dates, timestamp.date())
+        if index == 0:
+            return None
+        return self.tariffs[index-1]
+
+
+# The timeline of this process. It is loaded lazily and replaced as a
+# whole, so readers never see it half updated
+_timeline = None
+_lock = Lock()
+
+
+def get_timeline():
+    '''
+    Gets the tariff timeline, reloading it if the tariffs changed since
+    it was cached, in this process or any other. This costs one query
+    for the version, plus one for the tariffs after a change.
+    '''
+    global _timeline
+    version = CacheVersion.get(TARIFFS_CACHE_KEY)
+    timeline = _timeline
+    # Versions are compared for equality, since a rolled back change
+    # takes the version back as well
+    if timeline is None or timeline.version != version:
+        with _lock:
+            timeline = TariffTimeline(
+                CallTariff.objects.order_by('valid_after'),
+                version
+            )
+            _timeline = timeline
+    return timeline
+
+
+def invalidate_timeline():
+    '''
+    Drops the tariff timeline of this process and tells the other
+    processes to drop theirs
+    '''
+    global _timeline
+    CacheVersion.bump(TARIFFS_CACHE_KEY)
+    _timeline = None
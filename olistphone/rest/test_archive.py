@@ -0,0 +1,206 @@
+from django.core.management import call_command
+from django.test import TestCase
+from rest.models import ArchivedCall, Call, CallRecord
+from rest.test_models import create_tariff
+import rest.archive as archive
+import rest.ingest as ingest
+import rest.statement_cache as statement_cache
+from datetime import date, datetime
+from decimal import Decimal
+from io import StringIO
+import json
+import shutil
+import tempfile
+
+SUBSCRIBER = '21998833445'
+# Leading zeros must survive the numeric encoding
+OTHER = '01199887766'
+DESTINATION = '4100000004'
+
+
+def call_records(call_id, source, start, end):
+    '''
+    Builds the records of a call, as sent to /records/bulk/
+    '''
+    return [
+        {
+            'type': 'S',
+            'timestamp': start,
+            'call_id': call_id,
+            'source': source,
+            'destination': DESTINATION
+        },
+        {'type': 'E', 'timestamp': end, 'call_id': call_id},
+    ]
+
+
+class ArchiveTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        settings = self.settings(ARCHIVE_DIR=directory)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        statement_cache.clear()
+        create_tariff(
+            valid_after=date(2018, 1, 1),
+            base_tariff=Decimal('0.36'),
+            minute_charge=Decimal('0.09'),
+            discount_charge=Decimal('0.00')
+        )
+        ingest.ingest_records(
+            call_records(
+                1, SUBSCRIBER, '2018-02-28T23:58:00Z', '2018-03-01T00:10:00Z'
+            )
+            + call_records(
+                2, SUBSCRIBER, '2018-03-10T12:00:00Z', '2018-03-10T13:01:30Z'
+            )
+            + call_records(
+                3, OTHER, '2018-03-10T12:00:00.250000Z', '2018-03-10T12:05:00Z'
+            )
+            + call_records(
+                4, SUBSCRIBER, '2018-04-02T08:00:00Z', '2018-04-02T08:03:00Z'
+            )
+        )
+
+    def get(self, subscriber, query=''):
+        response = self.client.get(
+            '/billing/{}/03-2018/{}'.format(subscriber, query),
+            follow=True
+        )
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def archive(self):
+        out = StringIO()
+        call_command('archive_records', '2018-03', stdout=out)
+        statement_cache.clear()
+        return out.getvalue()
+
+    def test_encoding(self):
+        call = Call(
+            call_id=7,
+            source=OTHER,
+            destination=DESTINATION,
+            start_timestamp=datetime(2018, 3, 10, 12, 0, 0, 250000),
+            end_timestamp=datetime(2018, 3, 10, 12, 5),
+            duration=299,
+            charge=Decimal('1234567.89')
+        )
+        archive.write_archive(
+            datetime(2018, 3, 1),
+            archive.merge_rows(None, [archive.call_row(call)])
+        )
+        stored, = archive.open_archive(datetime(2018, 3, 1)).calls_of(OTHER)
+        for field in ('call_id', 'source', 'destination', 'start_timestamp',
+                      'end_timestamp', 'duration', 'charge'):
+            self.assertEqual(getattr(stored, field), getattr(call, field))
+        self.assertEqual(str(stored.charge), '1234567.89')
+        self.assertIsNone(archive.open_archive(datetime(2018, 4, 1)))
+
+    def test_archived_month_served_from_file(self):
+        statement = self.get(SUBSCRIBER).data
+        other = self.get(OTHER).data
+        self.assertIn('Archived 3 calls of 2018-03', self.archive())
+        # The calls of the month and their records left the database,
+        # and those of other months stayed. Only the keys of the calls
+        # are kept.
+        self.assertEqual(
+            list(Call.objects.values_list('call_id', flat=True)),
+            [4]
+        )
+        self.assertEqual(
+            sorted(CallRecord.objects.values_list('type', 'call_id')),
+            [('E', 4), ('S', 4)]
+        )
+        self.assertEqual(
+            sorted(ArchivedCall.objects.values_list('call_id', 'source')),
+            [(1, SUBSCRIBER), (2, SUBSCRIBER), (3, OTHER)]
+        )
+        self.assertEqual(self.get(SUBSCRIBER).data, statement)
+        self.assertEqual(self.get(OTHER).data, other)
+        self.assertEqual(len(self.get('21998833440').data['billed_calls']), 0)
+        # Pages and streams read the archive too
+        page = self.get(SUBSCRIBER, '?limit=1').data
+        self.assertEqual(page['totals']['calls'], 2)
+        self.assertEqual(page['billed_calls'], statement['billed_calls'][:1])
+        page = self.get(
+            SUBSCRIBER,
+            '?limit=1&after={}'.format(page['next'])
+        ).data
+        self.assertEqual(page['billed_calls'], statement['billed_calls'][1:])
+        self.assertIsNone(page['next'])
+        statement_cache.clear()
+        response = self.get(SUBSCRIBER, '?stream=1')
+        self.assertEqual(
+            json.loads(b''.join(response.streaming_content))['billed_calls'],
+            json.loads(json.dumps(statement['billed_calls']))
+        )
+
+    def test_calls_ended_after_archiving(self):
+        ingest.ingest_records([{
+            'type': 'S',
+            'timestamp': '2018-03-20T10:00:00Z',
+            'call_id': 5,
+            'source': SUBSCRIBER,
+            'destination': DESTINATION
+        }])
+        self.archive()
+        ingest.ingest_records([
+            {'type': 'E', 'timestamp': '2018-03-20T10:02:00Z', 'call_id': 5}
+        ])
+        statement = self.get(SUBSCRIBER).data
+        self.assertEqual(len(statement['billed_calls']), 3)
+        # Archiving again adds it to the file
+        self.assertIn('(4 calls in the file)', self.archive())
+        self.assertFalse(Call.objects.filter(call_id=5).exists())
+        self.assertEqual(self.get(SUBSCRIBER).data, statement)
+
+    def test_resent_records_of_archived_calls(self):
+        statement = self.get(SUBSCRIBER).data
+        self.archive()
+        # Their records are rebuilt from the file
+        results = ingest.ingest_records(call_records(
+            2, SUBSCRIBER, '2018-03-10T12:00:00Z', '2018-03-10T13:01:30Z'
+        ))
+        self.assertEqual(
+            [result['status'] for result in results],
+            ['duplicate', 'duplicate']
+        )
+        start, _ = call_records(
+            3, OTHER, '2018-03-10T12:00:00.250000Z', '2018-03-10T12:05:00Z'
+        )
+        response = self.client.post(
+            '/records/',
+            json.dumps(start),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(
+            '/records/',
+            json.dumps({
+                'type': 'E',
+                'timestamp': '2018-03-10T13:05:00Z',
+                'call_id': 2
+            }),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(CallRecord.objects.filter(call_id=2).exists())
+        self.assertFalse(Call.objects.filter(call_id=2).exists())
+        statement_cache.clear()
+        self.assertEqual(self.get(SUBSCRIBER).data, statement)
+
+    def test_archived_call_stored_again(self):
+        self.archive()
+        # E.g. stored again while the month was being archived
+        archived, = [
+            call for call in archive.open_archive(
+                datetime(2018, 3, 1)
+            ).calls_of(SUBSCRIBER) if call.call_id == 2
+        ]
+        archived.id = None
+        archived.save()
+        billed = self.get(SUBSCRIBER).data['billed_calls']
+        self.assertEqual(len(billed), 2)
@@ -0,0 +1,282 @@
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from rest.models import MonthlyStatement, PhoneBill
+from rest.test_models import create_record
+import rest.services as services
+import rest.statement_cache as statement_cache
+from datetime import datetime, timedelta
+from io import StringIO
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+
+
+class ExplainQueriesCommandTests(TestCase):
+
+    def test_hot_queries_use_indexes(self):
+        out = StringIO()
+        # --check fails the command if any query scans a whole table
+        call_command('explain_queries', '--check', stdout=out)
+        self.assertIn(', 0 full table scans', out.getvalue())
+
+
+def create_calls():
+    '''
+    Stores the calls of march 2018 the close tests bill
+    '''
+    calls = [
+        (40, '21998833445', datetime(2018, 2, 28, 23, 59), 120),
+        (41, '21998833445', datetime(2018, 3, 10, 12, 0), 137),
+        (42, '21900000000', datetime(2018, 3, 10, 13, 0), 60),
+        # Ends in april
+        (43, '21998833445', datetime(2018, 3, 31, 23, 59), 120),
+    ]
+    for call_id, source, start, duration in calls:
+        create_record(
+            type='S',
+            timestamp=start,
+            call_id=call_id,
+            source=source,
+            destination='41000000000'
+        )
+        create_record(
+            type='E',
+            timestamp=start+timedelta(seconds=duration),
+            call_id=call_id
+        )
+
+
+class CloseBillingPeriodCommandTests(TestCase):
+
+    def setUp(self):
+        statement_cache.clear()
+        create_calls()
+
+    def close(self, period):
+        out = StringIO()
+        call_command('close_billing_period', period, stdout=out)
+        return out.getvalue()
+
+    def test_close_period(self):
+        url = '/billing/21998833445/03-2018'
+        # The statement as computed on request
+        expected = self.client.get(url, follow=True).content
+        PhoneBill.objects.all().delete()
+        output = self.close('2018-03')
+        self.assertIn('2 statements, 3 calls', output)
+        self.assertEqual(
+            MonthlyStatement.objects.filter(period='2018-03-01').count(),
+            2
+        )
+        self.assertEqual(PhoneBill.objects.count(), 3)
+        # Closed months are served from the stored statements
+        with self.assertNumQueries(1):
+            response = self.client.get(url, follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(response.content, expected)
+        self.assertEqual(
+            len(json.loads(response.content.decode())['billed_calls']),
+            2
+        )
+
+    def test_closed_period_caching(self):
+        self.close('2018-03')
+        url = '/billing/21998833445/03-2018'
+        response = self.client.get(url, follow=True)
+        statement = MonthlyStatement.objects.get(
+            subscriber='21998833445',
+            period='2018-03-01'
+        )
+        self.assertEqual(response['ETag'], '"{}"'.format(statement.etag))
+        self.assertIn('Last-Modified', response)
+        # A late call changes a closed statement, so it is revalidated
+        self.assertNotIn('immutable', response['Cache-Control'])
+        self.assertIn('must-revalidate', response['Cache-Control'])
+        self.assertIn(
+            'max-age={}'.format(settings.CLOSED_STATEMENT_MAX_AGE),
+            response['Cache-Control']
+        )
+        # Polls with a current copy cost the statement lookup alone
+        with self.assertNumQueries(1):
+            response = self.client.get(
+                url,
+                follow=True,
+                HTTP_IF_NONE_MATCH=response['ETag']
+            )
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(
+            url,
+            follow=True,
+            HTTP_IF_MODIFIED_SINCE=response['Last-Modified']
+        )
+        self.assertEqual(response.status_code, 304)
+        # Closing the month again keeps the version of an unchanged
+        # statement
+        self.close('2018-03')
+        response = self.client.get(
+            url,
+            follow=True,
+            HTTP_IF_NONE_MATCH='"{}"'.format(statement.etag)
+        )
+        self.assertEqual(response.status_code, 304)
+        # But not of one with a late call
+        create_record(
+            type='S',
+            timestamp=datetime(2018, 3, 30, 8, 0),
+            call_id=90,
+            source='21998833445',
+            destination='41000000000'
+        )
+        create_record(
+            type='E',
+            timestamp=datetime(2018, 3, 30, 8, 5),
+            call_id=90
+        )
+        self.close('2018-03')
+        response = self.client.get(
+            url,
+            follow=True,
+            HTTP_IF_NONE_MATCH='"{}"'.format(statement.etag)
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_late_call_drops_closed_statement(self):
+        self.close('2018-03')
+        url = '/billing/21998833445/03-2018'
+        closed = self.client.get(url, follow=True)
+        # A call of march whose end record arrives after the close
+        create_record(
+            type='S',
+            timestamp=datetime(2018, 3, 30, 8, 0),
+            call_id=91,
+            source='21998833445',
+            destination='41000000000'
+        )
+        create_record(
+            type='E',
+            timestamp=datetime(2018, 3, 30, 8, 5),
+            call_id=91
+        )
+        self.assertFalse(MonthlyStatement.objects.filter(
+            subscriber='21998833445',
+            period='2018-03-01'
+        ).exists())
+        # The statements of other subscribers are kept
+        self.assertEqual(MonthlyStatement.objects.count(), 1)
+        response = self.client.get(
+            url,
+            follow=True,
+            HTTP_IF_NONE_MATCH=closed['ETag']
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['billed_calls']), 3)
+
+    def test_close_period_again(self):
+        self.close('2018-03')
+        output = self.close('2018-03')
+        self.assertIn('2 statements, 3 calls', output)
+        self.assertEqual(MonthlyStatement.objects.count(), 2)
+        # The bills were not created twice either
+        self.assertEqual(PhoneBill.objects.count(), 3)
+
+    def test_close_invalid_period(self):
+        self.assertRaises(CommandError, self.close, 'mar-2018')
+        self.assertRaises(
+            CommandError,
+            self.close,
+            (datetime.now()+timedelta(days=31)).strftime('%Y-%m')
+        )
+
+    def test_close_with_workers_needs_shared_database(self):
+        # The test database lives in the memory of this process, or in
+        # the transaction of this test on other databases
+        self.assertRaises(
+            CommandError,
+            call_command,
+            'close_billing_period',
+            '2018-03',
+            '--workers',
+            '2',
+            stdout=StringIO()
+        )
+
+    def test_shard_sources(self):
+        reference_start, reference_end = services.get_monthly_period(
+            datetime(2018, 3, 1)
+        )
+        self.assertEqual(
+            services.shard_sources(reference_start, reference_end, 1),
+            [(None, None)]
+        )
+        # Each of the two subscribers gets a shard
+        shards = services.shard_sources(reference_start, reference_end, 2)
+        self.assertEqual(shards, [(None, '2199'), ('2199', None)])
+        statements = 0
+        for sources in shards:
+            shard_statements, _ = services.close_period(
+                reference_start,
+                reference_end,
+                sources
+            )
+            statements += shard_statements
+        self.assertEqual(statements, 2)
+        # Closing a shard again leaves the others alone
+        services.close_period(reference_start, reference_end, shards[0])
+        self.assertEqual(MonthlyStatement.objects.count(), 2)
+
+
+class ParallelCloseTests(TransactionTestCase):
+
+    def setUp(self):
+        statement_cache.clear()
+        create_calls()
+        # The workers open the database on their own, so an in-memory
+        # test database is copied to a file this process then uses too
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            database = os.path.join(self.directory, 'db.sqlite3')
+            connection.ensure_connection()
+            copy = sqlite3.connect(database)
+            connection.connection.backup(copy)
+            copy.close()
+            # The in-memory database is gone once its connection closes
+            memory = connection.connection
+            name = connection.settings_dict['NAME']
+            connection.connection = None
+            connection.settings_dict['NAME'] = database
+            self.addCleanup(setattr, connection, 'connection', memory)
+            self.addCleanup(
+                connection.settings_dict.__setitem__,
+                'NAME',
+                name
+            )
+            self.addCleanup(connection.close)
+
+    def test_close_with_workers(self):
+        expected = self.client.get(
+            '/billing/21998833445/03-2018',
+            follow=True
+        ).content
+        out = StringIO()
+        call_command(
+            'close_billing_period',
+            '2018-03',
+            '--workers',
+            '2',
+            stdout=out
+        )
+        self.assertIn('2 statements, 3 calls', out.getvalue())
+        statement = MonthlyStatement.objects.get(
+            subscriber='21998833445',
+            period='2018-03-01'
+        )
+        self.assertEqual(statement.content.encode(), expected)
+        self.assertEqual(MonthlyStatement.objects.count(), 2)
+        self.assertEqual(PhoneBill.objects.count(), 3)
@@ -0,0 +1,319 @@
+from django.core.exceptions import ValidationError
+from django.db import connection, connections, IntegrityError
+from django.db import OperationalError
+from django.test import TestCase, TransactionTestCase
+from rest.models import CallRecord, LastCall, Call
+from rest.ingest import build_record, ingest_records
+from rest.test_models import create_record
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import tempfile
+
+# The source every worker of the stress test calls from
+STRESS_SOURCE = '21999999999'
+STRESS_WORKERS = 4
+STRESS_ROUNDS = 30
+
+
+class IngestRecordsTests(TestCase):
+
+    def setUp(self):
+        self.time = datetime(2018, 6, 27, 12, 0, 0)
+        create_record(
+            type='S',
+            timestamp=self.time,
+            call_id=40,
+            source='2199999999',
+            destination='41000000000'
+        )
+
+    def statuses(self, results):
+        return [result['status'] for result in results]
+
+    def test_ingest_valid_batch(self):
+        results = ingest_records([
+            {
+                'type': 'E',
+                'timestamp': '2018-06-27T12:02:00Z',
+                'call_id': 40
+            },
+            {
+                'type': 'S',
+                'timestamp': '2018-06-27T12:05:00Z',
+                'call_id': 41,
+                'source': '2199999999',
+                'destination': '41000000000'
+            },
+            {
+                'type': 'E',
+                'timestamp': '2018-06-27T12:07:30Z',
+                'call_id': 41
+            },
+        ])
+        self.assertEqual(self.statuses(results), ['accepted'] * 3)
+        self.assertEqual(CallRecord.objects.count(), 4)
+        self.assertEqual(
+            CallRecord.objects.get(type='E', call_id=41).timestamp,
+            datetime(2018, 6, 27, 12, 7, 30)
+        )
+        last_call = LastCall.objects.get(source='2199999999')
+        self.assertEqual(last_call.call_id, 41)
+        self.assertEqual(
+            last_call.end_timestamp,
+            datetime(2018, 6, 27, 12, 7, 30)
+        )
+        # Both ended calls were stored, in the same batch
+        self.assertEqual(
+            list(Call.objects.order_by('call_id').values_list(
+                'call_id',
+                'duration'
+            )),
+            [(40, 120), (41, 150)]
+        )
+
+    def test_ingest_rejects_invalid_fields(self):
+        results = ingest_records([
+            'not a record',
+            {'type': 'F', 'timestamp': '2018-06-27T12:02:00Z', 'call_id': 1},
+            {
+                'type': 'E',
+                'timestamp': '2018-06-27T12:02:00Z',
+                'call_id': 40,
+                'source': '2199999999',
+                'destination': '41000000000'
+            },
+            {
+                'type': 'S',
+                'timestamp': '2018-06-27T12:05:00Z',
+                'call_id': 41,
+                'source': '2199999999'
+            },
+        ])
+        self.assertEqual(self.statuses(results), ['rejected'] * 4)
+        self.assertEqual(
+            results[2]['errors'],
+            ['End records must not have numbers.']
+        )
+        self.assertEqual(CallRecord.objects.count(), 1)
+
+    def test_ingest_rejects_database_conflicts(self):
+        results = ingest_records([
+            # Source is still on call 40
+            {
+                'type': 'S',
+                'timestamp': '2018-06-27T12:05:00Z',
+                'call_id': 41,
+                'source': '2199999999',
+                'destination': '41000000001'
+            },
+            # No start record for this call
+            {'type': 'E', 'timestamp': '2018-06-27T12:06:00Z', 'call_id': 7},
+            # Ends before it starts
+            {'type': 'E', 'timestamp': '2018-06-27T11:59:00Z', 'call_id': 40},
+            # A different start record for the same call
+            {
+                'type': 'S',
+                'timestamp': '2018-06-27T13:00:00Z',
+                'call_id': 40,
+                'source': '2188888888',
+                'destination': '41000000001'
+            },
+        ])
+        self.assertEqual(
+            self.statuses(results),
+            ['rejected', 'rejected', 'rejected', 'conflict']
+        )
+        self.assertIn('(Unpaired call_id)', results[0]['errors'][0])
+        self.assertEqual(CallRecord.objects.count(), 1)
+
+    def test_ingest_validates_against_earlier_items(self):
+        results = ingest_records([
+            {'type': 'E', 'timestamp': '2018-06-27T12:10:00Z', 'call_id': 40},
+            # Overlaps with call 40, which was ended by the item above
+            {
+                'type': 'S',
+                'timestamp': '2018-06-27T12:05:00Z',
+                'call_id': 41,
+                'source': '2199999999',
+                'destination': '41000000001'
+            },
+            {'type': 'E', 'timestamp': '2018-06-27T12:11:00Z', 'call_id': 40},
+        ])
+        self.assertEqual(
+            self.statuses(results),
+            ['accepted', 'rejected', 'conflict']
+        )
+        self.assertIn('later timestamp', results[1]['errors'][0])
+
+    def test_ingest_acknowledges_resends(self):
+        end = {
+            'type': 'E',
+            'timestamp': '2018-06-27T12:02:00Z',
+            'call_id': 40
+        }
+        start = {
+            'type': 'S',
+            'timestamp': '2018-06-27T12:00:00Z',
+            'call_id': 40,
+            'source': '2199999999',
+            'destination': '41000000000'
+        }
+        results = ingest_records([end, start, end])
+        self.assertEqual(
+            self.statuses(results),
+            ['accepted', 'duplicate', 'duplicate']
+        )
+        # The whole batch sent again is only looked up, within the
+        # savepoint of the batch and after locking its numbers
+        with self.assertNumQueries(5):
+            results = ingest_records([end, start])
+        self.assertEqual(self.statuses(results), ['duplicate'] * 2)
+        self.assertEqual(CallRecord.objects.count(), 2)
+        self.assertEqual(Call.objects.count(), 1)
+
+    def test_ingest_uses_few_queries(self):
+        items = []
+        for call_id in range(100, 200):
+            items.append({
+                'type': 'S',
+                'timestamp': '2018-07-01T10:{:02d}:00Z'.format(call_id % 60),
+                'call_id': call_id,
+                'source': '21{:08d}'.format(call_id),
+                'destination': '41{:09d}'.format(call_id)
+            })
+        # Savepoints, the lock and the insert count as queries as well,
+        # but none of them depends on the size of the batch
+        with self.assertNumQueries(10):
+            results = ingest_records(items)
+        self.assertEqual(self.statuses(results), ['accepted'] * 100)
+
+
+def stress_items(round, worker):
+    '''
+    Builds the call a worker sends in a round of the stress test. The
+    calls of all workers in a round start at the same instant from the
+    same source, so only one of them may be accepted.
+    '''
+    call_id = round * STRESS_WORKERS + worker
+    start = datetime(2018, 3, 1) + timedelta(minutes=2*round)
+    return [
+        {
+            'type': 'S',
+            'timestamp': start.isoformat(),
+            'call_id': call_id,
+            'source': STRESS_SOURCE,
+            'destination': '41{:09d}'.format(call_id)
+        },
+        {
+            'type': 'E',
+            'timestamp': (start + timedelta(seconds=60)).isoformat(),
+            'call_id': call_id
+        },
+    ]
+
+
+def use_database(database):
+    '''
+    Points a forked worker at the test database. An in-memory SQLite
+    one lives in the parent process, so the workers share a copy of it
+    in a file instead, dropping the connection they inherited.
+    '''
+    if database is not None:
+        connection.connection = None
+        connection.settings_dict['NAME'] = database
+
+
+def stress_worker(database, worker):
+    '''
+    Sends the calls of a worker in every round, alternating between a
+    batch and single saves. Returns the number of records accepted and
+    of those that failed on a lock.
+    '''
+    use_database(database)
+    accepted = 0
+    failures = 0
+    for round in range(STRESS_ROUNDS):
+        items = stress_items(round, worker)
+        try:
+            if round % 2:
+                for item in items:
+                    try:
+                        build_record(item).save()
+                        accepted += 1
+                    except (ValidationError, IntegrityError):
+                        pass
+            else:
+                accepted += sum(
+                    result['status'] == 'accepted'
+                    for result in ingest_records(items)
+                )
+        except OperationalError:
+            failures += 1
+    connection.close()
+    return accepted, failures
+
+
+def stored_calls(database):
+    '''
+    Gets the start timestamps of the stored start records of the stress
+    source, and the (start, end) timestamps of its calls
+    '''
+    use_database(database)
+    starts = list(CallRecord.objects.filter(
+        type='S',
+        source=STRESS_SOURCE
+    ).values_list('timestamp', flat=True))
+    calls = list(Call.objects.filter(source=STRESS_SOURCE).order_by(
+        'start_timestamp'
+    ).values_list('start_timestamp', 'end_timestamp'))
+    connection.close()
+    return starts, calls
+
+
+class ConcurrentIngestTests(TransactionTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = None
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.database = os.path.join(self.directory, 'db.sqlite3')
+            connection.ensure_connection()
+            copy = sqlite3.connect(self.database)
+            connection.connection.backup(copy)
+            copy.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_concurrent_calls_of_one_source(self):
+        # The workers are forked, like those of an application server,
+        # and must not share the connection of this process
+        connections.close_all()
+        with ProcessPoolExecutor(
+                max_workers=STRESS_WORKERS,
+                mp_context=multiprocessing.get_context('fork')) as executor:
+            results = list(executor.map(
+                stress_worker,
+                [self.database] * STRESS_WORKERS,
+                range(STRESS_WORKERS)
+            ))
+            starts, calls = executor.submit(
+                stored_calls,
+                self.database
+            ).result()
+        self.assertEqual(sum(failures for _, failures in results), 0)
+        # One start and end pair accepted per round
+        self.assertEqual(
+            sum(accepted for accepted, _ in results),
+            2 * STRESS_ROUNDS
+        )
+        self.assertEqual(len(starts), STRESS_ROUNDS)
+        self.assertEqual(len(set(starts)), STRESS_ROUNDS)
+        self.assertEqual(len(calls), STRESS_ROUNDS)
+        # And no call overlaps the next one
+        for (_, end), (start, _) in zip(calls, calls[1:]):
+            self.assertLess(end, start)
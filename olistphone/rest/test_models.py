@@ -1,10 +1,15 @@
+from unittest import skipUnless
 from django.test import TestCase
-from rest.models import CallRecord, PhoneBill, CallTariff
+from rest.models import CallRecord, PhoneBill, CallTariff, LastCall, Call
 from django.utils import timezone
+from django.db import connection, connections
 from django.db.utils import IntegrityError
 from django.core.exceptions import ValidationError
 from datetime import timedelta
 from dateutil.relativedelta import relativedelta
+import os
+import shutil
+import tempfile
 from decimal import *
 getcontext().prec = 2
 
@@ -199,6 +204,117 @@ class CallRecordTests(TestCase):
             destination='41000000000'
         )
 
+    def test_late_record_cannot_overlap(self):
+        time = timezone.now().replace(
+            year=1994,
+            month=6,
+            day=27,
+            hour=12,
+            minute=0,
+            second=0
+        )
+        for call_id, start in ((40, 0), (41, 60)):
+            create_record(
+                type='S',
+                timestamp=time+relativedelta(minutes=start),
+                call_id=call_id,
+                source='2199999999',
+                destination='41000000000'
+            )
+            create_record(
+                type='E',
+                timestamp=time+relativedelta(minutes=start+10),
+                call_id=call_id,
+            )
+        # Arrives after call 41, but overlaps with call 40
+        self.assertRaises(
+            ValidationError,
+            create_record,
+            type='S',
+            timestamp=time+relativedelta(minutes=5),
+            call_id=42,
+            source='2199999999',
+            destination='41000000000'
+        )
+        record = create_record(
+            type='S',
+            timestamp=time+relativedelta(minutes=20),
+            call_id=42,
+            source='2199999999',
+            destination='41000000000'
+        )
+        self.assertIsNotNone(record)
+
+    def test_last_call_is_kept_up_to_date(self):
+        time = timezone.now().replace(second=0)
+        create_record(
+            type='S',
+            timestamp=time,
+            call_id=40,
+            source='2199999999',
+            destination='41000000000'
+        )
+        last_call = LastCall.objects.get(source='2199999999')
+        self.assertEqual(last_call.call_id, 40)
+        self.assertIsNone(last_call.end_timestamp)
+        create_record(
+            type='E',
+            timestamp=time+relativedelta(minutes=2),
+            call_id=40,
+        )
+        last_call = LastCall.objects.get(source='2199999999')
+        self.assertEqual(
+            last_call.end_timestamp,
+            time+relativedelta(minutes=2)
+        )
+        create_record(
+            type='S',
+            timestamp=time+relativedelta(minutes=3),
+            call_id=41,
+            source='2199999999',
+            destination='41000000000'
+        )
+        last_call = LastCall.objects.get(source='2199999999')
+        self.assertEqual(last_call.call_id, 41)
+        self.assertIsNone(last_call.end_timestamp)
+
+    def test_end_record_stores_the_call(self):
+        time = timezone.now().replace(
+            year=2018,
+            month=6,
+            day=27,
+            hour=12,
+            minute=0,
+            second=0,
+            microsecond=0
+        )
+        create_tariff(
+            valid_after=time.replace(year=1994),
+            base_tariff=Decimal('0.36'),
+            minute_charge=Decimal('0.09'),
+            discount_charge=Decimal('0.00')
+        )
+        create_record(
+            type='S',
+            timestamp=time,
+            call_id=40,
+            source='2199999999',
+            destination='41000000000'
+        )
+        self.assertFalse(Call.objects.exists())
+        create_record(
+            type='E',
+            timestamp=time+relativedelta(seconds=137),
+            call_id=40,
+        )
+        call = Call.objects.get(call_id=40)
+        self.assertEqual(call.source, '2199999999')
+        self.assertEqual(call.destination, '41000000000')
+        self.assertEqual(call.start_timestamp, time)
+        self.assertEqual(call.end_timestamp, time+relativedelta(seconds=137))
+        self.assertEqual(call.duration, 137)
+        self.assertEqual(call.charge, Decimal('0.54'))
+
     def test_call_cannot_end_before_start(self):
         time = timezone.now().replace(
             year=1994,
@@ -223,6 +339,37 @@ class CallRecordTests(TestCase):
             call_id=40
         )
 
+    def test_validation_query_count(self):
+        time = timezone.now()
+        create_tariff(
+            valid_after=time.replace(year=1994),
+            base_tariff=Decimal('0.36'),
+            minute_charge=Decimal('0.09'),
+            discount_charge=Decimal('0.00')
+        )
+        # The lock of the numbers, one query for the call_id and
+        # timestamp facts, one for the latest call of the source, the
+        # insert itself and the update of the latest call, plus the
+        # savepoint around them
+        with self.assertNumQueries(7):
+            create_record(
+                type='S',
+                timestamp=time,
+                call_id=40,
+                source='2199999999',
+                destination='41000000000'
+            )
+        # The end record also stores the call, priced with the cached
+        # tariffs. Checking they are current is one query, and loading
+        # them after the tariff created above another. End records lock
+        # no number, but SQLite takes its write lock all the same.
+        with self.assertNumQueries(10 if connection.vendor == 'sqlite' else 9):
+            create_record(
+                type='E',
+                timestamp=time+relativedelta(minutes=2),
+                call_id=40,
+            )
+
     def test_record_uniqueness(self):
         time = timezone.now()
         record1 = create_record(
@@ -392,3 +539,31 @@ class CallTariffTests(TestCase):
             discount_charge=Decimal('0.11'),
             valid_after=timezone.now()
         )
+
+
+@skipUnless(connection.vendor == 'sqlite', 'Only SQLite is tuned')
+class SQLiteTuningTests(TestCase):
+
+    def pragma(self, wrapper, name):
+        with wrapper.cursor() as cursor:
+            cursor.execute('PRAGMA {}'.format(name))
+            return cursor.fetchone()[0]
+
+    def test_connection_pragmas(self):
+        # NORMAL
+        self.assertEqual(self.pragma(connection, 'synchronous'), 1)
+        self.assertEqual(self.pragma(connection, 'busy_timeout'), 5000)
+        self.assertEqual(self.pragma(connection, 'cache_size'), -65536)
+
+    def test_file_database_uses_wal(self):
+        # The test database lives in memory, which has no journal file
+        directory = tempfile.mkdtemp()
+        wrapper = connections['default'].__class__(dict(
+            connection.settings_dict,
+            NAME=os.path.join(directory, 'tuned.sqlite3')
+        ))
+        try:
+            self.assertEqual(self.pragma(wrapper, 'journal_mode'), 'wal')
+        finally:
+            wrapper.close()
+            shutil.rmtree(directory)
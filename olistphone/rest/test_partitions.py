@@ -0,0 +1,189 @@
+from unittest import skipIf, skipUnless
+from django.db import connection, transaction, IntegrityError
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from rest.models import Call, CallRecord
+from rest.test_models import create_record
+import rest.partitions as partitions
+import rest.statement_cache as statement_cache
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+import re
+
+PARTITIONED = partitions.supports_partitions(connection)
+
+# Names of the partitions of the calls and bills in a query plan
+PARTITION_PATTERN = re.compile(
+    r'\b(rest_(?:call|phonebill)_(?:\d{4}_\d{2}|default))\b'
+)
+
+
+@skipUnless(PARTITIONED, 'Tables are only partitioned on PostgreSQL')
+class PartitionTests(TestCase):
+
+    def setUp(self):
+        statement_cache.clear()
+
+    def partitions_of(self, table):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT DISTINCT tableoid::regclass::text FROM {}'.format(
+                    connection.ops.quote_name(table)
+                )
+            )
+            return {row[0] for row in cursor.fetchall()}
+
+    def create_call(self, call_id, start, duration=60):
+        create_record(
+            type='S',
+            timestamp=start,
+            call_id=call_id,
+            source='21998833445',
+            destination='41000000000'
+        )
+        create_record(
+            type='E',
+            timestamp=start + timedelta(seconds=duration),
+            call_id=call_id
+        )
+
+    def test_tables_are_partitioned(self):
+        current = date.today().replace(day=1)
+        with connection.cursor() as cursor:
+            for table, _, _ in partitions.PARTITIONED_TABLES:
+                self.assertTrue(partitions.is_partitioned(cursor, table))
+                existing = partitions.list_partitions(cursor, table)
+                # Created when the test database was migrated
+                self.assertIn(
+                    partitions.default_partition_name(table),
+                    existing
+                )
+                self.assertIn(
+                    partitions.partition_name(table, current),
+                    existing
+                )
+
+    def test_partition_moves_rows(self):
+        self.create_call(40, datetime(2018, 3, 10, 12, 0))
+        self.assertEqual(
+            self.partitions_of('rest_callrecord'),
+            {'rest_callrecord_default'}
+        )
+        created = partitions.ensure_partitions(
+            date(2018, 3, 1),
+            date(2018, 3, 1)
+        )
+        self.assertEqual(
+            created,
+            ['rest_callrecord_2018_03', 'rest_call_2018_03']
+            + ['rest_phonebill_2018_03']
+        )
+        self.assertEqual(
+            self.partitions_of('rest_callrecord'),
+            {'rest_callrecord_2018_03'}
+        )
+        self.assertEqual(
+            self.partitions_of('rest_call'),
+            {'rest_call_2018_03'}
+        )
+        # The keys of the rows moved are still taken
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            CallRecord.objects.bulk_create([CallRecord(
+                type='S',
+                timestamp=datetime(2018, 4, 10, 12, 0),
+                call_id=40,
+                source='21998833445',
+                destination='41000000000'
+            )])
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT COUNT(*) FROM rest_callrecord_key WHERE call_id = 40'
+            )
+            self.assertEqual(cursor.fetchone()[0], 2)
+            cursor.execute(
+                'SELECT COUNT(*) FROM rest_call_key WHERE call_id = 40'
+            )
+            self.assertEqual(cursor.fetchone()[0], 1)
+        # Created already
+        self.assertEqual(
+            partitions.ensure_partitions(date(2018, 3, 1), date(2018, 3, 1)),
+            []
+        )
+
+    def test_billing_reads_one_partition(self):
+        partitions.ensure_partitions(date(2018, 2, 1), date(2018, 4, 1))
+        self.create_call(40, datetime(2018, 2, 28, 23, 0))
+        self.create_call(41, datetime(2018, 3, 10, 12, 0))
+        self.create_call(42, datetime(2018, 4, 2, 12, 0))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                '/billing/21998833445/03-2018',
+                follow=True
+            )
+        self.assertEqual(len(response.data['billed_calls']), 1)
+        read = set()
+        with connection.cursor() as cursor:
+            for query in queries.captured_queries:
+                if not query['sql'].startswith('SELECT'):
+                    continue
+                cursor.execute('EXPLAIN ' + query['sql'])
+                for line, in cursor.fetchall():
+                    read.update(PARTITION_PATTERN.findall(line))
+        self.assertEqual(read, {'rest_call_2018_03', 'rest_phonebill_2018_03'})
+
+    def test_keys_unique_across_partitions(self):
+        partitions.ensure_partitions(date(2018, 3, 1), date(2018, 4, 1))
+        self.create_call(40, datetime(2018, 3, 10, 12, 0))
+        # The same start record a month later falls in another partition
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            CallRecord.objects.bulk_create([CallRecord(
+                type='S',
+                timestamp=datetime(2018, 4, 10, 12, 0),
+                call_id=40,
+                source='21998833445',
+                destination='41000000000'
+            )])
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Call.objects.create(
+                call_id=40,
+                source='21998833445',
+                destination='41000000000',
+                start_timestamp=datetime(2018, 4, 10, 12, 0),
+                end_timestamp=datetime(2018, 4, 10, 12, 1),
+                duration=60,
+                charge=Decimal('0.45')
+            )
+        # A deleted record frees its key
+        CallRecord.objects.filter(type='E', call_id=40).delete()
+        CallRecord.objects.bulk_create([CallRecord(
+            type='E',
+            timestamp=datetime(2018, 4, 1, 0, 0),
+            call_id=40
+        )])
+
+    def test_truncate_frees_keys(self):
+        self.create_call(40, datetime(2018, 3, 10, 12, 0))
+        # Like flush, which skips the row triggers
+        with connection.cursor() as cursor:
+            cursor.execute('TRUNCATE rest_callrecord, rest_call')
+            for table in ('rest_callrecord_key', 'rest_call_key'):
+                cursor.execute('SELECT COUNT(*) FROM ' + table)
+                self.assertEqual(cursor.fetchone(), (0, ))
+        CallRecord.objects.bulk_create([CallRecord(
+            type='S',
+            timestamp=datetime(2018, 3, 10, 12, 0),
+            call_id=40,
+            source='21998833445',
+            destination='41000000000'
+        )])
+
+
+@skipIf(PARTITIONED, 'Tables are partitioned')
+class PlainTablesTests(TestCase):
+
+    def test_no_partitions(self):
+        self.assertEqual(partitions.ensure_partitions(), [])
+        with self.assertRaises(CommandError):
+            call_command('create_partitions')
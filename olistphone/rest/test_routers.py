@@ -0,0 +1,135 @@
+from django.core.management import call_command
+from django.db import connections
+from django.test import TestCase, override_settings
+from rest.middleware import PIN_COOKIE
+from rest.models import Call, CallRecord, PhoneBill
+import rest.routers as routers
+import rest.statement_cache as statement_cache
+from datetime import datetime
+from decimal import Decimal
+import json
+import os
+import shutil
+import tempfile
+
+# Alias of the replica, a second SQLite file created for the tests
+REPLICA = 'replica_test'
+SUBSCRIBER = '21998833445'
+
+
+def create_call(using, call_id, destination):
+    '''
+    Stores a march 2018 call of the subscriber in one of the databases
+    '''
+    start = datetime(2018, 3, 10, 12, call_id % 60)
+    # Rows of a replica are copies of the primary's, so different calls
+    # never have the same id in both
+    return Call.objects.using(using).create(
+        id=call_id,
+        call_id=call_id,
+        source=SUBSCRIBER,
+        destination=destination,
+        start_timestamp=start,
+        end_timestamp=start.replace(second=30),
+        duration=30,
+        charge=Decimal('0.36')
+    )
+
+
+@override_settings(DATABASE_REPLICAS=[REPLICA])
+class ReplicaTests(TestCase):
+    # Every database is wrapped in the test transactions, including the
+    # replica added below before the test case is set up
+    multi_db = True
+
+    @classmethod
+    def setUpClass(cls):
+        # The replica holds its own rows, so what was read from it shows
+        cls.directory = tempfile.mkdtemp()
+        connections.databases[REPLICA] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(cls.directory, 'replica.sqlite3'),
+        }
+        call_command('migrate', database=REPLICA, verbosity=0)
+        super(ReplicaTests, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(ReplicaTests, cls).tearDownClass()
+        connections[REPLICA].close()
+        del connections.databases[REPLICA]
+        delattr(connections._connections, REPLICA)
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        statement_cache.clear()
+        routers.reset()
+        create_call('default', 40, '41000000040')
+        create_call(REPLICA, 41, '41000000041')
+
+    def billed_destinations(self):
+        response = self.client.get(
+            '/billing/{}/03-2018'.format(SUBSCRIBER),
+            follow=True
+        )
+        self.assertEqual(response.status_code, 200)
+        return [
+            bill['destination'] for bill in response.data['billed_calls']
+        ]
+
+    def test_statements_read_from_replica(self):
+        self.assertEqual(self.billed_destinations(), ['41000000041'])
+        # The bills are stored in the primary
+        self.assertEqual(
+            routers.ReplicaRouter().db_for_write(Call),
+            'default'
+        )
+
+    def test_only_billing_reads_from_replica(self):
+        router = routers.ReplicaRouter()
+        self.assertEqual(router.db_for_read(Call), 'default')
+        routers.reset()
+        with routers.read_from_replicas():
+            self.assertEqual(router.db_for_read(Call), REPLICA)
+            # The bills are read to create the missing ones
+            self.assertEqual(router.db_for_read(PhoneBill), 'default')
+            # After a write the thread reads its own writes
+            router.db_for_write(Call)
+            self.assertEqual(router.db_for_read(Call), 'default')
+
+    def test_client_pinned_after_write(self):
+        self.assertEqual(self.billed_destinations(), ['41000000041'])
+        response = self.client.post(
+            '/records/',
+            json.dumps({
+                'type': 'S',
+                'timestamp': '2018-04-01T12:00:00Z',
+                'call_id': 42,
+                'source': SUBSCRIBER,
+                'destination': '41000000042'
+            }),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.cookies[PIN_COOKIE]['max-age'], 5)
+        # Records are written to the primary only
+        self.assertTrue(CallRecord.objects.filter(call_id=42).exists())
+        self.assertFalse(
+            CallRecord.objects.using(REPLICA).filter(call_id=42).exists()
+        )
+        # The client keeps the cookie, and reads from the primary, past
+        # the statement cached from the replica
+        self.assertEqual(self.billed_destinations(), ['41000000040'])
+        # Once the cookie expired, statements are read from the replica
+        # again, and the statement cached from the primary is not
+        # served for the calls of the replica
+        del self.client.cookies[PIN_COOKIE]
+        self.assertEqual(self.billed_destinations(), ['41000000041'])
+
+    def test_reads_do_not_pin(self):
+        self.billed_destinations()
+        response = self.client.get(
+            '/billing/{}/03-2018'.format(SUBSCRIBER),
+            follow=True
+        )
+        self.assertNotIn(PIN_COOKIE, response.cookies)
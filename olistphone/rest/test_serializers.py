@@ -0,0 +1,88 @@
+from django.test import TestCase
+from rest.models import CallRecord, PhoneBill
+from rest.serializers import (
+    CallRecordSerializer,
+    PhoneBillSerializer,
+    represent_bills,
+    represent_bill_values
+)
+from decimal import Decimal
+from datetime import datetime, timedelta
+import random
+
+
+class RepresentBillsTests(TestCase):
+
+    def random_bills(self, count):
+        generator = random.Random(17)
+        start = datetime(2018, 3, 1)
+        return [
+            PhoneBill(
+                destination='41{:09d}'.format(generator.randrange(10**9)),
+                start_timestamp=start + timedelta(
+                    seconds=generator.randrange(31 * 86400),
+                    microseconds=generator.choice([0, 1, 250000])
+                ),
+                # Durations of calls that were just paired are floats
+                call_duration=generator.choice([
+                    generator.randrange(86400),
+                    float(generator.randrange(86400))
+                ]),
+                charge=generator.choice([
+                    Decimal(generator.randrange(10**6)) / 100,
+                    Decimal('0.36'),
+                    Decimal('12'),
+                    Decimal('1.005'),
+                    Decimal('0E-8')
+                ])
+            ) for _ in range(count)
+        ]
+
+    def test_same_as_serializer(self):
+        bills = self.random_bills(2000)
+        self.assertEqual(
+            represent_bills(bills),
+            PhoneBillSerializer(bills, many=True).data
+        )
+
+    def test_values(self):
+        PhoneBill.objects.bulk_create(self.random_bills(200))
+        bills = PhoneBill.objects.order_by('id')
+        self.assertEqual(
+            represent_bill_values(
+                bills.values_list(*PhoneBillSerializer.Meta.fields)
+            ),
+            PhoneBillSerializer(bills, many=True).data
+        )
+
+
+class CallRecordSerializerTests(TestCase):
+
+    def test_omits_empty_fields(self):
+        records = [
+            CallRecord(
+                id=1,
+                type='S',
+                timestamp=datetime(2018, 3, 1, 12, 0),
+                call_id=70,
+                source='2199999999',
+                destination='41000000000'
+            ),
+            CallRecord(
+                id=2,
+                type='E',
+                timestamp=datetime(2018, 3, 1, 12, 5),
+                call_id=70
+            ),
+        ]
+        self.assertEqual(
+            [
+                list(record)
+                for record in CallRecordSerializer(records, many=True).data
+            ],
+            [
+                ['id', 'type', 'timestamp', 'call_id', 'source',
+                 'destination'],
+                ['id', 'type', 'timestamp', 'call_id']
+            ]
+        )
@@ -1,14 +1,110 @@
 from django.test import TestCase
+from unittest import skipIf
 import rest.services as services
 from django.utils import timezone
 from dateutil.relativedelta import relativedelta
-from datetime import timedelta
-from rest.models import CallTariff
+from datetime import date, datetime, timedelta
+from math import floor
+from rest.models import CallTariff, Call
 from rest.test_models import create_record, create_bill
 from decimal import *
+import random
 getcontext().prec = 2
 
 
+# The per-period functions the pricing walk was made of, before the
+# closed form of services.calculate_pricing replaced it
+
+def calculate_basic_tariff(start, end, call_tariff):
+    '''
+    Function to calculate the usual tariff between two time periods
+    '''
+    # We only count full minutes
+    call_minutes = floor((end - start).seconds/60)
+    return call_minutes * call_tariff.minute_charge
+
+
+def calculate_discount_tariff(start, end, call_tariff):
+    '''
+    Function to calculate a discounted tariff between two time periods
+    '''
+    # We only count full minutes
+    call_minutes = floor((end - start).seconds/60)
+    return call_minutes * call_tariff.discount_charge
+
+
+def calculate_period(timestamp):
+    '''
+    Calculates the rates and time until the next change in tariff rate
+    from a given timestamp
+    '''
+    # Normal from 06:00:00 until 22:00:00
+    if (timestamp.hour >= 6) and (timestamp.hour < 22):
+        return False, (
+            timestamp.replace(hour=22, minute=0, second=0)
+            - timestamp
+        )
+    # Discount until 06:00:00 of the same day
+    if timestamp.hour < 6:
+        return True, (
+            timestamp.replace(hour=6, minute=0, second=0)
+            - timestamp
+        )
+    # Or of the next one
+    next_day = timestamp + relativedelta(days=1)
+    return True, next_day.replace(hour=6, minute=0, second=0) - timestamp
+
+
+def delta_hours(delta):
+    '''
+    Calculates a time delta in whole hours
+    '''
+    return floor(delta.seconds/3600)
+
+
+def reference_pricing(start, end, call_tariff):
+    '''
+    The pricing walk calculate_pricing used to do, one period at a
+    time. It is kept as the reference the closed form must match.
+    '''
+    tariff = 0
+    delta = services.calculate_time_delta(start, end)
+    current = start
+    while delta_hours(delta) >= 0:
+        is_discount_period, to_break = calculate_period(current)
+        if delta > to_break:
+            if is_discount_period:
+                tariff += calculate_discount_tariff(
+                    current,
+                    (current+to_break),
+                    call_tariff
+                )
+            else:
+                tariff += calculate_basic_tariff(
+                    current,
+                    (current+to_break),
+                    call_tariff
+                )
+            delta -= to_break
+            current += to_break
+        else:
+            if is_discount_period:
+                tariff += calculate_discount_tariff(
+                    current,
+                    end,
+                    call_tariff
+                )
+            else:
+                tariff += calculate_basic_tariff(
+                    current,
+                    end,
+                    call_tariff
+                )
+            break
+    tariff += call_tariff.base_tariff
+    return tariff
+
+
 class CallRecordServiceTests(TestCase):
 
     def setUp(self):
@@ -121,7 +217,7 @@ class CallRecordServiceTests(TestCase):
         time_end = time_start + relativedelta(seconds=137)
         tariff = (
             self.call_tariff.base_tariff
-            + services.calculate_basic_tariff(
+            + calculate_basic_tariff(
                 time_start,
                 time_end,
                 self.call_tariff
@@ -138,7 +234,7 @@ class CallRecordServiceTests(TestCase):
         time_end = time_start + relativedelta(seconds=137)
         tariff = (
             self.call_tariff.base_tariff
-            + services.calculate_discount_tariff(
+            + calculate_discount_tariff(
                 time_start,
                 time_end,
                 self.call_tariff
@@ -169,7 +265,7 @@ class CallRecordServiceTests(TestCase):
             minutes=23,
             seconds=18
         )
-        is_discount_period, to_break = services.calculate_period(time)
+        is_discount_period, to_break = calculate_period(time)
         self.assertEqual(expected_is_discount_period, is_discount_period)
         self.assertEqual(expected_to_break, to_break)
 
@@ -181,13 +277,13 @@ class CallRecordServiceTests(TestCase):
             minutes=48,
             seconds=10
         )
-        is_discount_period, to_break = services.calculate_period(time)
+        is_discount_period, to_break = calculate_period(time)
         self.assertEqual(expected_is_discount_period, is_discount_period)
         self.assertEqual(expected_to_break, to_break)
         time = time.replace(hour=5, minute=59, second=59)
         expected_is_discount_period = True
         expected_to_break = timedelta(seconds=1)
-        is_discount_period, to_break = services.calculate_period(time)
+        is_discount_period, to_break = calculate_period(time)
         self.assertEqual(expected_is_discount_period, is_discount_period)
         self.assertEqual(expected_to_break, to_break)
 
@@ -198,7 +294,7 @@ class CallRecordServiceTests(TestCase):
             hours=6,
             minutes=30,
         )
-        is_discount_period, to_break = services.calculate_period(time)
+        is_discount_period, to_break = calculate_period(time)
         self.assertEqual(expected_is_discount_period, is_discount_period)
         self.assertEqual(expected_to_break, to_break)
 
@@ -245,7 +341,195 @@ class CallRecordServiceTests(TestCase):
         )
         self.assertEqual(tariff, expected)
 
+    def test_calculate_pricing_multiple_days(self):
+        time_start = timezone.now().replace(hour=21, minute=0, second=0)
+        time_end = time_start + relativedelta(days=2, hours=9, minutes=10)
+        # Two whole days, plus the call above. The charges of each
+        # stretch are added up in turn, rounded to the precision of the
+        # context
+        expected = 0
+        for minutes in (60, 16 * 60, 16 * 60, 10):
+            expected += minutes * self.call_tariff.minute_charge
+        expected += self.call_tariff.base_tariff
+        tariff = services.calculate_pricing(
+            time_start,
+            time_end,
+            self.call_tariff
+        )
+        self.assertEqual(tariff, expected)
+        self.assertEqual(tariff, Decimal('1.8E+2'))
+
+    def test_calculate_pricing_matches_reference(self):
+        generator = random.Random(1994)
+        period_changes = (6 * 3600, 22 * 3600)
+        for _ in range(5000):
+            start = datetime(2018, 1, 1) + timedelta(
+                days=generator.randrange(365),
+                seconds=generator.randrange(24 * 3600),
+                microseconds=generator.choice((0, generator.randrange(10**6)))
+            )
+            # Short calls, calls across the period changes and calls
+            # lasting days, including ones ending right on a change
+            kind = generator.randrange(4)
+            if kind == 0:
+                duration = timedelta(seconds=generator.randrange(3600))
+            elif kind == 1:
+                duration = timedelta(seconds=generator.randrange(86400))
+            elif kind == 2:
+                duration = timedelta(seconds=generator.randrange(4 * 86400))
+            else:
+                midnight = start.replace(
+                    hour=0,
+                    minute=0,
+                    second=0,
+                    microsecond=start.microsecond
+                )
+                change = midnight + timedelta(
+                    days=generator.randrange(3),
+                    seconds=generator.choice(period_changes)
+                )
+                duration = max(change - start, timedelta(0))
+            duration += timedelta(
+                microseconds=generator.choice((0, generator.randrange(10**6)))
+            )
+            tariff = CallTariff(
+                base_tariff=Decimal(generator.randrange(100)) / 100,
+                minute_charge=Decimal(generator.randrange(10, 100)) / 100,
+                discount_charge=Decimal(generator.randrange(10)) / 100
+            )
+            self.assertEqual(
+                services.calculate_pricing(start, start+duration, tariff),
+                reference_pricing(start, start+duration, tariff),
+                (start, duration)
+            )
+
     def test_calculate_bills(self):
         expected = self.bills
         actual = services.calculate_bills(self.records)
         self.assertEqual(actual, expected)
+
+    def test_charge_calls_with_tariff_in_effect(self):
+        CallTariff.objects.create(
+            base_tariff=Decimal('0.50'),
+            minute_charge=Decimal('0.10'),
+            discount_charge=Decimal('0.00'),
+            valid_after=timezone.now().replace(day=1, month=1, year=2018)
+        )
+        time_start = timezone.now().replace(
+            day=27,
+            month=6,
+            hour=12,
+            minute=0,
+            second=0
+        )
+        calls = [
+            Call(
+                start_timestamp=time_start.replace(year=2017),
+                end_timestamp=time_start.replace(year=2017, minute=2)
+            ),
+            Call(
+                start_timestamp=time_start.replace(year=2018),
+                end_timestamp=time_start.replace(year=2018, minute=2)
+            ),
+        ]
+        # All the tariffs are fetched in one query, after checking the
+        # cached ones are out of date
+        with self.assertNumQueries(2):
+            services.charge_calls(calls)
+        self.assertEqual(calls[0].charge, Decimal('0.54'))
+        self.assertEqual(calls[1].charge, Decimal('0.70'))
+        # Then they are cached
+        with self.assertNumQueries(1):
+            services.charge_calls(calls)
+        self.assertEqual(calls[0].charge, Decimal('0.54'))
+        self.assertEqual(calls[1].charge, Decimal('0.70'))
+
+
+@skipIf(services.numpy is None, 'Batch pricing requires NumPy')
+class PriceCallsTests(TestCase):
+
+    def setUp(self):
+        self.tariffs = [
+            CallTariff(
+                valid_after=date(2018, 1, 1),
+                base_tariff=Decimal('0.50'),
+                minute_charge=Decimal('0.10'),
+                discount_charge=Decimal('0.01')
+            ),
+            CallTariff(
+                valid_after=date(1900, 1, 1),
+                base_tariff=Decimal('0.36'),
+                minute_charge=Decimal('0.09'),
+                discount_charge=Decimal('0.00')
+            ),
+        ]
+
+    def test_price_calls(self):
+        starts = services.numpy.array([
+            '2017-06-27T21:00:00',
+            '2018-06-27T21:00:00',
+            '1950-06-27T05:00:30',
+        ], dtype='datetime64[s]')
+        ends = services.numpy.array([
+            '2017-06-28T06:10:00',
+            '2018-06-28T06:10:00',
+            '1950-06-27T06:02:00',
+        ], dtype='datetime64[s]')
+        charges = services.price_calls(starts, ends, self.tariffs)
+        # 70 normal minutes and 480 discount minutes, with each tariff,
+        # then 59 discount minutes and 2 normal ones. Charges are
+        # rounded to two significant digits, as in calculate_pricing.
+        self.assertEqual(list(charges), [670, 1200, 54])
+
+    def test_price_calls_without_tariff(self):
+        starts = services.numpy.array(
+            ['1899-12-31T12:00'],
+            dtype='datetime64[s]'
+        )
+        ends = services.numpy.array(
+            ['1899-12-31T12:05'],
+            dtype='datetime64[s]'
+        )
+        self.assertRaises(
+            ValueError,
+            services.price_calls,
+            starts,
+            ends,
+            self.tariffs
+        )
+
+    def test_price_calls_matches_calculate_pricing(self):
+        generator = random.Random(2018)
+        starts = []
+        ends = []
+        for _ in range(5000):
+            start = datetime(2016, 1, 1) + timedelta(
+                days=generator.randrange(1000),
+                seconds=generator.randrange(24 * 3600),
+                microseconds=generator.choice((0, generator.randrange(10**6)))
+            )
+            starts.append(start)
+            ends.append(start + timedelta(
+                seconds=generator.choice((3600, 86400, 4 * 86400)),
+                microseconds=generator.randrange(10**6)
+            ) * generator.random())
+        charges = services.price_calls(
+            services.numpy.array(starts, dtype='datetime64[us]'),
+            services.numpy.array(ends, dtype='datetime64[us]'),
+            self.tariffs
+        )
+        for start, end, charge in zip(starts, ends, charges):
+            tariff = max(
+                (
+                    tariff for tariff in self.tariffs
+                    if tariff.valid_after <= start.date()
+                ),
+                key=lambda tariff: tariff.valid_after
+            )
+            self.assertEqual(
+                charge,
+                services.to_cents(
+                    services.calculate_pricing(start, end, tariff)
+                ),
+                (start, end)
+            )
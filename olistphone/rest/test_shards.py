@@ -0,0 +1,224 @@
+from django.core.management import call_command
+from django.db import connections
+from django.test import TestCase, override_settings
+from rest.models import Call, CallRecord, CallShard, LastCall, ShardBucket
+from rest.test_models import create_tariff
+import rest.shards as shards
+import rest.statement_cache as statement_cache
+from datetime import date, datetime
+from decimal import Decimal
+from io import StringIO
+import json
+import os
+import shutil
+import tempfile
+
+# Aliases of the shards, SQLite files created for the tests
+SHARDS = ['shard_test1', 'shard_test2']
+# Subscribers of buckets 266 and 275, in the first and second shard
+FIRST = '21998833444'
+SECOND = '21998833440'
+DESTINATION = '41000000040'
+
+
+def record_data(type, call_id, minute, source=None):
+    '''
+    Builds a record of a march 2018 call, as sent to /records/
+    '''
+    data = {
+        'type': type,
+        'timestamp': '2018-03-10T12:{:02}:00Z'.format(minute),
+        'call_id': call_id
+    }
+    if source is not None:
+        data['source'] = source
+        data['destination'] = DESTINATION
+    return data
+
+
+@override_settings(SHARDS=SHARDS)
+class ShardTests(TestCase):
+    # Every database is wrapped in the test transactions, including the
+    # shards added below before the test case is set up
+    multi_db = True
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        for alias in SHARDS:
+            connections.databases[alias] = {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': os.path.join(cls.directory, alias + '.sqlite3'),
+            }
+            call_command('migrate', database=alias, verbosity=0)
+        super(ShardTests, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(ShardTests, cls).tearDownClass()
+        for alias in SHARDS:
+            connections[alias].close()
+            del connections.databases[alias]
+            delattr(connections._connections, alias)
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        statement_cache.clear()
+        # The map cached by an earlier test may have the same version
+        shards.invalidate_map()
+        create_tariff(
+            valid_after=date(2018, 1, 1),
+            base_tariff=Decimal('0.36'),
+            minute_charge=Decimal('0.09'),
+            discount_charge=Decimal('0.00')
+        )
+
+    def post(self, data, path='/records/'):
+        return self.client.post(
+            path,
+            json.dumps(data),
+            content_type='application/json'
+        )
+
+    def count(self, model, alias, **filters):
+        return model.objects.using(alias).filter(**filters).count()
+
+    def billed_calls(self, subscriber):
+        response = self.client.get(
+            '/billing/{}/03-2018'.format(subscriber),
+            follow=True
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.data['billed_calls']
+
+    def test_records_stored_in_shard_of_subscriber(self):
+        self.assertEqual(
+            self.post(record_data('S', 1, 0, FIRST)).status_code,
+            201
+        )
+        # The end record is found through the directory of the calls
+        self.assertEqual(self.post(record_data('E', 1, 5)).status_code, 201)
+        self.assertEqual(self.count(CallRecord, SHARDS[0]), 2)
+        self.assertEqual(self.count(Call, SHARDS[0], source=FIRST), 1)
+        self.assertEqual(self.count(LastCall, SHARDS[0], source=FIRST), 1)
+        self.assertEqual(self.count(CallRecord, SHARDS[1]), 0)
+        self.assertEqual(self.count(CallRecord, 'default'), 0)
+        self.assertEqual(CallShard.objects.get(call_id=1).bucket, 266)
+        self.assertEqual(len(self.billed_calls(FIRST)), 1)
+        self.assertEqual(
+            Call.objects.for_subscriber(FIRST).get(source=FIRST).call_id,
+            1
+        )
+        # Resending is acknowledged from the shard
+        self.assertEqual(self.post(record_data('E', 1, 5)).status_code, 200)
+
+    def test_bulk_records_split_by_shard(self):
+        response = self.post([
+            record_data('S', 2, 0, FIRST),
+            record_data('S', 3, 1, SECOND),
+            record_data('E', 3, 4),
+            record_data('E', 2, 5),
+            record_data('E', 4, 6),
+        ], path='/records/bulk/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [result['status'] for result in response.data['results']],
+            ['accepted'] * 4 + ['rejected']
+        )
+        self.assertEqual(self.count(Call, SHARDS[0], source=FIRST), 1)
+        self.assertEqual(self.count(Call, SHARDS[1], source=SECOND), 1)
+        self.assertEqual(len(self.billed_calls(FIRST)), 1)
+        self.assertEqual(len(self.billed_calls(SECOND)), 1)
+
+    def test_call_id_taken_in_another_shard(self):
+        self.post(record_data('S', 5, 0, FIRST))
+        self.assertEqual(
+            self.post(record_data('S', 5, 10, SECOND)).status_code,
+            409
+        )
+        response = self.post(
+            [record_data('S', 5, 20, SECOND)],
+            path='/records/bulk/'
+        )
+        self.assertEqual(response.data['results'][0]['status'], 'rejected')
+        self.assertEqual(self.count(CallRecord, SHARDS[1]), 0)
+
+    def test_end_of_call_missing_from_directory(self):
+        # Started before the data was sharded
+        CallRecord.objects.using(SHARDS[1]).bulk_create([CallRecord(
+            type='S',
+            timestamp=datetime(2018, 3, 10, 12, 0),
+            call_id=6,
+            source=SECOND,
+            destination=DESTINATION
+        )])
+        self.assertEqual(self.post(record_data('E', 6, 5)).status_code, 201)
+        self.assertEqual(self.count(Call, SHARDS[1], call_id=6), 1)
+
+    def test_rebalance_moves_subscriber(self):
+        self.post(record_data('S', 7, 0, FIRST))
+        self.post(record_data('E', 7, 5))
+        self.post(record_data('S', 8, 10, SECOND))
+        self.post(record_data('E', 8, 15))
+        self.billed_calls(FIRST)
+        out = StringIO()
+        call_command(
+            'rebalance_shards',
+            subscriber=FIRST,
+            target=SHARDS[1],
+            stdout=out
+        )
+        self.assertIn(
+            'Moved bucket 266 (1 subscribers, 4 rows)',
+            out.getvalue()
+        )
+        self.assertEqual(
+            ShardBucket.objects.get(bucket=266).shard,
+            SHARDS[1]
+        )
+        self.assertEqual(shards.shard_for(FIRST), SHARDS[1])
+        self.assertEqual(self.count(CallRecord, SHARDS[0]), 0)
+        self.assertEqual(self.count(CallRecord, SHARDS[1]), 4)
+        self.assertEqual(self.count(Call, SHARDS[1]), 2)
+        self.assertEqual(len(self.billed_calls(FIRST)), 1)
+        # New calls of the subscriber follow it
+        self.post(record_data('S', 9, 20, FIRST))
+        self.assertEqual(self.post(record_data('E', 9, 25)).status_code, 201)
+        self.assertEqual(self.count(Call, SHARDS[1], source=FIRST), 2)
+        # Moving it back to the shard of its number forgets the move
+        call_command(
+            'rebalance_shards',
+            bucket=266,
+            target=SHARDS[0],
+            stdout=out
+        )
+        self.assertFalse(ShardBucket.objects.exists())
+        self.assertEqual(self.count(Call, SHARDS[0], source=FIRST), 2)
+        self.assertEqual(self.count(Call, SHARDS[1], source=SECOND), 1)
+
+    def test_rebalance_misplaced_buckets(self):
+        # E.g. stored before a shard was added
+        LastCall.objects.using(SHARDS[1]).create(
+            source=FIRST,
+            call_id=10,
+            start_timestamp=datetime(2018, 3, 10, 12, 0)
+        )
+        out = StringIO()
+        call_command('rebalance_shards', stdout=out)
+        self.assertIn('1 buckets moved', out.getvalue())
+        self.assertEqual(self.count(LastCall, SHARDS[0], source=FIRST), 1)
+        self.assertEqual(self.count(LastCall, SHARDS[1]), 0)
+
+    def test_ingest_checks_moves(self):
+        record = CallRecord(
+            type='S',
+            timestamp=datetime(2018, 3, 10, 12, 0),
+            call_id=11,
+            source=FIRST,
+            destination=DESTINATION
+        )
+        with shards.using_shard(shards.current(record)):
+            ShardBucket.objects.create(bucket=266, shard=SHARDS[1])
+            shards.invalidate_map()
+            with self.assertRaises(shards.ShardMoved):
+                shards.check_buckets([record])
@@ -0,0 +1,258 @@
+from django.conf import settings
+from django.test import TestCase, override_settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from rest.models import Call, CallRecord, SpoolCheckpoint
+import rest.ingest as ingest
+import rest.spool as spool
+from io import StringIO
+from unittest import mock
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+START = {
+    'type': 'S',
+    'timestamp': '2018-03-01T12:00:00Z',
+    'call_id': 70,
+    'source': '2199999999',
+    'destination': '41000000000'
+}
+END = {
+    'type': 'E',
+    'timestamp': '2018-03-01T12:05:00Z',
+    'call_id': 70
+}
+
+
+class SpoolTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings = override_settings(
+            INGEST_ASYNC=True,
+            INGEST_SPOOL_DIR=self.directory,
+            INGEST_SPOOL_FLUSH_INTERVAL=0
+        )
+        self.settings.enable()
+
+    def tearDown(self):
+        spool.get_writer().close()
+        self.settings.disable()
+        shutil.rmtree(self.directory)
+
+    def post(self, record):
+        return self.client.post(
+            '/records/',
+            content_type='application/json',
+            data=json.dumps(record),
+            follow=True
+        )
+
+    def status(self, position):
+        return self.client.get(
+            '/records/spool/{}/'.format(position),
+            follow=True
+        ).data
+
+    def apply(self):
+        out = StringIO()
+        call_command('apply_spool', '--once', stdout=out)
+        return out.getvalue()
+
+    def write_segment(self, segment, content):
+        with open(spool.segment_path(self.directory, segment), 'ab') as f:
+            f.write(content)
+
+    def test_spool_and_apply(self):
+        positions = []
+        for record in (START, END):
+            response = self.post(record)
+            self.assertEqual(response.status_code, 202)
+            positions.append(response.data['position'])
+        # Nothing is stored until the spool is applied
+        self.assertFalse(CallRecord.objects.exists())
+        self.assertEqual(self.status(positions[0])['status'], 'pending')
+        self.assertIn('2 accepted, 0 rejected', self.apply())
+        self.assertEqual(Call.objects.get(call_id=70).duration, 300)
+        for position in positions:
+            self.assertEqual(self.status(position)['status'], 'accepted')
+        # Applying again finds nothing new
+        self.assertIn('0 accepted, 0 rejected', self.apply())
+        self.assertEqual(CallRecord.objects.count(), 2)
+
+    def test_rejected_records(self):
+        # What could never be a record is not spooled
+        self.assertEqual(self.post([START]).status_code, 400)
+        self.assertEqual(self.post({}).status_code, 400)
+        positions = [
+            self.post(record).data['position']
+            for record in (END, START, dict(START, call_id=None))
+        ]
+        self.assertIn('1 accepted, 2 rejected', self.apply())
+        status = self.status(positions[0])
+        self.assertEqual(status['status'], 'rejected')
+        self.assertTrue(status['errors'])
+        self.assertEqual(self.status(positions[1])['status'], 'accepted')
+        response = self.client.get('/records/rejected/?limit=1', follow=True)
+        self.assertEqual(
+            [record['position'] for record in response.data['results']],
+            positions[:1]
+        )
+        self.assertEqual(
+            json.loads(response.data['results'][0]['record']),
+            END
+        )
+        response = self.client.get(
+            '/records/rejected/?limit=1&after={}'.format(
+                response.data['next']
+            ),
+            follow=True
+        )
+        self.assertEqual(
+            [record['position'] for record in response.data['results']],
+            positions[2:]
+        )
+        self.assertIsNone(response.data['next'])
+
+    def test_resent_records(self):
+        positions = [
+            self.post(record).data['position']
+            for record in (
+                START, END, START, dict(START, destination='41000000001')
+            )
+        ]
+        self.apply()
+        self.assertEqual(
+            [self.status(position)['status'] for position in positions],
+            ['accepted', 'accepted', 'accepted', 'rejected']
+        )
+        self.assertEqual(
+            self.status(positions[3])['errors'],
+            [ingest.CONFLICT_MESSAGE]
+        )
+        self.assertEqual(CallRecord.objects.count(), 2)
+
+    def test_invalid_requests(self):
+        self.assertEqual(
+            self.client.get('/records/spool/x/', follow=True).status_code,
+            400
+        )
+        self.assertEqual(
+            self.client.get(
+                '/records/rejected/?limit=0',
+                follow=True
+            ).status_code,
+            400
+        )
+
+    def test_malformed_and_partial_lines(self):
+        segment = spool.segment_name(time.time())
+        line = json.dumps(START).encode()
+        self.write_segment(segment, line + b'\n{"type": \n' + line[:10])
+        self.assertIn('1 accepted, 1 rejected', self.apply())
+        malformed = '{}:{}'.format(segment, len(line) + 1)
+        self.assertEqual(
+            self.status(malformed)['errors'],
+            ['Malformed record.']
+        )
+        # The last line is still being written
+        partial = '{}:{}'.format(segment, len(line) + 11)
+        self.assertEqual(self.status(partial)['status'], 'pending')
+        self.assertIn('0 accepted, 0 rejected', self.apply())
+        self.write_segment(
+            segment,
+            json.dumps(END).encode()[10:] + b'\n'
+        )
+        self.assertIn('1 accepted, 0 rejected', self.apply())
+        self.assertEqual(self.status(partial)['status'], 'accepted')
+        self.assertEqual(
+            CallRecord.objects.get(type='E').timestamp.minute,
+            5
+        )
+
+    def test_sealed_segments(self):
+        # Two hours ago, so past the grace period
+        sealed = spool.segment_name(
+            time.time() - 2 * settings.INGEST_SPOOL_SEGMENT_SECONDS
+        )
+        line = json.dumps(START).encode() + b'\n'
+        # The last append was cut by a crash
+        self.write_segment(sealed, line + line[:10])
+        self.assertIn('1 accepted, 1 rejected', self.apply())
+        self.assertEqual(
+            self.status('{}:{}'.format(sealed, len(line)))['status'],
+            'rejected'
+        )
+        # Drained and sealed, so removed
+        self.apply()
+        self.assertEqual(spool.list_segments(self.directory), [])
+        position = self.post(END).data['position']
+        self.assertIn('1 accepted, 0 rejected', self.apply())
+        self.assertEqual(self.status(position)['status'], 'accepted')
+
+    def test_crash_recovery(self):
+        for record in (START, END):
+            self.post(record)
+        with mock.patch(
+                'rest.spool.ingest_records',
+                side_effect=RuntimeError('crash')):
+            with self.assertRaises(RuntimeError):
+                self.apply()
+        # Nothing was committed, checkpoint included
+        self.assertFalse(CallRecord.objects.exists())
+        self.assertEqual(SpoolCheckpoint.load().offset, 0)
+        # The batch is applied again, once
+        self.assertIn('2 accepted, 0 rejected', self.apply())
+        self.assertIn('0 accepted, 0 rejected', self.apply())
+        self.assertEqual(CallRecord.objects.count(), 2)
+
+    def test_one_applier(self):
+        with open(os.path.join(self.directory, 'apply.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with self.assertRaises(CommandError):
+                self.apply()
+
+
+class SpoolWriterTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_group_commit(self):
+        writer = spool.SpoolWriter(self.directory, 0.05)
+        positions = []
+        appends = 16
+
+        def append(call_id):
+            positions.append(writer.append(dict(END, call_id=call_id)))
+
+        with mock.patch('rest.spool.os.fsync', wraps=os.fsync) as fsync:
+            threads = [
+                threading.Thread(target=append, args=(call_id, ))
+                for call_id in range(appends)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        writer.close()
+        # The appends made while one waits for the disk share its fsync
+        self.assertLess(fsync.call_count, appends // 2)
+        records = []
+        for position in positions:
+            segment, offset = spool.parse_position(position)
+            lines, _ = spool.read_records(
+                spool.segment_path(self.directory, segment),
+                offset,
+                1
+            )
+            records.append(json.loads(lines[0][1].decode())['call_id'])
+        self.assertEqual(sorted(records), list(range(appends)))
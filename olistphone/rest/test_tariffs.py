@@ -0,0 +1,73 @@
+from django.test import TestCase
+from rest.models import CallTariff, CacheVersion
+from rest.tariffs import TariffTimeline, get_timeline, TARIFFS_CACHE_KEY
+from rest.test_models import create_tariff
+from datetime import date, datetime
+from decimal import *
+getcontext().prec = 2
+
+
+class TariffTimelineTests(TestCase):
+
+    def setUp(self):
+        self.tariff = create_tariff(
+            valid_after=date(1994, 6, 27),
+            base_tariff=Decimal('0.36'),
+            minute_charge=Decimal('0.09'),
+            discount_charge=Decimal('0.00')
+        )
+
+    def test_tariff_at(self):
+        later_tariff = CallTariff(
+            valid_after=date(2018, 1, 1),
+            base_tariff=Decimal('0.50'),
+            minute_charge=Decimal('0.10'),
+            discount_charge=Decimal('0.00')
+        )
+        timeline = TariffTimeline([later_tariff, self.tariff])
+        self.assertIsNone(timeline.tariff_at(datetime(1994, 6, 26, 23)))
+        self.assertEqual(
+            timeline.tariff_at(datetime(1994, 6, 27, 0)),
+            self.tariff
+        )
+        self.assertEqual(
+            timeline.tariff_at(datetime(2017, 12, 31, 23, 59)),
+            self.tariff
+        )
+        self.assertEqual(
+            timeline.tariff_at(datetime(2018, 1, 1, 0)),
+            later_tariff
+        )
+
+    def test_timeline_is_cached(self):
+        timeline = get_timeline()
+        # Only the version is checked
+        with self.assertNumQueries(1):
+            self.assertIs(get_timeline(), timeline)
+
+    def test_timeline_follows_tariff_changes(self):
+        call_start = datetime(2018, 6, 27, 12, 0)
+        self.assertEqual(get_timeline().tariff_at(call_start), self.tariff)
+        later_tariff = create_tariff(
+            valid_after=date(2018, 1, 1),
+            base_tariff=Decimal('0.50'),
+            minute_charge=Decimal('0.10'),
+            discount_charge=Decimal('0.00')
+        )
+        self.assertEqual(get_timeline().tariff_at(call_start), later_tariff)
+        later_tariff.delete()
+        self.assertEqual(get_timeline().tariff_at(call_start), self.tariff)
+
+    def test_timeline_follows_other_processes(self):
+        timeline = get_timeline()
+        # Another process changed the tariffs, without the signals of
+        # this one knowing about it
+        CallTariff.objects.filter(pk=self.tariff.pk).update(
+            base_tariff=Decimal('0.40')
+        )
+        CacheVersion.bump(TARIFFS_CACHE_KEY)
+        self.assertIsNot(get_timeline(), timeline)
+        self.assertEqual(
+            get_timeline().tariff_at(datetime(2018, 6, 27)).base_tariff,
+            Decimal('0.40')
+        )
@@ -1,4 +1,15 @@
 from django.test import TestCase
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest.models import Call, CallRecord, CallTariff
+import rest.ingest as ingest
+from rest.test_models import create_record
+import rest.statement_cache as statement_cache
+from decimal import Decimal
+from unittest import mock
+import tracemalloc
+import json
+from datetime import datetime, timedelta
 
 
 class CallRecordViewTests(TestCase):
@@ -87,9 +98,73 @@ class CallRecordViewTests(TestCase):
             follow=True)
         self.assertEqual(response.status_code, 201)
 
+    def post_record(self, record):
+        return self.client.post(
+            '/records/',
+            content_type='application/json',
+            data=json.dumps(record),
+            follow=True
+        )
+
+    def test_resend_record(self):
+        start = {
+            'type': 'S',
+            'timestamp': '2017-12-12T15:10:13Z',
+            'call_id': 9990,
+            'source': '2199999999',
+            'destination': '41000000000'
+        }
+        end = {
+            'type': 'E',
+            'timestamp': '2017-12-12T15:13:13Z',
+            'call_id': 9990
+        }
+        for record in (start, end):
+            self.assertEqual(self.post_record(record).status_code, 201)
+            # Sent again, it is only looked up
+            with self.assertNumQueries(1):
+                response = self.post_record(record)
+            self.assertEqual(response.status_code, 200)
+        response = self.post_record(dict(start, destination='41000000001'))
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(
+            response.json()['detail'],
+            ingest.CONFLICT_MESSAGE
+        )
+        self.assertEqual(
+            self.post_record(dict(end, timestamp='2017-12-12T15:14:00Z'))
+            .status_code,
+            409
+        )
+        self.assertEqual(CallRecord.objects.count(), 2)
+        self.assertEqual(Call.objects.count(), 1)
+
+    def test_concurrent_resend(self):
+        start = {
+            'type': 'S',
+            'timestamp': '2017-12-12T15:10:13Z',
+            'call_id': 9990,
+            'source': '2199999999',
+            'destination': '41000000000'
+        }
+        self.assertEqual(self.post_record(start).status_code, 201)
+        # Another request stores the record after the lookup, and the
+        # insert breaks the unique constraint
+        with mock.patch(
+                'rest.ingest.find_stored',
+                side_effect=[None, CallRecord.objects.get()]), \
+                mock.patch(
+                    'rest.models.CallRecord.validate_save',
+                    return_value=None):
+            response = self.post_record(start)
+        self.assertEqual(response.status_code, 200)
+
 
 class MonthlyBillingViewTests(TestCase):
 
+    def setUp(self):
+        statement_cache.clear()
+
     def test_not_allowed_method(self):
         response = self.client.post(
             '/billing/21998833445/',
@@ -142,3 +217,507 @@ class MonthlyBillingViewTests(TestCase):
             follow=True
         )
         self.assertEqual(response.status_code, 200)
+
+    def test_request_bills_calls_ended_in_period(self):
+        calls = [
+            # Crosses into march, so it is billed there
+            (40, '21998833445', datetime(2018, 2, 28, 23, 59), 120),
+            (41, '21998833445', datetime(2018, 3, 10, 12, 0), 137),
+            # Another subscriber's call
+            (42, '21900000000', datetime(2018, 3, 10, 13, 0), 60),
+            # Ends in april
+            (43, '21998833445', datetime(2018, 3, 31, 23, 59), 120),
+        ]
+        for call_id, source, start, duration in calls:
+            create_record(
+                type='S',
+                timestamp=start,
+                call_id=call_id,
+                source=source,
+                destination='41000000000'
+            )
+            create_record(
+                type='E',
+                timestamp=start+timedelta(seconds=duration),
+                call_id=call_id
+            )
+        response = self.client.get(
+            '/billing/21998833445/03-2018',
+            follow=True
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['reference_period'], '3/2018')
+        self.assertEqual(
+            [
+                (bill['start_timestamp'], bill['call_duration'])
+                for bill in response.data['billed_calls']
+            ],
+            [('2018-02-28T23:59:00', 120), ('2018-03-10T12:00:00', 137)]
+        )
+
+    def measure_statement(self, url):
+        '''
+        Returns the number of queries and the peak memory allocated
+        by a statement request
+        '''
+        peaks = []
+        # Python grows its internal tables (e.g. of weakref finalizers)
+        # during whichever request fills them up, so the lowest peak of
+        # two requests is taken
+        for _ in range(2):
+            statement_cache.clear()
+            tracemalloc.start()
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, follow=True)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.assertEqual(response.status_code, 200)
+            peaks.append(peak)
+        return len(queries), min(peaks)
+
+    def test_statement_cost_ignores_other_subscribers(self):
+        for call_id in range(40, 45):
+            start = datetime(2018, 3, 10, 12, call_id)
+            create_record(
+                type='S',
+                timestamp=start,
+                call_id=call_id,
+                source='21998833445',
+                destination='41000000000'
+            )
+            create_record(
+                type='E',
+                timestamp=start+timedelta(seconds=30),
+                call_id=call_id
+            )
+        url = '/billing/21998833445/03-2018'
+        # The first request creates the bills, so we measure afterwards
+        self.client.get(url, follow=True)
+        quiet_queries, quiet_peak = self.measure_statement(url)
+        # A busy month for everybody else
+        Call.objects.bulk_create([
+            Call(
+                call_id=call_id,
+                source='21{:08d}'.format(call_id),
+                destination='41000000000',
+                start_timestamp=datetime(2018, 3, 15, 12, 0),
+                end_timestamp=datetime(2018, 3, 15, 12, 1),
+                duration=60,
+                charge=Decimal('0.45')
+            ) for call_id in range(1000, 6000)
+        ])
+        busy_queries, busy_peak = self.measure_statement(url)
+        self.assertEqual(busy_queries, quiet_queries)
+        # Allocations vary a little between runs, but they must not
+        # grow with the 5000 calls of other subscribers
+        self.assertLess(busy_peak, quiet_peak * 1.5)
+
+    def test_statement_query_budget(self):
+        Call.objects.bulk_create([
+            Call(
+                call_id=call_id,
+                source='21998833445',
+                destination='41{:09d}'.format(call_id),
+                start_timestamp=datetime(2018, 3, 1) + timedelta(
+                    minutes=call_id
+                ),
+                end_timestamp=datetime(2018, 3, 1) + timedelta(
+                    minutes=call_id,
+                    seconds=30
+                ),
+                duration=30,
+                charge=Decimal('0.36')
+            ) for call_id in range(150)
+        ])
+        url = '/billing/21998833445/03-2018'
+        # Whether the month was closed, the version of its calls, the
+        # calls, their bills and the insert of the missing bills,
+        # however many calls there are
+        with self.assertNumQueries(5):
+            response = self.client.get(url, follow=True)
+        self.assertEqual(len(response.data['billed_calls']), 150)
+        # Then the statement is cached, and only whether the month was
+        # closed and the version of its calls are read
+        with self.assertNumQueries(2):
+            response = self.client.get(url, follow=True)
+        self.assertEqual(len(response.data['billed_calls']), 150)
+        # Computed again, the bills are all there
+        statement_cache.clear()
+        with self.assertNumQueries(4):
+            response = self.client.get(url, follow=True)
+        self.assertEqual(len(response.data['billed_calls']), 150)
+
+    def test_statement_etag(self):
+        Call.objects.create(
+            call_id=1,
+            source='21998833445',
+            destination='41000000000',
+            start_timestamp=datetime(2018, 3, 1, 12, 0),
+            end_timestamp=datetime(2018, 3, 1, 12, 1),
+            duration=60,
+            charge=Decimal('0.45')
+        )
+        url = '/billing/21998833445/03-2018'
+        response = self.client.get(url, follow=True)
+        etag = response['ETag']
+        # Months that were not closed are revalidated on every poll
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+        # A client with the current statement gets no body back, after
+        # looking for a closed statement and reading its version
+        with self.assertNumQueries(2):
+            response = self.client.get(
+                url,
+                follow=True,
+                HTTP_IF_NONE_MATCH=etag
+            )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        # As does one whose statement was not cached, after a single
+        # aggregate over the subscriber's calls
+        statement_cache.clear()
+        with self.assertNumQueries(2):
+            response = self.client.get(
+                url,
+                follow=True,
+                HTTP_IF_NONE_MATCH=etag
+            )
+        self.assertEqual(response.status_code, 304)
+        # A new call in the month changes the statement
+        create_record(
+            type='S',
+            timestamp=datetime(2018, 3, 2, 12, 0),
+            call_id=2,
+            source='21998833445',
+            destination='41000000000'
+        )
+        create_record(
+            type='E',
+            timestamp=datetime(2018, 3, 2, 12, 1),
+            call_id=2
+        )
+        response = self.client.get(
+            url,
+            follow=True,
+            HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(response.data['billed_calls']), 2)
+
+    def test_statement_cache_invalidation(self):
+        create_record(
+            type='S',
+            timestamp=datetime(2018, 3, 10, 12, 0),
+            call_id=40,
+            source='21998833445',
+            destination='41000000000'
+        )
+        create_record(
+            type='E',
+            timestamp=datetime(2018, 3, 10, 12, 2),
+            call_id=40
+        )
+        march = '/billing/21998833445/03-2018'
+        april = '/billing/21998833445/04-2018'
+        self.client.get(march, follow=True)
+        self.client.get(april, follow=True)
+        # A call ending in april only drops the april statement
+        for record in (
+            {
+                'type': 'S',
+                'timestamp': '2018-03-31T23:59:00Z',
+                'call_id': 41,
+                'source': '21998833445',
+                'destination': '41000000000'
+            },
+            {'type': 'E', 'timestamp': '2018-04-01T00:01:00Z', 'call_id': 41},
+        ):
+            response = self.client.post(
+                '/records/',
+                content_type='application/json',
+                data=json.dumps(record),
+                follow=True
+            )
+            self.assertEqual(response.status_code, 201)
+        with self.assertNumQueries(2):
+            response = self.client.get(march, follow=True)
+        self.assertEqual(len(response.data['billed_calls']), 1)
+        response = self.client.get(april, follow=True)
+        self.assertEqual(len(response.data['billed_calls']), 1)
+        self.assertEqual(
+            self.client.get('/billing/cache/', follow=True).data,
+            {'hits': 1, 'misses': 3, 'hit_rate': 0.25}
+        )
+        # A tariff valid from april on does not cover march
+        CallTariff.objects.create(
+            base_tariff=Decimal('0.36'),
+            minute_charge=Decimal('0.09'),
+            discount_charge=Decimal('0.00'),
+            valid_after=datetime(2018, 4, 1).date()
+        )
+        with self.assertNumQueries(2):
+            self.client.get(march, follow=True)
+        # April is computed again, its bills already stored
+        with self.assertNumQueries(4):
+            self.client.get(april, follow=True)
+
+    def test_statement_cached_while_calls_stored(self):
+        url = '/billing/21998833445/03-2018'
+        call = Call(
+            call_id=40,
+            source='21998833445',
+            destination='41000000040',
+            start_timestamp=datetime(2018, 3, 10, 12, 0),
+            end_timestamp=datetime(2018, 3, 10, 12, 1),
+            duration=60,
+            charge=Decimal('0.45')
+        )
+        Call.objects.bulk_create([call])
+        self.client.get(url, follow=True)
+        # A call committed without dropping anything from the cache, as
+        # when a reader caches the statement after the call was stored
+        # but before it was committed
+        call.pk = None
+        call.call_id = 41
+        call.destination = '41000000041'
+        Call.objects.bulk_create([call])
+        response = self.client.get(url, follow=True)
+        self.assertEqual(len(response.data['billed_calls']), 2)
+        # The statement of the new version is cached in turn
+        with self.assertNumQueries(2):
+            response = self.client.get(url, follow=True)
+        self.assertEqual(len(response.data['billed_calls']), 2)
+
+    def test_streamed_statement(self):
+        Call.objects.bulk_create([
+            Call(
+                call_id=call_id,
+                source='21998833445',
+                destination='41{:09d}'.format(call_id),
+                start_timestamp=datetime(2018, 3, 1) + timedelta(
+                    minutes=call_id
+                ),
+                end_timestamp=datetime(2018, 3, 1) + timedelta(
+                    minutes=call_id,
+                    seconds=30
+                ),
+                duration=30,
+                charge=Decimal('0.36')
+            ) for call_id in range(1000)
+        ])
+        url = '/billing/21998833445/03-2018'
+        response = self.client.get(url + '?stream=1', follow=True)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        # The envelope is sent before any call is read
+        content = iter(response.streaming_content)
+        with self.assertNumQueries(0):
+            first = next(content)
+        self.assertEqual(
+            first,
+            b'{"subscriber":"21998833445","reference_period":"3/2018",'
+            + b'"billed_calls":['
+        )
+        # Then the calls are read once, and the bills of each chunk of
+        # them fetched with a query
+        with CaptureQueriesContext(connection) as queries:
+            streamed = first + b''.join(content)
+        # PostgreSQL reads the calls with a cursor declared for the query
+        selects = [
+            query['sql'].split(' FROM ')[1].split()[0]
+            for query in queries
+            if query['sql'].startswith(('SELECT', 'DECLARE'))
+        ]
+        self.assertEqual(
+            selects,
+            ['"rest_call"'] + ['"rest_phonebill"'] * 3
+        )
+        # Streamed statements are not cached, and the same as the others
+        self.assertEqual(streamed, self.client.get(url, follow=True).content)
+        self.assertEqual(
+            len(json.loads(streamed.decode())['billed_calls']),
+            1000
+        )
+
+    def test_streamed_statement_without_calls(self):
+        response = self.client.get(
+            '/billing/21998833445/03-2018?stream=1',
+            follow=True
+        )
+        self.assertEqual(
+            json.loads(b''.join(response.streaming_content).decode()),
+            {
+                'subscriber': '21998833445',
+                'reference_period': '3/2018',
+                'billed_calls': []
+            }
+        )
+
+    def test_paginated_statement(self):
+        Call.objects.bulk_create([
+            Call(
+                call_id=call_id,
+                source='21998833445',
+                destination='41{:09d}'.format(call_id),
+                start_timestamp=datetime(2018, 3, 1) + timedelta(
+                    minutes=call_id
+                ),
+                end_timestamp=datetime(2018, 3, 1) + timedelta(
+                    minutes=call_id,
+                    seconds=30
+                ),
+                duration=30,
+                charge=Decimal('0.36')
+            ) for call_id in range(250)
+        ])
+        url = '/billing/21998833445/03-2018'
+        whole = self.client.get(url, follow=True).data['billed_calls']
+        pages = []
+        cursor = ''
+        while cursor is not None:
+            # The totals, the page of calls and their bills
+            with self.assertNumQueries(3):
+                response = self.client.get(
+                    url + '?limit=100' + (
+                        '&after=' + cursor if cursor else ''
+                    ),
+                    follow=True
+                )
+            self.assertEqual(
+                response.data['totals'],
+                {'calls': 250, 'duration': 7500, 'charge': '90.00'}
+            )
+            pages.append(response.data['billed_calls'])
+            cursor = response.data['next']
+        self.assertEqual([len(page) for page in pages], [100, 100, 50])
+        self.assertEqual([bill for page in pages for bill in page], whole)
+        # Pages are versioned like the whole statement
+        response = self.client.get(
+            url + '?limit=100',
+            follow=True,
+            HTTP_IF_NONE_MATCH=response['ETag']
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_paginated_statement_ties(self):
+        # Calls with no duration may end at the same time
+        end = datetime(2018, 3, 10, 12, 0)
+        Call.objects.bulk_create([
+            Call(
+                call_id=call_id,
+                source='21998833445',
+                destination='41000000000',
+                start_timestamp=end,
+                end_timestamp=end,
+                duration=0,
+                charge=Decimal('0.36')
+            ) for call_id in range(3)
+        ])
+        url = '/billing/21998833445/03-2018?limit=1'
+        seen = 0
+        cursor = ''
+        while cursor is not None:
+            response = self.client.get(
+                url + ('&after=' + cursor if cursor else ''),
+                follow=True
+            )
+            seen += len(response.data['billed_calls'])
+            cursor = response.data['next']
+        self.assertEqual(seen, 3)
+
+    def test_paginated_statement_without_calls(self):
+        response = self.client.get(
+            '/billing/21998833445/03-2018?limit=10',
+            follow=True
+        )
+        self.assertEqual(response.data['billed_calls'], [])
+        self.assertIsNone(response.data['next'])
+        self.assertEqual(
+            response.data['totals'],
+            {'calls': 0, 'duration': 0, 'charge': '0.00'}
+        )
+
+    def test_invalid_pagination(self):
+        url = '/billing/21998833445/03-2018'
+        for query in (
+                '?limit=0',
+                '?limit=1001',
+                '?limit=ten',
+                '?after=notacursor',
+                '?limit=10&after=MjAxOC0wMy0x'):
+            response = self.client.get(url + query, follow=True)
+            self.assertEqual(response.status_code, 400, query)
+
+
+class BulkCallRecordViewTests(TestCase):
+
+    def test_not_allowed_method(self):
+        response = self.client.get(
+            '/records/bulk/',
+            follow=True)
+        self.assertEqual(response.status_code, 405)
+
+    def test_send_invalid_data(self):
+        response = self.client.post(
+            '/records/bulk/',
+            content_type='application/json',
+            data='[]',
+            follow=True)
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(
+            '/records/bulk/',
+            content_type='application/json',
+            data='{"type":"E", "timestamp":"2017-12-12T15:13:13Z",'
+            + ' "call_id": 9990}',
+            follow=True)
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(
+            '/records/bulk/',
+            content_type='application/x-ndjson',
+            data='{"type":"E"}\n{"type":',
+            follow=True)
+        self.assertEqual(response.status_code, 400)
+
+    def test_send_json_array(self):
+        valid_data = '[{"type":"S", "timestamp":"2017-12-12T15:10:13Z",' \
+            + ' "call_id": 9990, "source": "2199999999",' \
+            + ' "destination": "41000000000"},' \
+            + ' {"type":"E", "timestamp":"2017-12-12T15:13:13Z",' \
+            + ' "call_id": 9990},' \
+            + ' {"type":"E", "timestamp":"2017-12-12T15:13:13Z",' \
+            + ' "call_id": 9991}]'
+        response = self.client.post(
+            '/records/bulk/',
+            content_type='application/json',
+            data=valid_data,
+            follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['accepted'], 2)
+        self.assertEqual(response.json()['rejected'], 1)
+        self.assertEqual(
+            [result['status'] for result in response.json()['results']],
+            ['accepted', 'accepted', 'rejected']
+        )
+        # The batch sent again, after a timeout
+        response = self.client.post(
+            '/records/bulk/',
+            content_type='application/json',
+            data=valid_data,
+            follow=True)
+        self.assertEqual(response.json()['accepted'], 0)
+        self.assertEqual(response.json()['duplicates'], 2)
+        self.assertEqual(response.json()['rejected'], 1)
+
+    def test_send_ndjson(self):
+        valid_data = '{"type":"S", "timestamp":"2017-12-12T15:10:13Z",' \
+            + ' "call_id": 9990, "source": "2199999999",' \
+            + ' "destination": "41000000000"}\n' \
+            + '{"type":"E", "timestamp":"2017-12-12T15:13:13Z",' \
+            + ' "call_id": 9990}\n'
+        response = self.client.post(
+            '/records/bulk/',
+            content_type='application/x-ndjson',
+            data=valid_data,
+            follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['accepted'], 2)
@@ -1,11 +1,27 @@
-from rest.models import CallRecord
+from rest.models import CallRecord, Call, MonthlyStatement, RejectedRecord
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import Count, Max
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from calendar import timegm
 from django.core.exceptions import ValidationError
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.renderers import JSONRenderer
 from rest_framework.parsers import JSONParser
+from rest.parsers import NDJSONParser
+import rest.archive as archive
 import rest.services as services
-from rest.serializers import CallRecordSerializer, PhoneBillSerializer
+import rest.ingest as ingest
+import rest.routers as routers
+import rest.shards as shards
+import rest.spool as spool
+import rest.statement_cache as statement_cache
+from rest.serializers import CallRecordSerializer, StatementTotalsSerializer
+import json
 import re
 
 
@@ -17,6 +33,10 @@ class CallRecordView(APIView):
         '''
         Method to receive a CallRecord creation request, in JSON format
         '''
+        # In the asynchronous mode, the record is only spooled here and
+        # validated when apply_spool stores it
+        if settings.INGEST_ASYNC:
+            return self.spool(request)
         # If we don't have an empty POST...
         if request.data:
             # Try to process and validate the request data
@@ -28,24 +48,191 @@ class CallRecordView(APIView):
             if not is_valid:
                 # Return a 400 BAD REQUEST :(
                 return Response(serializer.errors, status=400)
-            # If it is valid, try saving it since we have methods
-            # inside the model for additional validation
-            try:
-                serializer.save()
-            # If it fails model-side validation, we return a 400 BAD
-            # REQUEST as well
-            except ValidationError as err:
-                return Response(data=err, status=400)
-            # If all is done correctly, return a 201 CREATED
-            return Response(status=201)
+            record = CallRecord(**serializer.validated_data)
+            # The record is stored in the shard of its subscriber, and
+            # sent again to the new one if the subscriber was moved
+            # while it was validated
+            while True:
+                try:
+                    with shards.using_shard(shards.current(record)):
+                        return self.store(serializer, record)
+                except shards.ShardMoved:
+                    continue
         # ...if it's empty, just return a 400 BAD REQUEST
         return Response(status=400)
 
+    def store(self, serializer, record):
+        '''
+        Stores a valid record, in the current shard
+        '''
+        # A client retrying may have sent this record already, which
+        # is checked before the costlier validations
+        stored = ingest.find_stored(record)
+        if stored is not None:
+            return self.resent(record, stored)
+        # If it is valid, try saving it since we have methods
+        # inside the model for additional validation
+        try:
+            serializer.save()
+        # If it fails model-side validation, we return a 400 BAD
+        # REQUEST as well
+        except ValidationError as err:
+            return Response(data=err, status=400)
+        # A concurrent request stored the same call_id in between
+        except IntegrityError:
+            stored = ingest.find_stored(record)
+            if stored is None:
+                return Response(
+                    data={
+                        'detail': 'A record with this call_id and'
+                        + ' timestamp already exists.'
+                    },
+                    status=409
+                )
+            return self.resent(record, stored)
+        # If all is done correctly, return a 201 CREATED
+        return Response(status=201)
+
+    def resent(self, record, stored):
+        '''
+        Answers a record whose type and call_id are stored already
+        '''
+        # Return a 200 OK if it was stored as sent, so retries succeed
+        if record.is_resend_of(stored):
+            return Response(status=200)
+        # Return a 409 CONFLICT if it is a different record
+        return Response(
+            data={'detail': ingest.CONFLICT_MESSAGE},
+            status=409
+        )
+
+    def spool(self, request):
+        '''
+        Appends the record to the ingest spool, answering with its
+        position there once it is on disk
+        '''
+        # Only what could never be a record is rejected right away
+        if not request.data or not isinstance(request.data, dict):
+            return Response(status=400)
+        position = spool.append(request.data)
+        # Return a 202 ACCEPTED, the record being stored later
+        return Response({'position': position}, status=202)
+
+
+class RecordStatusView(APIView):
+    renderer_classes = (JSONRenderer, )
+
+    def get(self, request, position):
+        '''
+        Reports whether a spooled record is still pending, was stored,
+        or was rejected and why
+        '''
+        try:
+            return Response(spool.record_status(position))
+        except ValueError:
+            return Response(status=400)
+
+
+class RejectedRecordsView(APIView):
+    renderer_classes = (JSONRenderer, )
+
+    # Rejected records listed per page, by default and at most
+    PAGE_SIZE = 100
+    MAX_PAGE_SIZE = 1000
+
+    def get(self, request):
+        '''
+        Lists the spooled records that were rejected, oldest first. The
+        "next" of a page is the "after" of the one following it
+        '''
+        try:
+            limit = int(request.query_params.get('limit', self.PAGE_SIZE))
+            after = int(request.query_params.get('after', 0))
+        except ValueError:
+            return Response(status=400)
+        if not 1 <= limit <= self.MAX_PAGE_SIZE:
+            return Response(status=400)
+        rejected = list(
+            RejectedRecord.objects.filter(id__gt=after).order_by('id')
+            [:limit+1]
+        )
+        return Response({
+            'results': [
+                {
+                    'position': record.position,
+                    'record': record.record,
+                    'errors': json.loads(record.errors),
+                    'rejected_at': record.rejected_at
+                } for record in rejected[:limit]
+            ],
+            'next': rejected[limit-1].id if len(rejected) > limit else None
+        })
+
+
+class BulkCallRecordView(APIView):
+    renderer_classes = (JSONRenderer, )
+    parser_classes = (JSONParser, NDJSONParser)
+
+    def post(self, request):
+        '''
+        Method to receive many CallRecord creation requests at once,
+        either as a JSON array or as newline-delimited JSON
+        '''
+        # An empty body or empty array has nothing to ingest
+        if not request.data:
+            return Response(status=400)
+        # A single JSON object should go through /records/
+        if not isinstance(request.data, list):
+            return Response(
+                data={'detail': 'Expected a list of records.'},
+                status=400
+            )
+        results = ingest.ingest_records(request.data)
+        accepted = sum(
+            1 for result in results if result['status'] == 'accepted'
+        )
+        # Records stored by an earlier attempt of the same batch
+        duplicates = sum(
+            1 for result in results if result['status'] == 'duplicate'
+        )
+        # The batch itself was processed, so we return a 200 OK and
+        # report each record's outcome in the body
+        return Response({
+            'accepted': accepted,
+            'duplicates': duplicates,
+            'rejected': len(results) - accepted - duplicates,
+            'results': results
+        })
+
+
+class StatementCacheView(APIView):
+    renderer_classes = (JSONRenderer, )
+
+    def get(self, request):
+        '''
+        Reports the hits and misses of the statement cache
+        '''
+        return Response(statement_cache.get_stats())
+
 
 class MonthlyBillingView(APIView):
     renderer_classes = (JSONRenderer, )
     parser_classes = (JSONParser, )
 
+    def dispatch(self, request, *args, **kwargs):
+        '''
+        Serves the request from the shard of the subscriber
+        '''
+        alias = shards.shard_for(kwargs['phone_number'])
+        with shards.using_shard(alias):
+            return super(MonthlyBillingView, self).dispatch(
+                request,
+                *args,
+                **kwargs
+            )
+
+    # Statements are read from the replicas, if any
+    @routers.read_from_replicas()
     def get(self, request, phone_number, year_month=None):
         '''
         This method receives a phone number and optionally a year-month
@@ -74,53 +261,214 @@ class MonthlyBillingView(APIView):
                      )
             except ValueError:
                 return Response(status=400)
-        # Find calls that ended in the reference period
-        # The spec says that inclusion or exclusion in a monthly period
-        # is through the call end timestamp, so we filter accordingly
-        monthly_records_by_end = CallRecord.objects.filter(
-            type='E',
-            timestamp__gte=last_reference_start,
-            timestamp__lte=last_reference_end
-        )
-        # Next we need to find out what of these calls are made by
-        # the number we want to search for so we filter out
-        # for the calls that are made by the source...
-        calls_by_this_source = CallRecord.objects.filter(
+        # Find the calls of this number that ended in the reference
+        # period. The spec says that inclusion or exclusion in a monthly
+        # period is through the call end timestamp, so we filter
+        # accordingly. Calls are stored once their end record arrives,
+        # so this is a single range scan over the subscriber's index
+        calls_by_this_source = Call.objects.filter(
             source=phone_number,
-            call_id__in=[
-                call.call_id for call in monthly_records_by_end
-            ]
+            end_timestamp__gte=last_reference_start,
+            end_timestamp__lte=last_reference_end
         )
-        # ...and then filter again for the call end records, since
-        # they do not contain a "source" number
-        calls_by_this_source = (
+        # Dashboards page through large statements instead
+        if ('limit' in request.query_params
+                or 'after' in request.query_params):
+            return self.get_page(
+                request,
+                phone_number,
+                last_reference_start,
+                archived_calls(
+                    phone_number,
+                    last_reference_start,
+                    last_reference_end,
+                    calls_by_this_source
+                )
+            )
+        # Closed periods are served as they were stored at close, unless
+        # a call of the period ended late and the statement was dropped
+        # (see models.drop_statements). Only past periods can be closed,
+        # so polls of the current one skip the lookup
+        if last_reference_end < timezone.now():
+            try:
+                statement = MonthlyStatement.objects.get(
+                    subscriber=phone_number,
+                    period=last_reference_start.date()
+                )
+            except MonthlyStatement.DoesNotExist:
+                statement = None
+            if statement is not None:
+                etag = quote_etag(statement.etag)
+                last_modified = timegm(statement.closed_at.utctimetuple())
+                # The client's copy is current, so the content is not
+                # sent again
+                response = get_conditional_response(
+                    request,
+                    etag=etag,
+                    last_modified=last_modified
+                )
+                if response is None:
+                    response = HttpResponse(
+                        statement.content,
+                        content_type='application/json'
+                    )
+                return statement_headers(
+                    response,
+                    etag,
+                    last_modified,
+                    settings.CLOSED_STATEMENT_MAX_AGE
+                )
+        calls_by_this_source = archived_calls(
+            phone_number,
+            last_reference_start,
+            last_reference_end,
             calls_by_this_source
-            | monthly_records_by_end.filter(
-                type='E',
-                call_id__in=[
-                    call.call_id for call in calls_by_this_source
-                ]
+        )
+        if isinstance(calls_by_this_source, list):
+            version = services.summarize_calls(calls_by_this_source)
+            calls = iter(calls_by_this_source)
+        else:
+            calls_by_this_source = calls_by_this_source.order_by(
+                'end_timestamp'
+            )
+            # Calls are priced once and billed once, so the statement
+            # only changes when its calls do. Their count and latest id,
+            # read from the index alone, make up its version
+            version = calls_by_this_source.aggregate(
+                calls=Count('id'),
+                last_call=Max('id')
             )
+            # The calls are streamed from the cursor instead of being
+            # cached in the queryset, since we only go through them once
+            calls = calls_by_this_source.iterator()
+        version = '{}-{}'.format(version['calls'], version['last_call'] or 0)
+        etag = quote_etag(version)
+        response = get_conditional_response(request, etag=etag)
+        if response is not None:
+            return statement_headers(response, etag)
+        # Statements computed on request are cached under their version,
+        # which is read from the same database as the calls. An entry
+        # computed from a replica that lags, or while calls were being
+        # stored, only answers for the calls it was computed from.
+        return_data = statement_cache.get_statement(
+            phone_number,
+            last_reference_start,
+            last_reference_end,
+            version
         )
-        # We then order the queryset by call_id to group the calls
-        # with the same id together. This is necessary for the groupby
-        # call in the service.calculate_bills method
-        calls_by_this_source = calls_by_this_source.order_by('call_id')
-        bills = services.calculate_bills(calls_by_this_source)
-        reference_period = "{}/{}".format(
-            last_reference_start.month,
-            last_reference_start.year
+        if return_data is not None:
+            return statement_headers(Response(return_data), etag)
+        # Large statements may be requested as a stream, which starts
+        # before the calls are read and holds a chunk of them at a time.
+        # It is not cached, since it is never whole in memory.
+        if request.query_params.get('stream'):
+            # The stream is read after the view returns, out of the
+            # block of the shard
+            response = StreamingHttpResponse(
+                shards.keep_shard(services.stream_statement(
+                    phone_number,
+                    last_reference_start,
+                    calls
+                )),
+                content_type='application/json'
+            )
+            return statement_headers(response, etag)
+        bills = services.bill_calls(calls)
+        return_data = services.build_statement(
+            phone_number,
+            last_reference_start,
+            bills
+        )
+        statement_cache.set_statement(
+            phone_number,
+            last_reference_start,
+            version,
+            return_data
         )
-        # Create a serializer to create the response data
-        serializer = PhoneBillSerializer(data=bills, many=True)
-        # Double-check for validity
-        serializer.is_valid()
-        # Create the response dict with the subscriber and reference
-        # period fields
-        return_data = {
-            "subscriber": phone_number,
-            "reference_period": reference_period,
-            "billed_calls": serializer.data
-        }
         # Return a 200 OK response with the requested data
-        return Response(return_data)
+        return statement_headers(Response(return_data), etag)
+
+    def get_page(self, request, phone_number, reference_start, calls):
+        '''
+        Gets a page of a statement, after the "after" cursor and of at
+        most "limit" bills, with the totals of the whole statement
+        '''
+        try:
+            limit = int(request.query_params.get(
+                'limit',
+                services.PAGE_SIZE
+            ))
+            if not 0 < limit <= services.MAX_PAGE_SIZE:
+                raise ValueError('Invalid limit.')
+            after = request.query_params.get('after')
+            if after is not None:
+                after = services.decode_cursor(after)
+        except ValueError:
+            return Response(status=400)
+        # The totals are summed by the database, which also gives the
+        # version of the statement
+        totals = services.summarize_calls(calls)
+        etag = quote_etag('{}-{}'.format(
+            totals['calls'],
+            totals['last_call'] or 0
+        ))
+        response = get_conditional_response(request, etag=etag)
+        if response is not None:
+            return statement_headers(response, etag)
+        page, next_cursor = services.page_calls(calls, limit, after)
+        return_data = services.build_statement(
+            phone_number,
+            reference_start,
+            services.bill_calls(page)
+        )
+        return_data['totals'] = StatementTotalsSerializer(totals).data
+        return_data['next'] = next_cursor
+        return statement_headers(Response(return_data), etag)
+
+
+def archived_calls(subscriber, reference_start, reference_end, calls):
+    '''
+    Gets the calls of a subscriber in an archived month, from the archive
+    and the queryset of those that ended after it was archived, as a
+    list ordered by end. The queryset is returned as is for the other
+    months.
+    '''
+    # Only months that ended are archived
+    if reference_end >= timezone.now():
+        return calls
+    archived = archive.open_archive(reference_start)
+    if archived is None:
+        return calls
+    calls = list(calls)
+    # A call stored again after it was archived replaces the archived
+    # copy, as in archive.merge_rows, so it is not billed twice
+    call_ids = {call.call_id for call in calls}
+    return sorted(
+        [
+            call for call in archived.calls_of(subscriber)
+            if call.call_id not in call_ids
+        ] + calls,
+        key=lambda call: (call.end_timestamp, call.id)
+    )
+
+
+def statement_headers(response, etag, last_modified=None, max_age=None):
+    '''
+    Sets the caching headers of a statement response. Statements with a
+    max_age are used by clients for that long and then revalidated,
+    the others revalidated every time.
+    '''
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    # Statements are personal, so only the client may cache them
+    if max_age is not None:
+        patch_cache_control(
+            response,
+            private=True,
+            max_age=max_age,
+            must_revalidate=True
+        )
+    else:
+        patch_cache_control(response, private=True, no_cache=True)
+    return response